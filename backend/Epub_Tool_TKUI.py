@@ -39,12 +39,16 @@ try:
     from utils.font_subset import run_epub_font_subset
     from utils.chinese_convert import run_s2t, run_t2s
     from utils.regex_footnote import run as run_regex_footnote
+    from utils.log import flush_logs
 except ImportError:
 
     def mock_run(filepath, outdir, *args):
         time.sleep(0.2)
         return 0
 
+    def flush_logs():
+        pass
+
     encrypt_run = decrypt_run = reformat_run = run_epub_font_encrypt = (
         run_webp_to_img
     ) = run_img_to_webp = run_epub_img_transfer = run_epub_font_subset = run_s2t = run_t2s = run_regex_footnote = mock_run
@@ -473,6 +477,7 @@ class ModernEpubTool(BaseClass):
                 Messagebox.show_warning("无法找到有效的输出路径记录", "提示", parent=self)
 
     def open_log_file(self):
+        flush_logs()
         log_path = os.path.join(
             os.path.dirname(os.path.abspath(sys.argv[0])), "log.txt"
         )
@@ -649,6 +654,8 @@ class ModernEpubTool(BaseClass):
                 msg = f"输出至: {real_out_dir}"
             except Exception as e:
                 tag, status, msg = ("error", "异常", str(e))
+            # 日志是缓冲写入的，每本书处理完后写出，便于随时查看
+            flush_logs()
 
             # 传递 real_out_dir 到队列
             timestamp = time.strftime("%H:%M:%S")
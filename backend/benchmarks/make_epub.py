@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+# 生成用于性能测试的合成 EPUB
+#
+# 内容按固定随机种子生成，同样的参数总是得到同样的书籍，便于在不同提交之间对比。
+# 章节正文混合简体/繁体文字、生僻字 (注音)、阅微脚注 (阅微转多看)，
+# 并引用内嵌 CJK 字体 (字体子集化/加密) 和 PNG/JPEG/WebP 图片 (图片压缩/格式转换)。
+#
+#     python backend/benchmarks/make_epub.py out.epub --chapters 200 --chapter-kb 20 --images 50
+#
+# 依赖项目本身已使用的 pillow 和 fonttools。
+
+import argparse
+import io
+import random
+import zipfile
+
+from fontTools.fontBuilder import FontBuilder
+from fontTools.pens.ttGlyphPen import TTGlyphPen
+from PIL import Image
+
+SIMPLIFIED = "这是一个简体中文测试段落头发和发展都在这里汉字转换很重要读书学习时间图书馆里的书籍数量众多"
+TRADITIONAL = "這是一個繁體中文測試段落頭髮與發展都在這裡漢字轉換很重要讀書學習時間圖書館裡的書籍數量眾多"
+RARE = "㐲㐷龘䶮𫘣㑇㒸㔾㠯㧑㴔䲟䴕"
+PUNCTUATION = "，。！？；："
+
+IMAGE_FORMATS = (("png", "PNG", "image/png"), ("jpg", "JPEG", "image/jpeg"), ("webp", "WEBP", "image/webp"))
+
+# 固定的时间戳，保证同样参数生成的文件完全相同
+DATE_TIME = (2024, 1, 1, 0, 0, 0)
+
+CONTAINER_XML = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+    '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>'
+    "</container>"
+)
+
+
+def make_font(chars, family):
+    # 每个字形都是简单的方框，字数决定字体体积
+    fb = FontBuilder(1000, isTTF=True)
+    names = [".notdef"] + ["uni%04X" % ord(c) for c in chars]
+    fb.setupGlyphOrder(names)
+    fb.setupCharacterMap({ord(c): "uni%04X" % ord(c) for c in chars})
+    glyphs = {}
+    for i, name in enumerate(names):
+        pen = TTGlyphPen(None)
+        inset = 50 + i % 200
+        pen.moveTo((inset, 0))
+        pen.lineTo((inset, 800))
+        pen.lineTo((1000 - inset, 800))
+        pen.lineTo((1000 - inset, 0))
+        pen.closePath()
+        glyphs[name] = pen.glyph()
+    fb.setupGlyf(glyphs)
+    fb.setupHorizontalMetrics({name: (1000, 50) for name in names})
+    fb.setupHorizontalHeader(ascent=880, descent=-120)
+    fb.setupNameTable({"familyName": family, "styleName": "Regular"})
+    fb.setupOS2()
+    fb.setupPost()
+    fb.font["head"].created = fb.font["head"].modified = 0
+    fb.font.recalcTimestamp = False
+    data = io.BytesIO()
+    fb.save(data)
+    return data.getvalue()
+
+
+def make_image(rnd, width, height, fmt):
+    # 低频色块叠加噪声，压缩比接近真实插图
+    small = Image.frombytes("RGB", (16, 16), rnd.randbytes(16 * 16 * 3))
+    image = small.resize((width, height), Image.BILINEAR)
+    noise = Image.frombytes("L", (width, height), rnd.randbytes(width * height))
+    image = Image.blend(image, Image.merge("RGB", (noise, noise, noise)), 0.15)
+    data = io.BytesIO()
+    image.save(data, format=fmt)
+    return data.getvalue()
+
+
+def make_paragraph(rnd, index):
+    parts = []
+    for _ in range(rnd.randint(4, 8)):
+        source = rnd.choice((SIMPLIFIED, SIMPLIFIED, TRADITIONAL))
+        start = rnd.randrange(len(source) - 8)
+        parts.append(source[start : start + rnd.randint(6, 12)])
+        if rnd.random() < 0.3:
+            parts.append(rnd.choice(RARE))
+        parts.append(rnd.choice(PUNCTUATION))
+    text = "".join(parts)
+    if index % 5 == 0:
+        # 阅微脚注
+        text += f'<span class="reader js_readerFooterNote" data-wr-footernote="注释{index}：{SIMPLIFIED[:10]}"></span>'
+    return text
+
+
+def make_chapter(rnd, index, chapter_kb, images, image_files, version):
+    head = (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        + ("<!DOCTYPE html>\n" if version == "3.0" else
+           '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n')
+        + '<html xmlns="http://www.w3.org/1999/xhtml"><head>'
+        + f"<title>第{index + 1}章</title>"
+        + '<link href="../Styles/style.css" rel="stylesheet" type="text/css"/></head><body>'
+        + f'<h1 class="title" id="c{index}">第{index + 1}章 {SIMPLIFIED[index % 20:index % 20 + 4]}</h1>'
+    )
+    body = []
+    for i in range(images):
+        if image_files:
+            name = image_files[(index * images + i) % len(image_files)]
+            body.append(f'<div class="img"><img src="../Images/{name}" alt="插图"/></div>')
+    if index:
+        body.append(f'<p><a href="chapter{index - 1:04d}.xhtml#c{index - 1}">上一章</a></p>')
+    size, paragraph = len(head.encode("utf-8")), 0
+    while size < chapter_kb * 1024:
+        css = "kai" if paragraph % 3 else "song"
+        line = f'<p class="{css}">{make_paragraph(rnd, paragraph)}</p>'
+        body.append(line)
+        size += len(line.encode("utf-8"))
+        paragraph += 1
+    return head + "\n".join(body) + "</body></html>"
+
+
+def writestr(zout, bkpath, data, compress_type=zipfile.ZIP_DEFLATED):
+    zinfo = zipfile.ZipInfo(bkpath, date_time=DATE_TIME)
+    zinfo.compress_type = compress_type
+    zout.writestr(zinfo, data)
+
+
+def build(path, chapters=10, chapter_kb=10, images=10, image_size=(800, 600),
+          fonts=2, version="3.0", images_per_chapter=1, seed=0):
+    """生成合成 EPUB；version 为 "2.0" 或 "3.0"，返回写入的文件路径"""
+    rnd = random.Random(seed)
+    items, spine = [], []
+
+    def add(zout, bkpath, data, item_id, media_type, properties=""):
+        writestr(zout, bkpath, data)
+        props = f' properties="{properties}"' if properties else ""
+        items.append(f'<item id="{item_id}" href="{bkpath[len("OEBPS/"):]}" media-type="{media_type}"{props}/>')
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zout:
+        writestr(zout, "mimetype", "application/epub+zip", zipfile.ZIP_STORED)
+        writestr(zout, "META-INF/container.xml", CONTAINER_XML)
+
+        image_files = []
+        for i in range(images):
+            ext, fmt, media_type = IMAGE_FORMATS[i % len(IMAGE_FORMATS)]
+            name = f"image{i:04d}.{ext}"
+            add(zout, f"OEBPS/Images/{name}", make_image(rnd, *image_size, fmt), f"img{i}", media_type,
+                "cover-image" if i == 0 and version == "3.0" else "")
+            image_files.append(name)
+
+        font_faces = []
+        families = ("kai", "song", "title")[: max(0, fonts)]
+        chars = sorted(set(SIMPLIFIED + TRADITIONAL + RARE + PUNCTUATION + "第章注释0123456789"))
+        for i, family in enumerate(families):
+            # 后面的字体只覆盖部分字符，模拟不同体积的字体
+            font_chars = chars[: len(chars) * (len(families) - i) // len(families)]
+            add(zout, f"OEBPS/Fonts/{family}.ttf", make_font(font_chars, family), f"font{i}", "font/ttf")
+            font_faces.append(f'@font-face{{font-family:"{family}";src:url(../Fonts/{family}.ttf)}}')
+        css = "\n".join(font_faces + [
+            ".kai{font-family:kai}", ".song{font-family:\"song\"}", "h1.title{font-family:title}",
+            "div.img{text-align:center}",
+        ])
+        if image_files:
+            css += f"\nbody{{background:url(../Images/{image_files[0]})}}"
+        add(zout, "OEBPS/Styles/style.css", css, "style", "text/css")
+
+        for i in range(chapters):
+            name = f"chapter{i:04d}.xhtml"
+            add(zout, f"OEBPS/Text/{name}",
+                make_chapter(rnd, i, chapter_kb, images_per_chapter, image_files, version),
+                f"chapter{i}", "application/xhtml+xml")
+            spine.append(f'<itemref idref="chapter{i}"/>')
+
+        nav_points = "".join(
+            f'<navPoint id="nav{i}" playOrder="{i + 1}"><navLabel><text>第{i + 1}章</text></navLabel>'
+            f'<content src="Text/chapter{i:04d}.xhtml"/></navPoint>'
+            for i in range(chapters)
+        )
+        add(zout, "OEBPS/toc.ncx",
+            '<?xml version="1.0" encoding="UTF-8"?>\n<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+            '<head><meta name="dtb:uid" content="benchmark"/></head><docTitle><text>性能测试书籍</text></docTitle>'
+            f"<navMap>{nav_points}</navMap></ncx>",
+            "ncx", "application/x-dtbncx+xml")
+        if version == "3.0":
+            links = "".join(f'<li><a href="Text/chapter{i:04d}.xhtml">第{i + 1}章</a></li>' for i in range(chapters))
+            add(zout, "OEBPS/nav.xhtml",
+                '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+                '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">'
+                f'<head><title>目录</title></head><body><nav epub:type="toc"><ol>{links}</ol></nav></body></html>',
+                "nav", "application/xhtml+xml", "nav")
+
+        cover = '<meta name="cover" content="img0"/>' if image_files else ""
+        modified = '<meta property="dcterms:modified">2024-01-01T00:00:00Z</meta>' if version == "3.0" else ""
+        writestr(
+            zout,
+            "OEBPS/content.opf",
+            f'<?xml version="1.0" encoding="utf-8"?>\n<package version="{version}" unique-identifier="uid" '
+            'xmlns="http://www.idpf.org/2007/opf"><metadata xmlns:dc="http://purl.org/dc/elements/1.1/" '
+            'xmlns:opf="http://www.idpf.org/2007/opf"><dc:title>性能测试书籍</dc:title>'
+            '<dc:creator>epub_tool</dc:creator><dc:identifier id="uid">benchmark</dc:identifier>'
+            f"<dc:language>zh</dc:language>{cover}{modified}</metadata>"
+            f'<manifest>{"".join(items)}</manifest><spine toc="ncx">{"".join(spine)}</spine></package>',
+        )
+    return path
+
+
+def parse_size(text):
+    width, _, height = text.lower().partition("x")
+    return int(width), int(height or width)
+
+
+def add_arguments(parser):
+    parser.add_argument("--chapters", type=int, default=10, help="章节数")
+    parser.add_argument("--chapter-kb", type=int, default=10, help="每章正文大小 (KB)")
+    parser.add_argument("--images", type=int, default=10, help="图片数量")
+    parser.add_argument("--image-size", type=parse_size, default=(800, 600), help="图片尺寸，如 800x600")
+    parser.add_argument("--images-per-chapter", type=int, default=1, help="每章引用的图片数")
+    parser.add_argument("--fonts", type=int, default=2, choices=range(4), help="内嵌字体数量 (0-3)")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+
+
+def book_options(args):
+    return {
+        "chapters": args.chapters,
+        "chapter_kb": args.chapter_kb,
+        "images": args.images,
+        "image_size": args.image_size,
+        "images_per_chapter": args.images_per_chapter,
+        "fonts": args.fonts,
+        "seed": args.seed,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="生成用于性能测试的合成 EPUB")
+    parser.add_argument("output", help="输出的 EPUB 路径")
+    parser.add_argument("--epub-version", default="3.0", choices=("2.0", "3.0"))
+    add_arguments(parser)
+    args = parser.parse_args()
+    print(build(args.output, version=args.epub_version, **book_options(args)))
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# cli.py 各命令的性能测试
+#
+# 按参数生成合成 EPUB (make_epub.py)，对每个命令各启动一次 cli.py 子进程，
+# 记录耗时、峰值内存 (子进程 RSS) 和输出文件大小，结果以 JSON 输出，可保存后与其他提交的结果对比。
+#
+#     python backend/benchmarks/run_benchmarks.py --chapters 200 --chapter-kb 20 --images 40 -o before.json
+#     python backend/benchmarks/run_benchmarks.py --chapters 200 --chapter-kb 20 --images 40 --compare before.json
+#
+# decrypt 使用 encrypt 的输出作为输入，webp_to_img 使用 img_to_webp 的输出；pipeline 按 COMMAND_EXTRA
+# 中的步骤运行。--extra 原样传给 cli.py (如 '{"workers": 4}')，与命令自带的参数合并。
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from make_epub import add_arguments, book_options, build
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI_PATH = os.path.join(BACKEND_DIR, "cli.py")
+
+# cli.main 分发的全部命令，decrypt、webp_to_img 需排在其输入命令之后
+COMMANDS = [
+    "encrypt",
+    "decrypt",
+    "reformat",
+    "font_encrypt",
+    "font_subset",
+    "img_compress",
+    "img_to_webp",
+    "webp_to_img",
+    "s2t",
+    "t2s",
+    "add_pinyin",
+    "yuewei_to_duokan",
+    "pipeline",
+]
+# 以其他命令的输出作为输入
+INPUT_FROM = {"decrypt": "encrypt", "webp_to_img": "img_to_webp"}
+# 命令自带的 --extra 参数
+COMMAND_EXTRA = {
+    "pipeline": {"operations": ["reformat", "s2t", "font_subset", "img_compress"]},
+}
+
+
+def command_extra(cmd, extra):
+    # 命令自带的参数与 --extra 合并，--extra 中的同名参数优先
+    if cmd not in COMMAND_EXTRA:
+        return extra
+    return json.dumps({**COMMAND_EXTRA[cmd], **json.loads(extra or "{}")})
+
+
+def run_cli(cmd, input_path, output_dir, extra):
+    # 返回 (结果 JSON, 耗时, 峰值 RSS 字节数)；没有 os.wait4 的平台不统计内存
+    args = [sys.executable, CLI_PATH, cmd, "--input", input_path, "--output", output_dir]
+    if extra:
+        args += ["--extra", extra]
+    start = time.perf_counter()
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    stdout = proc.stdout.read()
+    peak_rss = None
+    if hasattr(os, "wait4"):
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        # Linux 单位为 KB，macOS 为字节
+        peak_rss = rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+    else:
+        proc.wait()
+    wall_time = time.perf_counter() - start
+    proc.stdout.close()
+
+    lines = stdout.decode("utf-8", "replace").strip().splitlines()
+    try:
+        result = json.loads(lines[-1])
+    except (IndexError, ValueError):
+        result = {"status": "error", "message": f"exit code {proc.returncode}"}
+    return result, wall_time, peak_rss
+
+
+def output_files(output_dir):
+    return [os.path.join(output_dir, name) for name in sorted(os.listdir(output_dir))
+            if name.lower().endswith(".epub")]
+
+
+def run_variant(version, options, commands, extra, repeat, workdir):
+    variant_dir = os.path.join(workdir, f"epub{version[0]}")
+    os.makedirs(variant_dir)
+    book = build(os.path.join(variant_dir, "book.epub"), version=version, **options)
+    outputs = {}  # { 命令 : 输出文件 }，供后续命令使用
+    results = []
+    for cmd in commands:
+        input_path = outputs.get(INPUT_FROM.get(cmd), book)
+        runs = []
+        for i in range(repeat):
+            output_dir = os.path.join(variant_dir, f"{cmd}_{i}")
+            os.makedirs(output_dir)
+            result, wall_time, peak_rss = run_cli(cmd, input_path, output_dir, command_extra(cmd, extra))
+            files = output_files(output_dir)
+            runs.append({
+                "status": result.get("status"),
+                "message": result.get("message"),
+                "wall_time": round(wall_time, 4),
+                "peak_rss": peak_rss,
+                "output_size": sum(os.path.getsize(f) for f in files),
+            })
+            if files:
+                outputs[cmd] = files[0]
+        best = min(runs, key=lambda run: run["wall_time"])
+        entry = {
+            "epub_version": version,
+            "command": cmd,
+            "input_size": os.path.getsize(input_path),
+            **{key: value for key, value in best.items() if value is not None},
+        }
+        if repeat > 1:
+            entry["wall_times"] = [run["wall_time"] for run in runs]
+        results.append(entry)
+        print(f"EPUB{version} {cmd:<18} {entry['status']:<8} {entry['wall_time']:8.3f}s "
+              f"rss={format_size(entry.get('peak_rss'))} out={format_size(entry['output_size'])}",
+              file=sys.stderr)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_size(size):
+    if size is None:
+        return "-"
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+
+def compare(report, baseline):
+    # 按 (EPUB 版本, 命令) 对比耗时与峰值内存
+    old = {(r["epub_version"], r["command"]): r for r in baseline["results"]}
+    print(f"对比基准: {baseline['meta'].get('revision')} -> {report['meta'].get('revision')}", file=sys.stderr)
+    for r in report["results"]:
+        base = old.get((r["epub_version"], r["command"]))
+        if not base:
+            continue
+        ratio = r["wall_time"] / base["wall_time"] if base["wall_time"] else float("inf")
+        rss = ""
+        if r.get("peak_rss") and base.get("peak_rss"):
+            rss = f"  rss {format_size(base['peak_rss'])} -> {format_size(r['peak_rss'])}"
+        print(f"EPUB{r['epub_version']} {r['command']:<18} {base['wall_time']:8.3f}s -> "
+              f"{r['wall_time']:8.3f}s ({ratio:.2f}x){rss}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cli.py 各命令的性能测试")
+    add_arguments(parser)
+    parser.add_argument("--epub-version", default="both", choices=("2.0", "3.0", "both"))
+    parser.add_argument("--commands", default=",".join(COMMANDS), help="逗号分隔的命令列表")
+    parser.add_argument("--extra", default="", help="传给 cli.py 的 --extra JSON")
+    parser.add_argument("--repeat", type=int, default=1, help="每个命令重复次数，取最短耗时")
+    parser.add_argument("-o", "--output", help="结果 JSON 的保存路径，默认输出到标准输出")
+    parser.add_argument("--compare", help="与之前保存的结果 JSON 对比")
+    parser.add_argument("--keep", action="store_true", help="保留生成的书籍和输出文件")
+    args = parser.parse_args()
+
+    commands = [cmd.strip() for cmd in args.commands.split(",") if cmd.strip()]
+    unknown = [cmd for cmd in commands if cmd not in COMMANDS]
+    if unknown:
+        parser.error(f"未知命令: {', '.join(unknown)}")
+    # decrypt、webp_to_img 需要其输入命令的输出
+    for cmd, source in INPUT_FROM.items():
+        if cmd in commands and source not in commands:
+            commands.insert(commands.index(cmd), source)
+    versions = ("2.0", "3.0") if args.epub_version == "both" else (args.epub_version,)
+    options = book_options(args)
+
+    workdir = tempfile.mkdtemp(prefix="epub_tool_bench_")
+    try:
+        results = []
+        for version in versions:
+            results += run_variant(version, options, commands, args.extra, max(1, args.repeat), workdir)
+    finally:
+        if args.keep:
+            print(f"输出目录: {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "book": {**options, "image_size": "%dx%d" % options["image_size"]},
+            "extra": args.extra,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,14 @@
 import sys
 import os
 import json
+import time
 import traceback
 import logging
+import threading
+import socketserver
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # Setup a debug log file in the same directory as this script
 debug_log_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cli_debug.log")
@@ -43,6 +49,12 @@ try:
     from utils.chinese_convert import run_s2t, run_t2s
     from utils.pinyin_annotate import run_add_pinyin
     from utils.yuewei_to_duokan import run as run_yuewei_to_duokan
+    from utils.pipeline import run_pipeline
+    from utils.result_cache import ResultCache, parse_size
+    from utils import progress
+    from utils.profiling import TOP_N, profile_call
+    from utils.job_stats import collect_stats
+    from utils.log import configure_logs, flush_logs, take_log_ring
     log_debug("Imports successful")
 except ImportError as e:
     err_msg = f"ImportError: {str(e)}\n{traceback.format_exc()}"
@@ -55,19 +67,23 @@ except Exception as e:
     print_json({"status": "error", "message": f"Startup Error: {str(e)}"})
     sys.exit(1)
 
-def main():
-    # Manual argument parsing
-    argv = sys.argv[1:]
-    
-    if not argv:
-        print_json({"status": "error", "message": "No command provided"})
-        return
+# --name value options collected into the options dict
+VALUE_OPTIONS = (
+    "--workers", "--listen", "--cache-dir", "--cache-size",
+    "--progress-fd", "--profile", "--profile-top",
+    "--log-file", "--log-ring", "--log-level",
+)
+# --name flags without a value
+FLAG_OPTIONS = ("--progress", "--stats", "--stats-memory")
+
 
+def parse_args(argv):
     cmd = argv[0]
     input_path = None
     output_dir = None
     extra_str = "{}"
-    
+    options = {}
+
     # Simple parser
     i = 1
     positional = []
@@ -85,81 +101,417 @@ def main():
             if i + 1 < len(argv):
                 extra_str = argv[i+1]
                 i += 1
+        elif arg in VALUE_OPTIONS:
+            if i + 1 < len(argv):
+                options[arg[2:]] = argv[i+1]
+                i += 1
+        elif arg in FLAG_OPTIONS:
+            options[arg[2:]] = True
         elif arg.startswith("--"):
             pass
         else:
             positional.append(arg)
         i += 1
-        
+
     if not input_path and len(positional) > 0:
         input_path = positional[0]
     if not output_dir and len(positional) > 1:
         output_dir = positional[1]
 
-    log_debug(f"Parsed: cmd={cmd}, input={input_path}, output={output_dir}")
+    return cmd, input_path, output_dir, extra_str, options
 
-    if not input_path:
-         print_json({"status": "error", "message": "No input file provided"})
-         return
 
+def parse_extra(extra_str):
+    if isinstance(extra_str, dict):
+        return extra_str
     try:
-        extra = json.loads(extra_str)
+        extra = json.loads(extra_str) if extra_str else {}
     except Exception as e:
         log_debug(f"JSON Parsing Error for extra_str: {e}\nContent: {extra_str}")
         extra = {}
+    return extra if isinstance(extra, dict) else {}
+
+
+COMMANDS = {
+    "encrypt": encrypt_run,
+    "decrypt": decrypt_run,
+    "reformat": reformat_run,
+    "font_encrypt": run_epub_font_encrypt,
+    "font_subset": run_epub_font_subset,
+    "img_to_webp": run_img_to_webp,
+    "img_compress": run_img_compress,
+    "webp_to_img": run_webp_to_img,
+    "s2t": run_s2t,
+    "t2s": run_t2s,
+    "add_pinyin": run_add_pinyin,
+    "yuewei_to_duokan": run_yuewei_to_duokan,
+    "pipeline": run_pipeline,
+}
+
+
+# --extra keys forwarded to the run functions as keyword arguments, e.g.
+#   s2t      --extra '{"workers": 4}'
+#   s2t      --extra '{"incremental": true}'   (reconvert only changed chapters, see utils/incremental.py)
+#   s2t      --extra '{"html_engine": "lxml"}'   (html.parser / lxml / selectolax, see utils/html_engine.py)
+#   font_subset --extra '{"workers": 4}'   (subset / encrypt fonts in parallel, also font_encrypt)
+#   reformat --extra '{"workers": 4}'   (rewrite XHTML/CSS links in parallel, also encrypt / decrypt)
+#   font_subset --extra '{"font_cache": "~/.epub_tool_cache/fonts"}'   (reuse subsets across books, see utils/font_cache.py)
+#   img_compress --extra '{"max_workers": 4}'
+#   img_compress --extra '{"memory_limit": 512}'   (MB, bounded-memory streaming, see utils/streaming.py)
+#   pipeline --extra '{"operations": ["reformat", "s2t", "font_subset", "img_compress"]}'
+COMMAND_OPTIONS = {
+    "encrypt": ("workers",),
+    "decrypt": ("workers",),
+    "reformat": ("workers",),
+    "s2t": ("workers", "incremental", "html_engine"),
+    "t2s": ("workers", "incremental", "html_engine"),
+    "add_pinyin": ("workers", "incremental", "html_engine"),
+    "font_encrypt": ("html_engine", "workers"),
+    "font_subset": ("html_engine", "workers", "font_cache", "font_cache_superset", "font_cache_size"),
+    "img_compress": ("max_workers", "memory_limit"),
+    "img_to_webp": ("max_workers", "memory_limit"),
+    "webp_to_img": ("max_workers", "memory_limit"),
+    "pipeline": ("operations",),
+}
+
+
+def run_command(cmd, input_path, output_dir, extra):
+    kwargs = {key: extra[key] for key in COMMAND_OPTIONS.get(cmd, ()) if key in extra}
+    return COMMANDS[cmd](input_path, output_dir, **kwargs)
+
+
+def build_result(result, input_path):
+    # Handle special return value (tuple) for any command
+    if isinstance(result, tuple):
+        status_code, message = result
+        if status_code == 0:
+            # Success - message contains output path
+            return {"status": "success", "file": input_path, "output_path": message}
+        # Error - message contains error message
+        return {"status": "error", "message": message, "file": input_path}
+    elif result == 0:
+        return {"status": "success", "file": input_path}
+    elif result == "skip":
+        return {"status": "skip", "file": input_path}
+    return {"status": "error", "message": str(result), "file": input_path}
+
 
-    result = 0
+def execute(cmd, input_path, output_dir, extra, cache=None):
+    if not input_path:
+        return {"status": "error", "message": "No input file provided"}
+    if cmd not in COMMANDS:
+        return {"status": "error", "message": f"Unknown command: {cmd}"}
+
+    def runner(output_dir):
+        try:
+            result = run_command(cmd, input_path, output_dir, extra)
+        except Exception as e:
+            err_msg = f"Runtime Error: {str(e)}\n{traceback.format_exc()}"
+            log_debug(err_msg)
+            return {"status": "error", "message": str(e), "file": input_path}
+        return build_result(result, input_path)
+
+    if cache is None or not os.path.isfile(input_path) or uses_incremental(cmd, extra):
+        return runner(output_dir)
+    return cache.run(cmd, input_path, output_dir, extra, runner)
+
+
+def uses_incremental(cmd, extra):
+    # The incremental manifest and previous output live next to the real output file,
+    # which the cache's staging dir would hide, so incremental jobs bypass the cache
+    return bool(extra.get("incremental")) and "incremental" in COMMAND_OPTIONS.get(cmd, ())
+
+
+# Opt-in result cache: --cache-dir <dir> [--cache-size <MB>]
+# Not used for jobs with {"incremental": ...}, see uses_incremental().
+def open_cache(options):
+    if not options.get("cache-dir"):
+        return None
     try:
-        if cmd == "encrypt":
-            result = encrypt_run(input_path, output_dir)
-        elif cmd == "decrypt":
-            result = decrypt_run(input_path, output_dir)
-        elif cmd == "reformat":
-            result = reformat_run(input_path, output_dir)
-        elif cmd == "font_encrypt":
-            result = run_epub_font_encrypt(input_path, output_dir)
-        elif cmd == "font_subset":
-            result = run_epub_font_subset(input_path, output_dir)
-        elif cmd == "img_to_webp":
-            result = run_webp_to_img(input_path, output_dir)
-        elif cmd == "img_compress":
-            result = run_img_compress(input_path, output_dir)
-        elif cmd == "webp_to_img":
-            result = run_webp_to_img(input_path, output_dir)
-        elif cmd == "s2t":
-            result = run_s2t(input_path, output_dir)
-        elif cmd == "t2s":
-            result = run_t2s(input_path, output_dir)
-        elif cmd == "add_pinyin":
-            result = run_add_pinyin(input_path, output_dir)
-        elif cmd == "yuewei_to_duokan":
-            result = run_yuewei_to_duokan(input_path, output_dir)
-        else:
-            print_json({"status": "error", "message": f"Unknown command: {cmd}"})
+        return ResultCache(options["cache-dir"], parse_size(options.get("cache-size")))
+    except (OSError, ValueError) as e:
+        log_debug(f"Cache disabled: {e}")
+        return None
+
+
+# Opt-in per-job profiling: --profile <dir> [--profile-top <N>]
+# Writes a cProfile .pstats file and a sampled collapsed-stack file per job and adds
+# {"profile": {"stats": ..., "collapsed": ..., "top": [...]}} to the result, see utils/profiling.py.
+def execute_profiled(cmd, input_path, output_dir, extra, cache=None, options=None):
+    options = options or {}
+    if not options.get("profile"):
+        return execute(cmd, input_path, output_dir, extra, cache)
+    try:
+        top = int(options.get("profile-top") or TOP_N)
+    except ValueError:
+        top = TOP_N
+    try:
+        result, summary = profile_call(
+            options["profile"], cmd, input_path, execute, cmd, input_path, output_dir, extra, cache, top=top
+        )
+    except OSError as e:
+        log_debug(f"Profiling disabled: {e}")
+        return execute(cmd, input_path, output_dir, extra, cache)
+    return {**result, "profile": summary}
+
+
+# Opt-in resource stats: --stats [--stats-memory]
+# Adds {"stats": {CPU seconds, peak RSS delta (not in serve mode), input/output archive sizes and member
+# counts, per-stage summaries}} to the result; --stats-memory adds a tracemalloc peak
+# per stage at a noticeable slowdown. See utils/job_stats.py.
+def execute_job(cmd, input_path, output_dir, extra, cache=None, options=None):
+    options = options or {}
+    if not (options.get("stats") or options.get("stats-memory")):
+        return execute_profiled(cmd, input_path, output_dir, extra, cache, options)
+    result, stats = collect_stats(
+        lambda: execute_profiled(cmd, input_path, output_dir, extra, cache, options),
+        input_path, memory=bool(options.get("stats-memory")),
+    )
+    return {**result, "stats": stats}
+
+
+# Tool log (utils/log.py), buffered and flushed on exit:
+#   default              appended to log.txt next to the executable, one header per process
+#   --log-file <path>    a separate log file for this job, truncated at start (shared by all jobs in serve mode)
+#   --log-ring <N>       keep only the last N lines in memory and return them as "log" in the result
+#   --log-level <level>  debug / info / warning / error (default info)
+def open_logs(options):
+    try:
+        configure_logs(options.get("log-file"), options.get("log-ring"), options.get("log-level"))
+    except (OSError, ValueError) as e:
+        log_debug(f"Log options ignored: {e}")
+
+
+def attach_log(result, options):
+    # With --log-ring the job's log lines travel with the result instead of a file
+    if not options.get("log-ring"):
+        return result
+    return {**result, "log": take_log_ring()}
+
+
+# Opt-in NDJSON event stream (stage start/end, documents done, bytes, elapsed ms):
+#   --progress           events on stdout, the result object stays the last line
+#   --progress-fd <fd>   events on an inherited file descriptor, stdout is unchanged
+# See utils/progress.py. Not available in serve mode.
+def open_progress(options):
+    try:
+        return progress.open_reporter(options, sys.stdout)
+    except (OSError, ValueError) as e:
+        log_debug(f"Progress events disabled: {e}")
+        return None
+
+
+# ---------------------------------------------------------------------------
+# serve mode: one long-lived process that keeps bs4/fontTools/PIL/opencc and
+# the dictionaries imported, and fans newline-delimited JSON jobs out to a
+# pool of equally warm worker processes.
+#
+#   request:  {"id": 1, "command": "s2t", "input": "a.epub", "output": "dir", "extra": {}}
+#   response: {"id": 1, "status": "success", "file": "a.epub", ...}
+# ---------------------------------------------------------------------------
+
+CACHE = None
+OPTIONS = {}
+# Jobs queued or running per connection (or stdin), per worker
+PENDING_PER_WORKER = 4
+
+
+def init_worker(options=None):
+    global CACHE, OPTIONS
+    # Keep stray prints of the tools out of the result stream
+    sys.stdout = sys.stderr
+    OPTIONS = options or {}
+    open_logs(OPTIONS)
+    CACHE = open_cache(OPTIONS)
+    from utils import pinyin_annotate
+
+    if pinyin_annotate.MAPS is None:
+        pinyin_annotate.initMaps()
+
+
+def run_job(job):
+    cmd = job.get("command")
+    input_path = job.get("input")
+    log_debug(f"Job: cmd={cmd}, input={input_path}, output={job.get('output')}")
+    result = execute_job(cmd, input_path, job.get("output"), parse_extra(job.get("extra")), CACHE, OPTIONS)
+    flush_logs()
+    return attach_log(result, OPTIONS)
+
+
+class WorkerPool:
+    """Warm ProcessPoolExecutor that is replaced when a worker process dies
+    (OOM kill, crash in a C extension), so one bad book doesn't stop the server.
+    Jobs queued or running in the broken pool are answered with an error."""
+
+    def __init__(self, workers, options):
+        self.workers = workers
+        self.options = options
+        self.lock = threading.Lock()
+        self.pool = self.create()
+
+    def create(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker, initargs=(self.options,))
+
+    def submit(self, func, *args):
+        # Returns (pool, future); pass the pool to replace() if the future fails with BrokenProcessPool
+        with self.lock:
+            pool = self.pool
+        try:
+            return pool, pool.submit(func, *args)
+        except BrokenProcessPool:
+            pool = self.replace(pool)
+            return pool, pool.submit(func, *args)
+
+    def replace(self, broken):
+        with self.lock:
+            if self.pool is broken:
+                log_debug("Worker process died, starting a new pool")
+                broken.shutdown(wait=False, cancel_futures=True)
+                self.pool = self.create()
+            return self.pool
+
+    def shutdown(self):
+        with self.lock:
+            self.pool.shutdown()
+
+
+def serve_stream(pool, reader, writer, max_in_flight):
+    # Results are written as jobs finish; at most max_in_flight jobs are queued or
+    # running per stream, reading further jobs waits until one completes.
+    # Nothing is kept per finished job, so a long-lived stream does not grow.
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(max_in_flight)
+
+    def emit(data):
+        with lock:
+            writer.write(json.dumps(data) + "\n")
+            writer.flush()
+
+    def finish(job, future, used=None):
+        # Writes the job's result and releases its slot. used is the pool the job ran in
+        try:
+            try:
+                result = future.result()
+            except BrokenProcessPool as e:
+                log_debug(f"Worker died: cmd={job.get('command')}, input={job.get('input')}")
+                if used is not None:
+                    pool.replace(used)
+                result = {"status": "error", "message": f"Worker process died: {e}", "file": job.get("input")}
+            except Exception as e:
+                log_debug(f"Worker Error: {traceback.format_exc()}")
+                result = {"status": "error", "message": str(e), "file": job.get("input")}
+            if "id" in job:
+                result = {"id": job["id"], **result}
+            emit(result)
+        except Exception:
+            log_debug(f"Result Error: {traceback.format_exc()}")
+        slots.release()
+
+    def submit(job):
+        try:
+            used, future = pool.submit(run_job, job)
+        except Exception as e:
+            log_debug(f"Submit Error: {traceback.format_exc()}")
+            future = Future()
+            future.set_exception(e)
+            finish(job, future)
             return
+        future.add_done_callback(lambda done: finish(job, done, used))
 
-        # Handle special return value (tuple) for any command
-        if isinstance(result, tuple):
-            status_code, message = result
-            if status_code == 0:
-                # Success - message contains output path
-                print_json({"status": "success", "file": input_path, "output_path": message})
-            else:
-                # Error - message contains error message
-                print_json({"status": "error", "message": message, "file": input_path})
-        elif result == 0:
-             print_json({"status": "success", "file": input_path})
-        elif result == "skip":
-             print_json({"status": "skip", "file": input_path})
-        else:
-             print_json({"status": "error", "message": str(result), "file": input_path})
+    for line in reader:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise ValueError("job must be a JSON object")
+        except Exception as e:
+            emit({"status": "error", "message": f"Invalid job: {e}"})
+            continue
+        slots.acquire()
+        submit(job)
 
-    except Exception as e:
-        err_msg = f"Runtime Error: {str(e)}\n{traceback.format_exc()}"
-        log_debug(err_msg)
-        print_json({"status": "error", "message": str(e), "file": input_path})
+    # Wait until every result has been written (callbacks release their slot last)
+    for _ in range(max_in_flight):
+        slots.acquire()
+
+
+class SocketWriter:
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text):
+        self.wfile.write(text.encode("utf-8"))
+
+    def flush(self):
+        self.wfile.flush()
+
+
+class JobServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def serve(workers=None, listen=None, options=None):
+    if not workers:
+        workers = min(os.cpu_count() or 1, 4)
+    log_debug(f"Serving with {workers} workers, listen={listen}")
+    pool = WorkerPool(workers, options or {})
+    try:
+        if not listen:
+            serve_stream(pool, sys.stdin, sys.stdout, workers * PENDING_PER_WORKER)
+            return
+
+        host, _, port = listen.rpartition(":")
+
+        class JobHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                reader = (line.decode("utf-8") for line in self.rfile)
+                serve_stream(pool, reader, SocketWriter(self.wfile), workers * PENDING_PER_WORKER)
+
+        with JobServer((host or "127.0.0.1", int(port)), JobHandler) as server:
+            print_json({"status": "listening", "address": list(server.server_address)})
+            sys.stdout.flush()
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+    finally:
+        pool.shutdown()
+
+
+def main():
+    # Manual argument parsing
+    argv = sys.argv[1:]
+    
+    if not argv:
+        print_json({"status": "error", "message": "No command provided"})
+        return
+
+    cmd, input_path, output_dir, extra_str, options = parse_args(argv)
+    open_logs(options)
+
+    if cmd == "serve":
+        try:
+            workers = int(options.get("workers") or 0)
+        except ValueError:
+            workers = 0
+        serve(workers, options.get("listen"), options)
+        return
+
+    log_debug(f"Parsed: cmd={cmd}, input={input_path}, output={output_dir}")
+
+    extra = parse_extra(extra_str)
+    open_progress(options)
+    progress.emit("job_start", command=cmd, file=input_path)
+    started = time.perf_counter()
+    result = execute_job(cmd, input_path, output_dir, extra, open_cache(options), options)
+    progress.emit("job_end", status=result.get("status"), elapsed_ms=int((time.perf_counter() - started) * 1000))
+    print_json(attach_log(result, options))
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     try:
         main()
     except Exception as e:
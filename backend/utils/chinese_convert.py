@@ -7,20 +7,142 @@ import io
 
 try:
     from utils.log import logwriter
+    from utils.epub_container import EpubContainer
+    from utils.parallel import OrderedExecutor
+    from utils.incremental import member_digest, open_manifest
+    from utils.html_engine import get_engine
+    from utils.opencc_index import load_matcher
+    from utils import progress
 except ImportError:
     from log import logwriter
+    from epub_container import EpubContainer
+    from parallel import OrderedExecutor
+    from incremental import member_digest, open_manifest
+    from html_engine import get_engine
+    from opencc_index import load_matcher
+    import progress
 
 logger = logwriter()
 
+_opencc = {}  # { mode : OpenCC }，每个进程各自保留一份
+
+
+def get_opencc(mode):
+    if mode not in _opencc:
+        # 优先使用由 OpenCC 词典编译的匹配器 (见 opencc_index.py)，结果与 OpenCC(mode) 相同
+        _opencc[mode] = load_matcher(mode) or OpenCC(mode)
+    return _opencc[mode]
+
+
+# 批量转换: 文档内的各段文本以分隔符连接后一次转换再拆开，调用次数不再随文本节点数增长。
+# OpenCC 按空白及标点切分后逐段转换，分隔符 (U+001E，属于空白) 两侧的文字不会组成词，
+# 因此结果与逐段转换相同。文本中本身含有分隔符时退回逐段转换。
+SENTINEL = "\x1e"
+BATCH_CHARS = 64 * 1024  # 每次转换的文本量上限
+
+
+def convert_batch(convert, texts):
+    """转换多段文本，返回与 texts 一一对应的结果"""
+    results = []
+    batch = []
+    size = 0
+    for text in texts:
+        if batch and size + len(text) > BATCH_CHARS:
+            results += _convert_joined(convert, batch)
+            batch = []
+            size = 0
+        batch.append(text)
+        size += len(text) + 1
+    if batch:
+        results += _convert_joined(convert, batch)
+    return results
+
+
+def _convert_joined(convert, texts):
+    if not any(SENTINEL in text for text in texts):
+        converted = convert(SENTINEL.join(texts)).split(SENTINEL)
+        if len(converted) == len(texts):
+            return converted
+    return [convert(text) for text in texts]
+
+
+def convert_html_soup(soup, convert, engine=None):
+    """就地转换 HTML 文档中的文本节点及 title/alt 属性"""
+    engine = engine or get_engine(editable=True)
+    # Text nodes (skip Comment, Doctype, ProcessingInstruction, etc. and style/script)
+    strings = list(engine.text_nodes(soup, ('style', 'script')))
+    # title/alt attributes
+    attrs = [(tag, name) for tag in soup.find_all(True) for name in ('title', 'alt') if tag.has_attr(name)]
+
+    converted = convert_batch(convert, [str(string) for string in strings] + [tag[name] for tag, name in attrs])
+    _replace_strings(strings, converted)
+    for (tag, name), value in zip(attrs, converted[len(strings):]):
+        tag[name] = value
+
+
+def convert_xml_soup(soup, convert):
+    """就地转换 NCX/OPF 文档中的文本节点"""
+    # Skip special tags
+    strings = [
+        string for string in soup.find_all(string=True)
+        if not isinstance(string, (Comment, Doctype, ProcessingInstruction, Declaration))
+    ]
+    _replace_strings(strings, convert_batch(convert, [str(string) for string in strings]))
+
+
+def _replace_strings(strings, converted):
+    # 未变化的普通文本节点无需替换 (replace_with 要在父节点中线性查找位置)；
+    # CData 等子类替换后会变为普通文本，与原实现一致仍然替换
+    for string, new_string in zip(strings, converted):
+        if type(string) is NavigableString and new_string == string:
+            continue
+        string.replace_with(new_string)
+
+
+def convert_document(filename, content, mode, html_engine=None):
+    """转换单个 HTML/XHTML/NCX/OPF 文档，返回 (新内容, 错误信息)；可在工作进程中执行"""
+    cc = get_opencc(mode)
+
+    def convert_text(text):
+        if not text:
+            return text
+        return cc.convert(text)
+
+    try:
+        # Try to detect encoding, usually utf-8 for epub
+        text_content = content.decode('utf-8')
+
+        # Use BeautifulSoup for HTML files to avoid breaking tags
+        if filename.lower().endswith(('.html', '.xhtml', '.htm')):
+            engine = get_engine(html_engine, editable=True)
+            soup = engine.parse(text_content)
+            convert_html_soup(soup, convert_text, engine)
+            return engine.serialize(soup).encode('utf-8'), None
+
+        # For NCX/OPF
+        soup = BeautifulSoup(text_content, 'xml')
+        convert_xml_soup(soup, convert_text)
+
+        # Use formatter='html' to prevent escaping issues if needed, but utf-8 encode handles it
+        return str(soup).encode('utf-8'), None
+    except Exception as e:
+        return None, str(e)
+
+
 class ChineseConvert:
-    def __init__(self, epub_path, output_path, mode='s2t'):
+    def __init__(self, epub_path, output_path, mode='s2t', workers=1, incremental=None, html_engine=None):
         if not os.path.exists(epub_path):
             raise Exception("EPUB文件不存在")
 
         self.epub_path = os.path.normpath(epub_path)
-        self.epub = zipfile.ZipFile(epub_path)
+        self.container = EpubContainer(epub_path)
+        self.epub = self.container.epub
         self.mode = mode  # 's2t' (Simplified to Traditional) or 't2s' (Traditional to Simplified)
-        self.cc = OpenCC(mode)
+        self.cc = get_opencc(mode)
+        self.workers = workers  # 并行转换章节的进程数
+        self.html_engine = get_engine(html_engine, editable=True).name  # HTML 解析引擎，见 html_engine.py
+        self.manifest = None
+        self.digests = {}  # { 文件名 : 输入内容摘要 }，仅增量处理时记录
         
         if output_path and os.path.exists(output_path):
             if os.path.isfile(output_path):
@@ -34,10 +156,17 @@ class ChineseConvert:
             self.output_path,
             os.path.basename(self.epub_path).replace(".epub", f"{suffix}.epub"),
         )
-        
+
+        # 增量处理: 须在删除上次输出之前读取清单
+        # 不同解析引擎的输出可能不同，各自记录
+        self.manifest = open_manifest(incremental, self.file_write_path, f"{mode}:{self.html_engine}")
+        if self.manifest:
+            self.manifest.begin()
+
         if os.path.exists(self.file_write_path):
             os.remove(self.file_write_path)
             
+        progress.output_file(self.file_write_path)
         self.target_epub = zipfile.ZipFile(
             self.file_write_path,
             "w",
@@ -50,68 +179,52 @@ class ChineseConvert:
         return self.cc.convert(text)
 
     def process_file(self):
-        for item in self.epub.infolist():
-            content = self.epub.read(item.filename)
-            
-            # Process HTML/XHTML/NCX/OPF files
-            if item.filename.lower().endswith(('.html', '.xhtml', '.htm', '.ncx', '.opf')):
-                try:
-                    # Try to detect encoding, usually utf-8 for epub
-                    text_content = content.decode('utf-8')
-                    
-                    # Use BeautifulSoup for HTML files to avoid breaking tags
-                    if item.filename.lower().endswith(('.html', '.xhtml', '.htm')):
-                        soup = BeautifulSoup(text_content, 'html.parser')
-                        
-                        # Convert text nodes
-                        for string in soup.find_all(string=True):
-                            # Skip special tags (Comment, Doctype, ProcessingInstruction, etc.)
-                            if isinstance(string, (Comment, Doctype, ProcessingInstruction, Declaration)):
-                                continue
-                                
-                            # Skip special tags if necessary, but usually text nodes are safe
-                            if string.parent.name not in ['style', 'script']:
-                                new_string = self.convert_text(string)
-                                string.replace_with(new_string)
-                                
-                        # Convert title attribute in tags if any
-                        for tag in soup.find_all(True):
-                            if tag.has_attr('title'):
-                                tag['title'] = self.convert_text(tag['title'])
-                            if tag.has_attr('alt'):
-                                tag['alt'] = self.convert_text(tag['alt'])
-                                
-                        # Return processed HTML
-                        # Use formatter='html' to prevent escaping issues if needed, but utf-8 encode handles it
-                        new_content = str(soup).encode('utf-8')
-                        
-                    else:
-                        # For NCX/OPF
-                        soup = BeautifulSoup(text_content, 'xml')
-                        
-                        # Convert text in tags
-                        for string in soup.find_all(string=True):
-                            # Skip special tags
-                            if isinstance(string, (Comment, Doctype, ProcessingInstruction, Declaration)):
-                                continue
-                                
-                            new_string = self.convert_text(string)
-                            string.replace_with(new_string)
-                            
-                        new_content = str(soup).encode('utf-8')
-
-                    self.target_epub.writestr(item.filename, new_content)
-                    
-                except Exception as e:
-                    logger.write(f"文件 {item.filename} 转换失败，使用原内容: {e}")
-                    self.target_epub.writestr(item, content)
-            else:
-                # Copy other files (images, css, fonts) as is
-                self.target_epub.writestr(item, content)
+        items = self.epub.infolist()
+        self.stage = progress.stage("convert", len(items), self.target_epub)
+        with self.stage, OrderedExecutor(self.workers) as executor:
+            for item in items:
+                # Process HTML/XHTML/NCX/OPF files
+                if item.filename.lower().endswith(('.html', '.xhtml', '.htm', '.ncx', '.opf')):
+                    content = self.epub.read(item.filename)
+                    if self.manifest:
+                        digest = member_digest(content)
+                        if self.manifest.unchanged(item.filename, digest):
+                            executor.put(item, False)
+                            self.write_results(executor.results())
+                            continue
+                        self.digests[item.filename] = digest
+                    executor.submit(item, convert_document, item.filename, content, self.mode, self.html_engine)
+                else:
+                    # Copy other files (images, css, fonts) as is
+                    executor.put(item, None)
+                self.write_results(executor.results())
+            self.write_results(executor.results(wait=True))
 
         self.close_file()
+        if self.manifest:
+            self.manifest.commit()
         logger.write(f"EPUB简繁转换完成 ({self.mode})，输出路径: {self.file_write_path}")
 
+    def write_results(self, results):
+        # 按压缩包原有顺序写入
+        for item, result in results:
+            self.stage.advance(read=item.compress_size)
+            if result is False:
+                # 内容未变化，沿用上次的输出 (增量处理)
+                self.manifest.reuse(self.target_epub, item.filename)
+                continue
+            if result is None:
+                self.container.copy_to(self.target_epub, item)
+                continue
+            new_content, error = result
+            if error is None:
+                self.target_epub.writestr(item.filename, new_content)
+                if self.manifest:
+                    self.manifest.record(item.filename, self.digests.pop(item.filename), new_content)
+            else:
+                logger.write(f"文件 {item.filename} 转换失败，使用原内容: {error}")
+                self.container.copy_to(self.target_epub, item)
+
     def close_file(self):
         if self.epub:
             self.epub.close()
@@ -122,19 +235,21 @@ class ChineseConvert:
         if self.file_write_path and os.path.exists(self.file_write_path):
             os.remove(self.file_write_path)
             logger.write(f"删除临时文件: {self.file_write_path}")
+        if self.manifest:
+            self.manifest.abort()
 
-def run_s2t(epub_path, output_path=None):
+def run_s2t(epub_path, output_path=None, workers=1, incremental=None, html_engine=None):
     logger.write(f"\n正在尝试将EPUB转换为繁体: {epub_path}")
-    return _run_convert(epub_path, output_path, 's2t')
+    return _run_convert(epub_path, output_path, 's2t', workers, incremental, html_engine)
 
-def run_t2s(epub_path, output_path=None):
+def run_t2s(epub_path, output_path=None, workers=1, incremental=None, html_engine=None):
     logger.write(f"\n正在尝试将EPUB转换为简体: {epub_path}")
-    return _run_convert(epub_path, output_path, 't2s')
+    return _run_convert(epub_path, output_path, 't2s', workers, incremental, html_engine)
 
-def _run_convert(epub_path, output_path, mode):
+def _run_convert(epub_path, output_path, mode, workers=1, incremental=None, html_engine=None):
     cc_tool = None
     try:
-        cc_tool = ChineseConvert(epub_path, output_path, mode)
+        cc_tool = ChineseConvert(epub_path, output_path, mode, workers, incremental, html_engine)
         cc_tool.process_file()
         return 0
     except Exception as e:
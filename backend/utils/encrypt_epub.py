@@ -7,23 +7,193 @@ import zipfile
 import re, sys
 from os import path
 from urllib.parse import unquote
-from xml.etree import ElementTree
 import os
 from hashlib import md5 as hashlibmd5
 
 try:
     from utils.log import logwriter
+    from utils.epub_container import EpubContainer, MIME_MAP
+    from utils.link_rewriter import HREF_RE, POSTER_RE, SRC_RE, link_resolver, rewrite_css, rewrite_xhtml
+    from utils.link_rewriter import LinkMap, current_links, install_links, merge_errors
+    from utils.parallel import OrderedExecutor
+    from utils import progress
 except:
     from log import logwriter
+    from epub_container import EpubContainer, MIME_MAP
+    from link_rewriter import HREF_RE, POSTER_RE, SRC_RE, link_resolver, rewrite_css, rewrite_xhtml
+    from link_rewriter import LinkMap, current_links, install_links, merge_errors
+    from parallel import OrderedExecutor
+    import progress
 
 logger = logwriter()
 
+# CSS 中的 @import，rewrite_css 与 url() 在同一次扫描中处理
+IMPORT_RE = re.compile(
+    r"@import +([\'\"])(.*?)\1|@import +url\([\'\"]?(.*?)[\'\"]?\)"
+)
+
+
+def rewrite_text_file(xhtml_bkpath, data):
+    """改写 XHTML 中的链接，返回 (新内容, 问题链接)。模块级函数，可在进程池中执行"""
+    links = current_links()
+    re_path_map = links.re_path_map
+    errors = []
+    text = data.decode("utf-8")
+    resolve = link_resolver(xhtml_bkpath, links.bookpath)
+    if not text.startswith("<?xml"):
+        text = '<?xml version="1.0" encoding="utf-8"?>\n' + text
+    if not re.match(r"(?s).*<!DOCTYPE html", text):
+        text = re.sub(
+            r"(<\?xml.*?>)\n*",
+            r'\1\n<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN"\n  "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n',
+            text,
+            1,
+        )
+
+    # 修改a[href]
+
+    def re_href(match):
+        href, target_id, bkpath = resolve(match.group(3), True)
+        bkpath = links.check(errors, bkpath, href, target_id)
+        if not bkpath:
+            return match.group()
+
+        if href.lower().endswith(
+            (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp")
+        ):
+            filename = re_path_map["image"][bkpath]
+            return match.group(1) + "../Images/" + filename + match.group(4)
+        elif href.lower().endswith(".css"):
+            filename = re_path_map["css"][bkpath]
+            return (
+                '<link href="../Styles/'
+                + filename
+                + '" type="text/css" rel="stylesheet"/>'
+            )
+        elif href.lower().endswith((".xhtml", ".html")):
+            filename = re_path_map["text"][bkpath]
+            return match.group(1) + filename + target_id + match.group(4)
+        else:
+            return match.group()
+
+    # 修改src
+    def re_src(match):
+        href, _, bkpath = resolve(match.group(3))
+        bkpath = links.check(errors, bkpath, href)
+        if not bkpath:
+            return match.group()
+
+        if href.lower().endswith(
+            (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp", ".svg")
+        ):
+            filename = re_path_map["image"][bkpath]
+            return match.group(1) + "../Images/" + filename + match.group(4)
+        elif href.lower().endswith(".mp3"):
+            filename = re_path_map["audio"][bkpath]
+            return match.group(1) + "../Audio/" + filename + match.group(4)
+        elif href.lower().endswith(".mp4"):
+            filename = re_path_map["video"][bkpath]
+            return match.group(1) + "../Video/" + filename + match.group(4)
+        elif href.lower().endswith(".js"):
+            filename = re_path_map["other"][bkpath]
+            return match.group(1) + "../Misc/" + filename + match.group(4)
+        else:
+            return match.group()
+
+    def re_poster(match):
+        href, _, bkpath = resolve(match.group(3))
+        bkpath = links.check(errors, bkpath, href)
+        if not bkpath:
+            return match.group()
+        if href.lower().endswith(
+            (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp", ".svg")
+        ):
+            filename = re_path_map["image"][bkpath]
+            return match.group(1) + "../Images/" + filename + match.group(4)
+        else:
+            return match.group()
+
+    # 修改 text
+    def re_url(match):
+        url, _, bkpath = resolve(match.group(2))
+        bkpath = links.check(errors, bkpath, url)
+        if not bkpath:
+            return match.group()
+
+        if url.lower().endswith((".ttf", ".otf")):
+            filename = re_path_map["font"][bkpath]
+            return match.group(1) + "../Fonts/" + filename + match.group(3)
+        elif url.lower().endswith(
+            (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp", ".svg")
+        ):
+            filename = re_path_map["image"][bkpath]
+            return match.group(1) + "../Images/" + filename + match.group(3)
+        else:
+            return match.group()
+
+    # 单次扫描完成 href、src、poster、url() 的替换
+    text = rewrite_xhtml(
+        text, [(HREF_RE, re_href), (SRC_RE, re_src), (POSTER_RE, re_poster)], re_url
+    )
+    return bytes(text, encoding="utf-8"), errors
+
+
+def rewrite_css_file(css_bkpath, data):
+    """改写 CSS 中的链接，返回 (新内容, 问题链接)，无法解码时新内容为 None。模块级函数，可在进程池中执行"""
+    links = current_links()
+    re_path_map = links.re_path_map
+    errors = []
+    try:
+        css = data.decode("utf-8")
+    except:
+        return None, errors
+    resolve = link_resolver(css_bkpath, links.bookpath)
+
+    # 修改 @import
+    def re_import(match):
+        href = match.group(2) if match.group(2) else match.group(3)
+        href = unquote(href).strip()
+        if not href.lower().endswith(".css"):
+            return match.group()
+        bkpath = links.bookpath(href, css_bkpath)
+        bkpath = links.check(errors, bkpath, href)
+        if not bkpath:
+            return match.group()
+        filename = re_path_map.get("css", {}).get(bkpath, path.basename(href))
+        if match.group(2):
+            return '@import "{}"'.format(filename)
+        else:
+            return '@import url("{}")'.format(filename)
+
+    # 修改 css的url
+    def re_css_url(match):
+        url, _, bkpath = resolve(match.group(2))
+        bkpath = links.check(errors, bkpath, url)
+        if not bkpath:
+            return match.group()
+        if url.lower().endswith((".ttf", ".otf")):
+            filename = re_path_map["font"][bkpath]
+            return match.group(1) + "../Fonts/" + filename + match.group(3)
+        elif url.lower().endswith(
+            (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp", ".svg")
+        ):
+            filename = re_path_map["image"][bkpath]
+            return match.group(1) + "../Images/" + filename + match.group(3)
+        else:
+            return match.group()
+
+    css = rewrite_css(css, IMPORT_RE, re_import, re_css_url)
+    return bytes(css, encoding="utf-8"), errors
+
 
 class EpubTool:
 
-    def __init__(self, epub_src):
+    def __init__(self, epub_src, workers=1):
         self.encrypted = False
-        self.epub = zipfile.ZipFile(epub_src)
+        self.container = EpubContainer(epub_src)
+        self.epub = self.container.epub
+        self.paths = self.container.paths  # 路径解析及大小写无关索引，结果有缓存
+        self.workers = workers  # 并行改写 XHTML/CSS 的进程数
         self.tgt_epub = None
         self.file_write_path = None
         self.epub_src = epub_src
@@ -32,9 +202,10 @@ class EpubTool:
         self.output_path = self.ebook_root
         self.epub_type = ""
         self.temp_dir = ""
-        self._init_namelist()
-        self._init_mime_map()
-        self._init_opf()
+        self.namelist = self.container.namelist
+        self.mime_map = MIME_MAP
+        self.opfpath = self.container.opfpath
+        self.opf = self.container.opf
         self.manifest_list = []  # (id,opf_href,mime,properties)
         self.toc_rn = {}
         self.all_mixed = {}
@@ -59,56 +230,16 @@ class EpubTool:
             self.output_path, self.epub_name.replace(".epub", "_encrypt.epub")
         )
 
-    def _init_namelist(self):
-        self.namelist = self.epub.namelist()
-
-    def _init_mime_map(self):
-        self.mime_map = {
-            ".html": "application/xhtml+xml",
-            ".xhtml": "application/xhtml+xml",
-            ".css": "text/css",
-            ".js": "application/javascript",
-            ".jpg": "image/jpeg",
-            ".jpeg": "image/jpeg",
-            ".bmp": "image/bmp",
-            ".png": "image/png",
-            ".gif": "image/gif",
-            ".webp": "image/webp",
-            ".ttf": "font/ttf",
-            ".otf": "font/otf",
-            ".woff": "font/woff",
-            ".ncx": "application/x-dtbncx+xml",
-            ".mp3": "audio/mpeg",
-            ".mp4": "video/mp4",
-            ".smil": "application/smil+xml",
-            ".pls": "application/pls+xml",
-        }
-
-    def _init_opf(self):
-        # 通过 container.xml 读取 opf 文件
-        container_xml = self.epub.read("META-INF/container.xml").decode("utf-8")
-        rf = re.match(r'<rootfile[^>]*full-path="(?i:(.*?\.opf))"', container_xml)
-        if rf is not None:
-            self.opfpath = rf.group(1)
-            self.opf = self.epub.read(self.opfpath).decode("utf-8")
-            return
-        # 通过路径首个 opf 读取 opf 文件
-        for bkpath in self.namelist:
-            if bkpath.lower().endswith(".opf"):
-                self.opfpath = bkpath
-                self.opf = self.epub.read(self.opfpath).decode("utf-8")
-                return
-        raise RuntimeError("无法发现opf文件")
-
     def _parse_opf(self):
-        self.etree_opf = {"package": ElementTree.fromstring(self.opf)}
-
-        for child in self.etree_opf["package"]:
-            tag = re.sub(r"\{.*?\}", r"", child.tag)
-            self.etree_opf[tag] = child
-        self._parse_metadata()
-        self._parse_manifest()
-        self._parse_spine()
+        self.etree_opf = self.container.etree_opf
+
+        self.metadata = dict(self.container.metadata)
+        self.id_to_h_m_p = dict(self.container.id_to_h_m_p)
+        self.id_to_href = {  # { id : href.lower, ... }
+            id: href.lower() for id, (href, mime, prop) in self.id_to_h_m_p.items()
+        }
+        self.href_to_id = dict(self.container.href_to_id)  # { href.lower : id, ...}
+        self.spine_list = list(self.container.spine_list)
         self._clear_duplicate_id_href()
         self._parse_hrefs_not_in_epub()
         self._add_files_not_in_opf()
@@ -200,70 +331,6 @@ class EpubTool:
 
         self._check_manifest_and_spine()
 
-    def _parse_metadata(self):
-        self.metadata = {}
-        for key in [
-            "title",
-            "creator",
-            "language",
-            "subject",
-            "source",
-            "identifier",
-            "cover",
-        ]:
-            self.metadata[key] = ""
-        for meta in self.etree_opf["metadata"]:
-            tag = re.sub(r"\{.*?\}", r"", meta.tag)
-            if tag in [
-                "title",
-                "creator",
-                "language",
-                "subject",
-                "source",
-                "identifier",
-            ]:
-                self.metadata[tag] = meta.text
-            elif tag == "meta":
-                if meta.get("name") and meta.get("content"):
-                    self.metadata["cover"] = meta.get("content")
-
-    def _parse_manifest(self):
-        self.id_to_h_m_p = {}  # { id : (href,mime,properties) , ... }
-        self.id_to_href = {}  # { id : href.lower, ... }
-        self.href_to_id = {}  # { href.lower : id, ...}
-        if_error = False
-        for item in self.etree_opf["manifest"]:
-            # 检查opf文件中是否存在错误
-            try:
-                id = item.get("id")
-                href = unquote(item.get("href"))
-            except Exception as e:
-                str_item = (
-                    ElementTree.tostring(item, encoding="unicode")
-                    .replace("\n", "")
-                    .replace("\r", "")
-                    .replace("\t", "")
-                )
-                logger.write(f"item: {str_item} error: {e}")
-                if_error = True
-                continue
-            mime = item.get("media-type")
-            properties = item.get("properties") if item.get("properties") else ""
-
-            self.id_to_h_m_p[id] = (href, mime, properties)
-            self.id_to_href[id] = href.lower()
-            self.href_to_id[href.lower()] = id
-        if if_error:
-            logger.write("opf文件中存在错误，请检查！")
-
-    def _parse_spine(self):
-        self.spine_list = []  # [ (sid, linear, properties) , ... ]
-        for itemref in self.etree_opf["spine"]:
-            sid = itemref.get("idref")
-            linear = itemref.get("linear") if itemref.get("linear") else ""
-            properties = itemref.get("properties") if itemref.get("properties") else ""
-            self.spine_list.append((sid, linear, properties))
-
     def _clear_duplicate_id_href(self):
 
         # id_used = [ id_in_spine + cover_id ]
@@ -313,7 +380,7 @@ class EpubTool:
                     ".smil",
                 )
             ):
-                opf_href = get_relpath(self.opfpath, archive_path)
+                opf_href = self.paths.relpath(self.opfpath, archive_path)
                 if opf_href.lower() not in self.href_to_id.keys():
                     hrefs_not_in_opf.append(opf_href)
 
@@ -358,10 +425,9 @@ class EpubTool:
 
     def _parse_hrefs_not_in_epub(self):
         del_id = []
-        namelist = [x.lower() for x in self.epub.namelist()]
         for id, href in self.id_to_href.items():
-            bkpath = get_bookpath(href, self.opfpath)
-            if bkpath.lower() not in namelist:
+            bkpath = self.paths.bookpath(href, self.opfpath)
+            if self.container.real_path(bkpath) is None:
                 del_id.append(id)
                 del self.href_to_id[href]
         for id in del_id:
@@ -371,8 +437,10 @@ class EpubTool:
     def create_tgt_epub(self):
         output_path = self.output_path
         logger.write(f"输出路径: {output_path}")
+        file_write_path = path.join(output_path, self.epub_name.replace(".epub", "_encrypt.epub"))
+        progress.output_file(file_write_path)
         return zipfile.ZipFile(
-            path.join(output_path, self.epub_name.replace(".epub", "_encrypt.epub")),
+            file_write_path,
             "w",
             zipfile.ZIP_STORED,
         )
@@ -429,246 +497,76 @@ class EpubTool:
             basename_log[ftype].append(basename)
             return basename
 
-        def check_link(filename, bkpath, href, self, target_id=""):
-            if href == "" or href.startswith(
-                ("http://", "https://", "res:/", "file:/", "data:")
-            ):
-                return None
-            if bkpath.lower() in lowerPath_to_originPath.keys():
-                if bkpath != lowerPath_to_originPath[bkpath.lower()]:  # 大小写不一致
-                    correct_path = lowerPath_to_originPath[bkpath.lower()]
-                    self.errorLink_log.setdefault(filename, [])
-                    self.errorLink_log[filename].append(
-                        (href + target_id, correct_path)
-                    )
-                    bkpath = correct_path
-            else:  # 链接路径找不到对应文件
-                self.errorLink_log.setdefault(filename, [])
-                self.errorLink_log[filename].append((href + target_id, None))
-                return None
-            return bkpath
-
         # xhtml文件，关联 toc文件，一切 xhtml中的<a>元素
         for id, href, properties, newhref in self.text_list:
-            bkpath = get_bookpath(href, self.opfpath)
+            bkpath = self.paths.bookpath(href, self.opfpath)
             basename = auto_rename(id, newhref, "text")
             re_path_map["text"][bkpath] = basename
             lowerPath_to_originPath[bkpath.lower()] = bkpath
 
         # css 文件，关联 xhtml文件的link，css文件中的@import
         for id, href, properties, newhref in self.css_list:
-            bkpath = get_bookpath(href, self.opfpath)
+            bkpath = self.paths.bookpath(href, self.opfpath)
             basename = auto_rename(id, newhref, "css")
             re_path_map["css"][bkpath] = basename
             lowerPath_to_originPath[bkpath.lower()] = bkpath
 
         # 图片，关联css中的url，xhtml文件中的href
         for id, href, properties, newhref in self.image_list:
-            bkpath = get_bookpath(href, self.opfpath)
+            bkpath = self.paths.bookpath(href, self.opfpath)
             basename = auto_rename(id, newhref, "image")
             re_path_map["image"][bkpath] = basename
             lowerPath_to_originPath[bkpath.lower()] = bkpath
         # 字体，关联css中的url
         for id, href, properties, newhref in self.font_list:
-            bkpath = get_bookpath(href, self.opfpath)
+            bkpath = self.paths.bookpath(href, self.opfpath)
             basename = auto_rename(id, newhref, "font")
             re_path_map["font"][bkpath] = basename
             lowerPath_to_originPath[bkpath.lower()] = bkpath
 
         # 音频
         for id, href, properties, newhref in self.audio_list:
-            bkpath = get_bookpath(href, self.opfpath)
+            bkpath = self.paths.bookpath(href, self.opfpath)
             basename = auto_rename(id, newhref, "audio")
             re_path_map["audio"][bkpath] = basename
             lowerPath_to_originPath[bkpath.lower()] = bkpath
 
         # 视频
         for id, href, properties, newhref in self.video_list:
-            bkpath = get_bookpath(href, self.opfpath)
+            bkpath = self.paths.bookpath(href, self.opfpath)
             basename = auto_rename(id, newhref, "video")
             re_path_map["video"][bkpath] = basename
             lowerPath_to_originPath[bkpath.lower()] = bkpath
 
         # 其他文件
         for id, href, mime, properties, newhref in self.other_list:
-            bkpath = get_bookpath(href, self.opfpath)
+            bkpath = self.paths.bookpath(href, self.opfpath)
             basename = auto_rename(id, newhref, "other")
             re_path_map["other"][bkpath] = basename
             lowerPath_to_originPath[bkpath.lower()] = bkpath
 
-        # xhtml文件
-        for xhtml_bkpath, new_name in re_path_map["text"].items():
-            text = self.epub.read(xhtml_bkpath).decode("utf-8")
-            if not text.startswith("<?xml"):
-                text = '<?xml version="1.0" encoding="utf-8"?>\n' + text
-            if not re.match(r"(?s).*<!DOCTYPE html", text):
-                text = re.sub(
-                    r"(<\?xml.*?>)\n*",
-                    r'\1\n<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN"\n  "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n',
-                    text,
-                    1,
+        # 改名表已确定，各文档的改写只读取快照
+        links = LinkMap(re_path_map, lowerPath_to_originPath, self.paths)
+        install_links(links)
+
+        # xhtml、css文件: 各文档的改写互不相关，在进程池中进行，按原顺序写入
+        self.stage = progress.stage("rewrite", len(re_path_map["text"]) + len(re_path_map["css"]), self.tgt_epub)
+        with self.stage, OrderedExecutor(self.workers, initializer=install_links, initargs=(links,)) as executor:
+            for xhtml_bkpath, new_name in re_path_map["text"].items():
+                executor.submit(
+                    (xhtml_bkpath, "OEBPS/Text/" + new_name),
+                    rewrite_text_file, xhtml_bkpath, self.epub.read(xhtml_bkpath),
                 )
-
-            # 修改a[href]
-
-            def re_href(match):
-                href = match.group(3)
-                href = unquote(href).strip()
-                if "#" in href:
-                    href, target_id = href.split("#")
-                    target_id = "#" + target_id
-                else:
-                    target_id = ""
-
-                bkpath = get_bookpath(href, xhtml_bkpath)
-                bkpath = check_link(xhtml_bkpath, bkpath, href, self, target_id)
-                if not bkpath:
-                    return match.group()
-
-                if href.lower().endswith(
-                    (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp")
-                ):
-                    filename = re_path_map["image"][bkpath]
-                    return match.group(1) + "../Images/" + filename + match.group(4)
-                elif href.lower().endswith(".css"):
-                    filename = re_path_map["css"][bkpath]
-                    return (
-                        '<link href="../Styles/'
-                        + filename
-                        + '" type="text/css" rel="stylesheet"/>'
-                    )
-                elif href.lower().endswith((".xhtml", ".html")):
-                    filename = re_path_map["text"][bkpath]
-                    return match.group(1) + filename + target_id + match.group(4)
-                else:
-                    return match.group()
-
-            text = re.sub(r"(<[^>]*href=([\'\"]))(.*?)(\2[^>]*>)", re_href, text)
-
-            # 修改src
-            def re_src(match):
-                href = match.group(3)
-                href = unquote(href).strip()
-                bkpath = get_bookpath(href, xhtml_bkpath)
-                bkpath = check_link(xhtml_bkpath, bkpath, href, self)
-                if not bkpath:
-                    return match.group()
-
-                if href.lower().endswith(
-                    (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp", ".svg")
-                ):
-                    filename = re_path_map["image"][bkpath]
-                    return match.group(1) + "../Images/" + filename + match.group(4)
-                elif href.lower().endswith(".mp3"):
-                    filename = re_path_map["audio"][bkpath]
-                    return match.group(1) + "../Audio/" + filename + match.group(4)
-                elif href.lower().endswith(".mp4"):
-                    filename = re_path_map["video"][bkpath]
-                    return match.group(1) + "../Video/" + filename + match.group(4)
-                elif href.lower().endswith(".js"):
-                    filename = re_path_map["other"][bkpath]
-                    return match.group(1) + "../Misc/" + filename + match.group(4)
-                else:
-                    return match.group()
-
-            def re_poster(match):
-                href = match.group(3)
-                href = unquote(href).strip()
-                bkpath = get_bookpath(href, xhtml_bkpath)
-                bkpath = check_link(xhtml_bkpath, bkpath, href, self)
-                if not bkpath:
-                    return match.group()
-                if href.lower().endswith(
-                    (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp", ".svg")
-                ):
-                    filename = re_path_map["image"][bkpath]
-                    return match.group(1) + "../Images/" + filename + match.group(4)
-                else:
-                    return match.group()
-
-            text = re.sub(r"(<[^>]* src=([\'\"]))(.*?)(\2[^>]*>)", re_src, text)
-            text = re.sub(r"(<[^>]* poster=([\'\"]))(.*?)(\2[^>]*>)", re_poster, text)
-
-            # 修改 text
-            def re_url(match):
-                url = match.group(2)
-                url = unquote(url).strip()
-                bkpath = get_bookpath(url, xhtml_bkpath)
-                bkpath = check_link(xhtml_bkpath, bkpath, url, self)
-                if not bkpath:
-                    return match.group()
-
-                if url.lower().endswith((".ttf", ".otf")):
-                    filename = re_path_map["font"][bkpath]
-                    return match.group(1) + "../Fonts/" + filename + match.group(3)
-                elif url.lower().endswith(
-                    (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp", ".svg")
-                ):
-                    filename = re_path_map["image"][bkpath]
-                    return match.group(1) + "../Images/" + filename + match.group(3)
-                else:
-                    return match.group()
-
-            text = re.sub(r"(url\([\'\"]?)(.*?)([\'\"]?\))", re_url, text)
-            self.tgt_epub.writestr(
-                "OEBPS/Text/" + new_name,
-                bytes(text, encoding="utf-8"),
-                zipfile.ZIP_DEFLATED,
-            )
-        # css文件
-        for css_bkpath, new_name in re_path_map["css"].items():
-            try:
-                css = self.epub.read(css_bkpath).decode("utf-8")
-            except:
-                continue
-
-            # 修改 @import
-            def re_import(match):
-                href = match.group(2) if match.group(2) else match.group(3)
-                href = unquote(href).strip()
-                if not href.lower().endswith(".css"):
-                    return match.group()
-                bkpath = get_bookpath(href, css_bkpath)
-                bkpath = check_link(css_bkpath, bkpath, href, self)
-                if not bkpath:
-                    return match.group()
-                filename = re_path_map.get("css", {}).get(bkpath, path.basename(href))
-                if match.group(2):
-                    return '@import "{}"'.format(filename)
-                else:
-                    return '@import url("{}")'.format(filename)
-
-            css = re.sub(
-                r"@import +([\'\"])(.*?)\1|@import +url\([\'\"]?(.*?)[\'\"]?\)",
-                re_import,
-                css,
-            )
-
-            # 修改 css的url
-            def re_css_url(match):
-                url = match.group(2)
-                url = unquote(url).strip()
-                bkpath = get_bookpath(url, css_bkpath)
-                bkpath = check_link(css_bkpath, bkpath, url, self)
-                if not bkpath:
-                    return match.group()
-                if url.lower().endswith((".ttf", ".otf")):
-                    filename = re_path_map["font"][bkpath]
-                    return match.group(1) + "../Fonts/" + filename + match.group(3)
-                elif url.lower().endswith(
-                    (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp", ".svg")
-                ):
-                    filename = re_path_map["image"][bkpath]
-                    return match.group(1) + "../Images/" + filename + match.group(3)
-                else:
-                    return match.group()
-
-            css = re.sub(r"(url\([\'\"]?)(.*?)([\'\"]?\))", re_css_url, css)
-            self.tgt_epub.writestr(
-                "OEBPS/Styles/" + new_name,
-                bytes(css, encoding="utf-8"),
-                zipfile.ZIP_DEFLATED,
-            )
+                self._write_rewritten(executor.results())
+            for css_bkpath, new_name in re_path_map["css"].items():
+                try:
+                    css = self.epub.read(css_bkpath)
+                except:
+                    self.stage.advance()
+                    continue
+                executor.submit((css_bkpath, "OEBPS/Styles/" + new_name), rewrite_css_file, css_bkpath, css)
+                self._write_rewritten(executor.results())
+            self._write_rewritten(executor.results(wait=True))
         # 图片
         for img_bkpath, new_name in re_path_map["image"].items():
             try:
@@ -730,7 +628,7 @@ class EpubTool:
                 href_base = (
                     self.toc_rn[href_base] if href_base in self.toc_rn else href_base
                 )
-                bkpath = get_bookpath(href_base, self.tocpath)
+                bkpath = self.paths.bookpath(href_base, self.tocpath)
 
                 if not bkpath:
                     return match.group()
@@ -746,7 +644,7 @@ class EpubTool:
         manifest_text = "<manifest>"
 
         for id, href, mime, prop in self.manifest_list:
-            bkpath = get_bookpath(href, self.opfpath)
+            bkpath = self.paths.bookpath(href, self.opfpath)
             prop_ = ' properties="' + prop + '"' if prop else ""
             if mime == "application/xhtml+xml":
                 filename = re_path_map["text"][bkpath]
@@ -797,6 +695,13 @@ class EpubTool:
         )
         self.close_files()
 
+    def _write_rewritten(self, results):
+        for (bkpath, arcname), (content, errors) in results:
+            self.stage.advance(read=self.epub.getinfo(bkpath).compress_size)
+            merge_errors(self.errorLink_log, bkpath, errors)
+            if content is not None:
+                self.tgt_epub.writestr(arcname, content, zipfile.ZIP_DEFLATED)
+
     def close_files(self):
         if self.epub:
             self.epub.close()
@@ -811,48 +716,6 @@ class EpubTool:
             logger.write("临时文件不存在或已被删除。")
 
 
-# 相对路径计算函数
-def get_relpath(from_path, to_path):
-    # from_path 和 to_path 都需要是绝对路径
-    from_path = re.split(r"[\\/]", from_path)
-    to_path = re.split(r"[\\/]", to_path)
-    while from_path[0] == to_path[0]:
-        from_path.pop(0), to_path.pop(0)
-    to_path = "../" * (len(from_path) - 1) + "/".join(to_path)
-    return to_path
-
-
-# 计算bookpath
-def get_bookpath(relative_path, refer_bkpath):
-    # relative_path 相对路径，一般是href
-    # refer_bkpath 参考的绝对路径
-
-    relative_ = re.split(r"[\\/]", relative_path)
-    refer_ = re.split(r"[\\/]", refer_bkpath)
-
-    back_step = 0
-    while relative_[0] == "..":
-        back_step += 1
-        relative_.pop(0)
-
-    if len(refer_) <= 1:
-        return "/".join(relative_)
-    else:
-        refer_.pop(-1)
-
-    if back_step < 1:
-        return "/".join(refer_ + relative_)
-    elif back_step > len(refer_):
-        return "/".join(relative_)
-
-    # len(refer_) > 1 and back_setp <= len(refer_):
-    while back_step > 0 and len(refer_) > 0:
-        refer_.pop(-1)
-        back_step -= 1
-
-    return "/".join(refer_ + relative_)
-
-
 def epub_sources():
     if len(sys.argv) <= 1:
         return sys.argv
@@ -868,13 +731,13 @@ def epub_sources():
     return epub_srcs
 
 
-def run(epub_src, output_path=None):
+def run(epub_src, output_path=None, workers=1):
     try:
         logger.write(f"\n正在尝试加密EPUB: {epub_src}")
         if epub_src.lower().endswith("_encrypt.epub"):
             logger.write("警告: 该文件已加密，无需再次处理！")
             return "skip"
-        epub = EpubTool(epub_src)
+        epub = EpubTool(epub_src, workers)
         epub.set_output_path(output_path)
         if epub.encrypted == True:
             logger.write("警告: 该文件已加密，无需再次处理！")
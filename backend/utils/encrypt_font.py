@@ -15,20 +15,205 @@ from datetime import datetime
 
 try:
     from utils.log import logwriter
+    from utils.epub_container import EpubContainer
+    from utils.html_engine import get_engine
+    from utils.parallel import OrderedExecutor
+    from utils import progress
 except:
     from log import logwriter
+    from epub_container import EpubContainer
+    from html_engine import get_engine
+    from parallel import OrderedExecutor
+    import progress
 
 logger = logwriter()
 
 
+# 修改自https://github.com/solarhell/fontObfuscator
+def ensure_cmap_has_all_text(cmap: dict, s: str) -> bool:
+    missing_chars = []
+    exsit_chars = []
+    for char in s:
+        if ord(char) not in cmap:
+            # raise Exception(f'字库缺少{char}这个字 {ord(char)}')
+            missing_chars.append(char)
+        else:
+            exsit_chars.append(char)
+    return missing_chars, "".join(exsit_chars)
+
+
+def set_timestamps(font):
+    # 设置 'head' 表的时间戳
+    head_table = font["head"]
+    current_time = int(datetime.now().timestamp())
+    # print(f"原始时间戳: {head_table.created}, {head_table.modified}")
+    created_datetime = datetime.fromtimestamp(head_table.created).strftime(
+        "%Y-%m-%d %H:%M:%S"
+    )
+    modified_datetime = datetime.fromtimestamp(head_table.modified).strftime(
+        "%Y-%m-%d %H:%M:%S"
+    )
+    logger.write(f"原始时间戳: {created_datetime}, {modified_datetime}")
+    # print(f"转换UTC时间，: {created_datetime}")
+    # print(f"转换UTC时间，: {modified_datetime}")
+    head_table.created = current_time
+    head_table.modified = current_time
+    logger.write(
+        f"转换后时间戳 {datetime.fromtimestamp(current_time).strftime('%Y-%m-%d %H:%M:%S')}"
+    )
+
+
+# 修改自https://github.com/solarhell/fontObfuscator
+def encrypt_font_data(i, font_path, font_data, plain_text, seed):
+    """加密单个字体，返回 (新字体数据, { 原字符 : 替换用的实体 })。模块级函数，可在进程池中执行"""
+    rng = random.Random(seed)
+    original_font = TTFont(BytesIO(font_data))
+    name_table = original_font["name"]
+    family_name = None
+    style_name = None
+    for record in name_table.names:
+        if record.nameID == 1:
+            family_name = record.string.decode(record.getEncoding())
+        elif record.nameID == 2:
+            style_name = record.string.decode(record.getEncoding())
+
+        if family_name and style_name:
+            break
+    if family_name is None:
+        family_name = f"ETFamily_{i}"
+    if style_name is None:
+        style_name = "Regular"
+
+    NAME_STRING = {
+        "familyName": family_name,
+        "styleName": style_name,
+        "psName": family_name + "-" + style_name,
+        "copyright": "Created by EpubTool",
+        "version": "Version 1.0",
+        "vendorURL": "https://EpubTool.com/",
+    }
+    original_cmap: dict = original_font.getBestCmap()
+    miss_char, plain_text = ensure_cmap_has_all_text(
+        original_cmap, plain_text
+    )
+    if len(miss_char) > 0:
+        logger.write(f"字体文件{font_path}缺少字符{miss_char}")
+    available_ranges = [ord(char) for char in plain_text]
+    glyphs, metrics, cmap = {}, {}, {}
+    private_codes = rng.sample(range(0xAC00, 0xD7AF), len(plain_text))
+    cjk_codes = rng.sample(available_ranges, len(plain_text))
+
+    glyph_set = original_font.getGlyphSet()
+    pen = TTGlyphPen(glyph_set)
+    glyph_order = original_font.getGlyphOrder()
+    final_shadow_text: list = []
+    spescial_glyphs = [
+        "null",
+        ".notdef",
+        "minus",
+        "dotlessi",
+        "uni0307",
+        "quotesingle",
+        "zero.dnom",
+        "fraction",
+        "uni0237",
+    ]
+
+    for special_glyph in spescial_glyphs:
+        if special_glyph in glyph_order:
+            glyph_set[special_glyph].draw(pen)
+            glyphs[special_glyph] = pen.glyph()
+            metrics[special_glyph] = original_font["hmtx"][special_glyph]
+            final_shadow_text += [special_glyph]
+
+    html_entities = []
+
+    for index, plain in enumerate(plain_text):
+        try:
+            shadow_cmap_name = original_cmap[cjk_codes[index]]
+        except KeyError:
+            logger.write(
+                f"字体文件缺少字符，unicode:{cjk_codes[index]}，请检查"
+            )
+
+        final_shadow_text += [shadow_cmap_name]
+        glyph_set[original_cmap[ord(plain)]].draw(pen)
+        glyphs[shadow_cmap_name] = pen.glyph()
+        metrics[shadow_cmap_name] = original_font["hmtx"][
+            original_cmap[ord(plain)]
+        ]
+        cmap[private_codes[index]] = shadow_cmap_name
+        html_entities += [hex(private_codes[index]).replace("0x", "&#x")]
+
+    horizontal_header = {
+        "ascent": original_font["hhea"].ascent,
+        "descent": original_font["hhea"].descent,
+    }
+    missing_glyphs = [
+        glyph for glyph in final_shadow_text if glyph not in glyphs
+    ]
+    if missing_glyphs:
+        logger.write(f"以下字形在 glyphs 中缺失: {missing_glyphs}")
+        for glyph in missing_glyphs:
+            glyphs[glyph] = pen.glyph()
+            metrics[glyph] = (0, 0)
+
+    glyf_table = original_font["glyf"]
+    glyphs_to_keep = set(glyphs.keys())
+    new_glyph_order = [
+        glyph for glyph in glyph_order if glyph in glyphs_to_keep
+    ]
+    original_font.setGlyphOrder(new_glyph_order)
+
+    # 删除不必要的字形
+    for glyph in glyph_order:
+        if glyph not in glyphs_to_keep:
+            if glyph in glyf_table.glyphs:
+                del glyf_table.glyphs[glyph]
+            if glyph in original_font["hmtx"].metrics:
+                del original_font["hmtx"].metrics[glyph]
+            loca_index = glyph_order.index(glyph)
+            if 0 <= loca_index < len(original_font["loca"].locations):
+                original_font["loca"].locations[loca_index] = 0
+
+    # 更新 maxp 表
+    original_font["maxp"].numGlyphs = len(new_glyph_order)
+
+    set_timestamps(original_font)
+
+    fb = FontBuilder(original_font["head"].unitsPerEm, isTTF=True)
+    fb.setupGlyphOrder(new_glyph_order)
+    fb.setupCharacterMap(cmap)
+    fb.setupGlyf(glyphs)
+    fb.setupHorizontalMetrics(metrics)
+    fb.setupHorizontalHeader(**horizontal_header)
+    fb.setupNameTable(NAME_STRING)
+    fb.setupOS2()
+    fb.setupPost()
+    font_stream = BytesIO()
+    fb.save(font_stream)
+    # print(plain_text, html_entities)
+    # print(f"write {font_path}")
+
+    text_list = list(plain_text)
+    replace_table = {}
+    for a0, a1 in zip(text_list, html_entities):
+        replace_table[a0] = a1
+    return font_stream.getvalue(), replace_table
+
+
 class FontEncrypt:
 
-    def __init__(self, epub_path, output_path):
+    def __init__(self, epub_path, output_path, html_engine=None, workers=1):
         if not os.path.exists(epub_path):
             raise Exception("EPUB文件不存在")
 
+        # 统计用字与替换文字须选中相同的元素，两处使用同一个可修改的引擎，见 html_engine.py
+        self.engine = get_engine(html_engine, editable=True)
+        self.workers = workers  # 并行加密字体的进程数
         self.epub_path = os.path.normpath(epub_path)
-        self.epub = zipfile.ZipFile(epub_path)
+        self.container = EpubContainer(epub_path)
+        self.epub = self.container.epub
         if output_path and os.path.exists(output_path):
             if os.path.isfile(output_path):
                 raise Exception("输出路径不能是文件")
@@ -47,6 +232,7 @@ class FontEncrypt:
         self.htmls = []
         self.css = []
         self.fonts = []
+        self.font_by_basename = {}  # { 字体文件名 : 字体路径 }，同名时以后出现者为准
         self.ori_files = []
         self.missing_chars = []
         self.font_to_font_family_mapping = {}
@@ -54,7 +240,7 @@ class FontEncrypt:
         self.font_to_char_mapping = {}
         # self.font_to_unchanged_file_mapping = {}
         self.target_epub = None
-        for file in self.epub.namelist():
+        for file in self.container.namelist:
             if file.lower().endswith(".html") or file.endswith(".xhtml"):
                 self.htmls.append(file)
             elif file.lower().endswith(".css"):
@@ -62,10 +248,12 @@ class FontEncrypt:
                 self.css.append(file)
             elif file.lower().endswith((".ttf", ".otf", ".woff")):
                 self.fonts.append(file)
+                self.font_by_basename[os.path.basename(file)] = file
             else:
                 self.ori_files.append(file)
 
     def create_target_epub(self):
+        progress.output_file(self.file_write_path)
         self.target_epub = zipfile.ZipFile(
             self.file_write_path,
             "w",
@@ -101,9 +289,8 @@ class FontEncrypt:
                             for url in src_urls:
                                 # 尝试匹配文件名
                                 url_basename = os.path.basename(url).split('?')[0].split('#')[0]
-                                for font_path in self.fonts:
-                                    if os.path.basename(font_path) == url_basename:
-                                        mapping[font_family] = font_path
+                                if url_basename in self.font_by_basename:
+                                    mapping[font_family] = self.font_by_basename[url_basename]
                                         
         self.font_to_font_family_mapping = mapping
 
@@ -157,37 +344,35 @@ class FontEncrypt:
 
     def find_char_mapping(self):
         mapping = {}
-        for one_html in self.htmls:
-            with self.epub.open(one_html) as f:
-                content = f.read().decode("utf-8")
-                soup = BeautifulSoup(content, "html.parser")
-                for (
-                    css_selector,
-                    font_file,
-                ) in self.css_selector_to_font_mapping.items():
-                    # 使用 CSS 选择器查找对应的标签
-                    elements = soup.select(css_selector)
-
-                    # 提取每个标签的文字内容
-                    text_contents = [
-                        element.get_text(strip=True) for element in elements
-                    ]
-                    combined_sentence = "".join(text_contents)
-                    if font_file not in mapping:
-                        mapping[font_file] = self.remove_duplicates(combined_sentence)
-                    else:
-                        mapping[font_file] = self.remove_duplicates(
-                            "".join([mapping[font_file], combined_sentence])
-                        )
+        with progress.stage("scan", len(self.htmls)) as stage:
+            for one_html in self.htmls:
+                with self.epub.open(one_html) as f:
+                    content = f.read().decode("utf-8")
+                    doc = self.engine.parse(content)
+                    for (
+                        css_selector,
+                        font_file,
+                    ) in self.css_selector_to_font_mapping.items():
+                        # 使用 CSS 选择器查找对应的标签，提取每个标签的文字内容
+                        text_contents = self.engine.select_text(doc, css_selector)
+                        combined_sentence = "".join(text_contents)
+                        if font_file not in mapping:
+                            mapping[font_file] = self.remove_duplicates(combined_sentence)
+                        else:
+                            mapping[font_file] = self.remove_duplicates(
+                                "".join([mapping[font_file], combined_sentence])
+                            )
+                stage.advance(read=self.container.getinfo(one_html).compress_size)
         self.font_to_char_mapping = mapping
 
     def get_mapping(self):
         self.find_local_fonts_mapping()
         self.find_selector_to_font_mapping()
         self.find_char_mapping()
-        logger.write(f"字体文件映射: {self.font_to_font_family_mapping}")
-        logger.write(f"CSS选择器映射: {self.css_selector_to_font_mapping}")
-        logger.write(f"字体文件到字符映射: {self.font_to_char_mapping}")
+        # 映射可能很大，按参数延迟格式化，日志级别高于 info 时不做格式化
+        logger.debug("字体文件映射: %s", self.font_to_font_family_mapping)
+        logger.debug("CSS选择器映射: %s", self.css_selector_to_font_mapping)
+        logger.debug("字体文件到字符映射: %s", self.font_to_char_mapping)
         return (
             self.font_to_font_family_mapping,
             self.css_selector_to_font_mapping,
@@ -204,181 +389,33 @@ class FontEncrypt:
             # 去除标点符号和特殊字符
             self.font_to_char_mapping[key] = re.sub(r"[^\u4e00-\u9fa5]", "", text)
             # self.font_to_char_mapping[key] = emoji.replace_emoji(text, replace="")
-        logger.write(f"清理后的文本: {self.font_to_char_mapping}")
+        logger.debug("清理后的文本: %s", self.font_to_char_mapping)
 
-    # 修改自https://github.com/solarhell/fontObfuscator
     def ensure_cmap_has_all_text(self, cmap: dict, s: str) -> bool:
-        missing_chars = []
-        exsit_chars = []
-        for char in s:
-            if ord(char) not in cmap:
-                # raise Exception(f'字库缺少{char}这个字 {ord(char)}')
-                missing_chars.append(char)
-            else:
-                exsit_chars.append(char)
-        return missing_chars, "".join(exsit_chars)
+        return ensure_cmap_has_all_text(cmap, s)
 
     def set_timestamps(self, font):
-        # 设置 'head' 表的时间戳
-        head_table = font["head"]
-        current_time = int(datetime.now().timestamp())
-        # print(f"原始时间戳: {head_table.created}, {head_table.modified}")
-        created_datetime = datetime.fromtimestamp(head_table.created).strftime(
-            "%Y-%m-%d %H:%M:%S"
-        )
-        modified_datetime = datetime.fromtimestamp(head_table.modified).strftime(
-            "%Y-%m-%d %H:%M:%S"
-        )
-        logger.write(f"原始时间戳: {created_datetime}, {modified_datetime}")
-        # print(f"转换UTC时间，: {created_datetime}")
-        # print(f"转换UTC时间，: {modified_datetime}")
-        head_table.created = current_time
-        head_table.modified = current_time
-        logger.write(
-            f"转换后时间戳 {datetime.fromtimestamp(current_time).strftime('%Y-%m-%d %H:%M:%S')}"
-        )
+        set_timestamps(font)
 
-    # 修改自https://github.com/solarhell/fontObfuscator
     def encrypt_font(self):
         self.create_target_epub()
-        for i, (font_path, plain_text) in enumerate(self.font_to_char_mapping.items()):
-            original_font = TTFont(BytesIO(self.epub.read(font_path)))
-            name_table = original_font["name"]
-            family_name = None
-            style_name = None
-            for record in name_table.names:
-                if record.nameID == 1:
-                    family_name = record.string.decode(record.getEncoding())
-                elif record.nameID == 2:
-                    style_name = record.string.decode(record.getEncoding())
-
-                if family_name and style_name:
-                    break
-            if family_name is None:
-                family_name = f"ETFamily_{i}"
-            if style_name is None:
-                style_name = "Regular"
-
-            NAME_STRING = {
-                "familyName": family_name,
-                "styleName": style_name,
-                "psName": family_name + "-" + style_name,
-                "copyright": "Created by EpubTool",
-                "version": "Version 1.0",
-                "vendorURL": "https://EpubTool.com/",
-            }
-            original_cmap: dict = original_font.getBestCmap()
-            miss_char, plain_text = self.ensure_cmap_has_all_text(
-                original_cmap, plain_text
-            )
-            if len(miss_char) > 0:
-                logger.write(f"字体文件{font_path}缺少字符{miss_char}")
-            available_ranges = [ord(char) for char in plain_text]
-            glyphs, metrics, cmap = {}, {}, {}
-            private_codes = random.sample(range(0xAC00, 0xD7AF), len(plain_text))
-            cjk_codes = random.sample(available_ranges, len(plain_text))
-
-            glyph_set = original_font.getGlyphSet()
-            pen = TTGlyphPen(glyph_set)
-            glyph_order = original_font.getGlyphOrder()
-            final_shadow_text: list = []
-            spescial_glyphs = [
-                "null",
-                ".notdef",
-                "minus",
-                "dotlessi",
-                "uni0307",
-                "quotesingle",
-                "zero.dnom",
-                "fraction",
-                "uni0237",
-            ]
-
-            for special_glyph in spescial_glyphs:
-                if special_glyph in glyph_order:
-                    glyph_set[special_glyph].draw(pen)
-                    glyphs[special_glyph] = pen.glyph()
-                    metrics[special_glyph] = original_font["hmtx"][special_glyph]
-                    final_shadow_text += [special_glyph]
-
-            html_entities = []
-
-            for index, plain in enumerate(plain_text):
-                try:
-                    shadow_cmap_name = original_cmap[cjk_codes[index]]
-                except KeyError:
-                    logger.write(
-                        f"字体文件缺少字符，unicode:{cjk_codes[index]}，请检查"
-                    )
-
-                final_shadow_text += [shadow_cmap_name]
-                glyph_set[original_cmap[ord(plain)]].draw(pen)
-                glyphs[shadow_cmap_name] = pen.glyph()
-                metrics[shadow_cmap_name] = original_font["hmtx"][
-                    original_cmap[ord(plain)]
-                ]
-                cmap[private_codes[index]] = shadow_cmap_name
-                html_entities += [hex(private_codes[index]).replace("0x", "&#x")]
-
-            horizontal_header = {
-                "ascent": original_font["hhea"].ascent,
-                "descent": original_font["hhea"].descent,
-            }
-            missing_glyphs = [
-                glyph for glyph in final_shadow_text if glyph not in glyphs
-            ]
-            if missing_glyphs:
-                logger.write(f"以下字形在 glyphs 中缺失: {missing_glyphs}")
-                for glyph in missing_glyphs:
-                    glyphs[glyph] = pen.glyph()
-                    metrics[glyph] = (0, 0)
-
-            glyf_table = original_font["glyf"]
-            glyphs_to_keep = set(glyphs.keys())
-            new_glyph_order = [
-                glyph for glyph in glyph_order if glyph in glyphs_to_keep
-            ]
-            original_font.setGlyphOrder(new_glyph_order)
-
-            # 删除不必要的字形
-            for glyph in glyph_order:
-                if glyph not in glyphs_to_keep:
-                    if glyph in glyf_table.glyphs:
-                        del glyf_table.glyphs[glyph]
-                    if glyph in original_font["hmtx"].metrics:
-                        del original_font["hmtx"].metrics[glyph]
-                    loca_index = glyph_order.index(glyph)
-                    if 0 <= loca_index < len(original_font["loca"].locations):
-                        original_font["loca"].locations[loca_index] = 0
-
-            # 更新 maxp 表
-            original_font["maxp"].numGlyphs = len(new_glyph_order)
-
-            self.set_timestamps(original_font)
-
-            fb = FontBuilder(original_font["head"].unitsPerEm, isTTF=True)
-            fb.setupGlyphOrder(new_glyph_order)
-            fb.setupCharacterMap(cmap)
-            fb.setupGlyf(glyphs)
-            fb.setupHorizontalMetrics(metrics)
-            fb.setupHorizontalHeader(**horizontal_header)
-            fb.setupNameTable(NAME_STRING)
-            fb.setupOS2()
-            fb.setupPost()
-            font_stream = BytesIO()
-            fb.save(font_stream)
-            # print(plain_text, html_entities)
-            # print(f"write {font_path}")
-
-            self.target_epub.writestr(
-                font_path, font_stream.getvalue(), zipfile.ZIP_DEFLATED
-            )
-            text_list = list(plain_text)
-            replace_table = {}
-            for a0, a1 in zip(text_list, html_entities):
-                replace_table[a0] = a1
+        # 各字体在进程池中并行加密，按原顺序写入；随机数种子在主进程生成，工作进程间不会重复
+        self.stage = progress.stage("encrypt", len(self.font_to_char_mapping), self.target_epub)
+        with self.stage, OrderedExecutor(self.workers) as executor:
+            for i, (font_path, plain_text) in enumerate(self.font_to_char_mapping.items()):
+                executor.submit(
+                    font_path, encrypt_font_data, i, font_path, self.epub.read(font_path),
+                    plain_text, random.getrandbits(64),
+                )
+                self.write_fonts(executor.results())
+            self.write_fonts(executor.results(wait=True))
+
+    def write_fonts(self, results):
+        for font_path, (font_data, replace_table) in results:
+            self.stage.advance(read=self.container.getinfo(font_path).compress_size)
+            self.target_epub.writestr(font_path, font_data, zipfile.ZIP_DEFLATED)
             self.font_to_char_mapping[font_path] = replace_table
-            logger.write(f"字体文件{font_path}的加密映射: \n{replace_table}")
+            logger.debug("字体文件%s的加密映射: \n%s", font_path, replace_table)
 
     def close_file(self):
         self.epub.close()
@@ -392,38 +429,43 @@ class FontEncrypt:
             logger.write("临时文件不存在或已被删除。")
 
     def read_html(self):
-        for one_html in self.htmls:
-            with self.epub.open(one_html) as f:
-                content = f.read().decode("utf-8")
-            soup = BeautifulSoup(content, "html.parser")
-
-            for css_selector in self.css_selector_to_font_mapping.keys():
-                font_file = self.css_selector_to_font_mapping[css_selector]
-                replace_table = self.font_to_char_mapping[font_file]
-                trans_table = str.maketrans(replace_table)
+        with progress.stage("rewrite", len(self.htmls) + len(self.ori_files), self.target_epub) as stage:
+            for one_html in self.htmls:
+                with self.epub.open(one_html) as f:
+                    content = f.read().decode("utf-8")
+                soup = self.engine.parse(content)
+
+                for css_selector in self.css_selector_to_font_mapping.keys():
+                    font_file = self.css_selector_to_font_mapping[css_selector]
+                    replace_table = self.font_to_char_mapping[font_file]
+                    trans_table = str.maketrans(replace_table)
                 
-                # Use soup.select instead of manual parsing
-                selector_tags = soup.select(css_selector)
+                    # Use soup.select instead of manual parsing
+                    selector_tags = soup.select(css_selector)
                 
-                for tag in selector_tags:
-                    ori_text = "".join(str(item) for item in tag.contents)
-                    new_text = ori_text.translate(trans_table)
-                    parsed_new_text = BeautifulSoup(
-                        html.unescape(new_text), "html.parser"
-                    )
-                    # print(f"ori_text:{ori_text}\nnew_text:{new_text}")
-                    tag.clear()  # 清空当前标签内容
-                    tag.append(parsed_new_text)  # 插入新的内容
-                    # print(tag.get_text(strip=True))
-            formatted_html = soup.prettify(formatter="html")
-            self.target_epub.writestr(
-                one_html, formatted_html.encode("utf-8"), zipfile.ZIP_DEFLATED
-            )
-        for item in self.ori_files:
-            if item in self.epub.namelist():
-                with self.epub.open(item) as f:
-                    content = f.read()
-                self.target_epub.writestr(item, content, zipfile.ZIP_DEFLATED)
+                    for tag in selector_tags:
+                        ori_text = "".join(str(item) for item in tag.contents)
+                        new_text = ori_text.translate(trans_table)
+                        parsed_new_text = BeautifulSoup(
+                            html.unescape(new_text), "html.parser"
+                        )
+                        # print(f"ori_text:{ori_text}\nnew_text:{new_text}")
+                        tag.clear()  # 清空当前标签内容
+                        tag.append(parsed_new_text)  # 插入新的内容
+                        # print(tag.get_text(strip=True))
+                formatted_html = soup.prettify(formatter="html")
+                self.target_epub.writestr(
+                    one_html, formatted_html.encode("utf-8"), zipfile.ZIP_DEFLATED
+                )
+                stage.advance(read=self.container.getinfo(one_html).compress_size)
+            for item in self.ori_files:
+                if self.container.has(item):
+                    with self.epub.open(item) as f:
+                        content = f.read()
+                    self.target_epub.writestr(item, content, zipfile.ZIP_DEFLATED)
+                    stage.advance(read=self.container.getinfo(item).compress_size)
+                else:
+                    stage.advance()
         self.close_file()
         logger.write(f"EPUB文件处理完成，输出文件路径: {self.file_write_path}")
 
@@ -431,9 +473,9 @@ class FontEncrypt:
     #    self.font_to_unchanged_file_mapping = font_file_mapping if font_file_mapping else {}
 
 
-def run_epub_font_encrypt(epub_path, output_path=None):
+def run_epub_font_encrypt(epub_path, output_path=None, html_engine=None, workers=1):
     logger.write(f"\n正在尝试加密EPUB字体: {epub_path}")
-    fe = FontEncrypt(epub_path, output_path)
+    fe = FontEncrypt(epub_path, output_path, html_engine, workers)
     if len(fe.fonts) == 0:
         logger.write("没有找到字体文件，退出")
         return "skip"
@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+# EPUB 容器: 统一的 zip / container.xml / OPF 读取层
+#
+# 各功能模块原先各自打开 zipfile、扫描 namelist、解析 OPF。
+# EpubContainer 只打开一次压缩包，按需（首次访问时）解析一次 OPF，
+# 并提供 id/href/mime 及大小写无关路径的索引，成员内容按需读取。
+
+import io
+import re
+import struct
+import sys
+import zipfile
+from functools import cached_property, lru_cache
+from os import path
+from urllib.parse import unquote
+from xml.etree import ElementTree
+
+try:
+    from utils.log import logwriter
+    from utils.streaming import stream_member
+except:
+    from log import logwriter
+    from streaming import stream_member
+
+logger = logwriter()
+
+
+MIME_MAP = {
+    ".html": "application/xhtml+xml",
+    ".xhtml": "application/xhtml+xml",
+    ".css": "text/css",
+    ".js": "application/javascript",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".bmp": "image/bmp",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+    ".ttf": "font/ttf",
+    ".otf": "font/otf",
+    ".woff": "font/woff",
+    ".ncx": "application/x-dtbncx+xml",
+    ".mp3": "audio/mpeg",
+    ".mp4": "video/mp4",
+    ".smil": "application/smil+xml",
+    ".pls": "application/pls+xml",
+}
+
+
+class EpubContainer:
+    def __init__(self, epub_src):
+        self.epub_src = epub_src
+        self.epub = zipfile.ZipFile(epub_src)
+        self.namelist = self.epub.namelist()
+        self.paths = PathIndex(self.namelist)
+        self.name_set = self.paths.name_set
+        self.lower_to_path = self.paths.lower_to_path
+
+    # ---------- 成员访问 ----------
+
+    def infolist(self):
+        return self.epub.infolist()
+
+    def getinfo(self, bkpath):
+        return self.epub.getinfo(bkpath)
+
+    def has(self, bkpath):
+        return bkpath in self.name_set
+
+    def real_path(self, bkpath):
+        # 大小写无关查找，返回压缩包内的实际路径，不存在时返回 None
+        return self.paths.real_path(bkpath)
+
+    def open(self, bkpath, mode="r"):
+        return self.epub.open(bkpath, mode)
+
+    def read(self, bkpath):
+        return self.epub.read(bkpath)
+
+    def read_text(self, bkpath, encoding="utf-8"):
+        return self.epub.read(bkpath).decode(encoding)
+
+    def copy_to(self, target, member):
+        # 原样复制成员到目标压缩包，见 copy_member
+        copy_member(self.epub, target, member)
+
+    def names_with_ext(self, *exts):
+        exts = tuple(ext.lower() for ext in exts)
+        return [name for name in self.namelist if name.lower().endswith(exts)]
+
+    def close(self):
+        if self.epub:
+            self.epub.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    # ---------- OPF ----------
+
+    @cached_property
+    def opfpath(self):
+        # 通过 container.xml 读取 opf 文件
+        if self.has("META-INF/container.xml"):
+            container_xml = self.read_text("META-INF/container.xml")
+            rf = re.match(r'<rootfile[^>]*full-path="(?i:(.*?\.opf))"', container_xml)
+            if rf is not None:
+                return rf.group(1)
+        # 通过路径首个 opf 读取 opf 文件
+        for bkpath in self.namelist:
+            if bkpath.lower().endswith(".opf"):
+                return bkpath
+        raise RuntimeError("无法发现opf文件")
+
+    @cached_property
+    def opf_dir(self):
+        return path.dirname(self.opfpath)
+
+    @cached_property
+    def opf(self):
+        return self.read_text(self.opfpath)
+
+    @cached_property
+    def etree_opf(self):
+        etree_opf = {"package": ElementTree.fromstring(self.opf)}
+        for child in etree_opf["package"]:
+            tag = re.sub(r"\{.*?\}", r"", child.tag)
+            etree_opf[tag] = child
+        return etree_opf
+
+    @cached_property
+    def version(self):
+        return self.etree_opf["package"].get("version")
+
+    @cached_property
+    def metadata(self):
+        metadata = {}
+        for key in [
+            "title",
+            "creator",
+            "language",
+            "subject",
+            "source",
+            "identifier",
+            "cover",
+        ]:
+            metadata[key] = ""
+        for meta in self.etree_opf["metadata"]:
+            tag = re.sub(r"\{.*?\}", r"", meta.tag)
+            if tag in [
+                "title",
+                "creator",
+                "language",
+                "subject",
+                "source",
+                "identifier",
+            ]:
+                metadata[tag] = meta.text
+            elif tag == "meta":
+                if meta.get("name") and meta.get("content"):
+                    metadata["cover"] = meta.get("content")
+        return metadata
+
+    @cached_property
+    def manifest(self):
+        # 按 OPF 中的顺序登记 manifest，重复 id 以后出现者为准
+        id_to_h_m_p = {}  # { id : (href,mime,properties) , ... }
+        href_to_id = {}  # { href.lower : id, ...}
+        if_error = False
+        for item in self.etree_opf["manifest"]:
+            # 检查opf文件中是否存在错误
+            try:
+                id = item.get("id")
+                href = unquote(item.get("href"))
+            except Exception as e:
+                str_item = (
+                    ElementTree.tostring(item, encoding="unicode")
+                    .replace("\n", "")
+                    .replace("\r", "")
+                    .replace("\t", "")
+                )
+                logger.write(f"item: {str_item} error: {e}")
+                if_error = True
+                continue
+            mime = item.get("media-type")
+            properties = item.get("properties") if item.get("properties") else ""
+
+            id_to_h_m_p[id] = (href, mime, properties)
+            href_to_id[href.lower()] = id
+        if if_error:
+            logger.write("opf文件中存在错误，请检查！")
+        return id_to_h_m_p, href_to_id
+
+    @property
+    def id_to_h_m_p(self):
+        return self.manifest[0]
+
+    @property
+    def href_to_id(self):
+        return self.manifest[1]
+
+    @cached_property
+    def id_to_href(self):
+        return {id: href for id, (href, mime, prop) in self.id_to_h_m_p.items()}
+
+    @cached_property
+    def href_to_mime(self):
+        # { href.lower : mime }
+        return {
+            href.lower(): mime for id, (href, mime, prop) in self.id_to_h_m_p.items()
+        }
+
+    @cached_property
+    def spine_list(self):
+        spine_list = []  # [ (sid, linear, properties) , ... ]
+        for itemref in self.etree_opf["spine"]:
+            sid = itemref.get("idref")
+            linear = itemref.get("linear") if itemref.get("linear") else ""
+            properties = itemref.get("properties") if itemref.get("properties") else ""
+            spine_list.append((sid, linear, properties))
+        return spine_list
+
+    def href_to_bookpath(self, href):
+        # OPF 中的 href 转为压缩包内路径
+        return self.paths.bookpath(href, self.opfpath)
+
+
+# ---------- 路径解析 ----------
+
+
+class PathIndex:
+    """压缩包内的路径解析: 缓存 (href, 引用文件所在目录) -> bookpath 及相对路径的计算结果，
+    并由 namelist 一次性建立小写路径索引，大小写无关的查找为 O(1)。解析出的路径经 sys.intern 复用"""
+
+    def __init__(self, namelist):
+        self.name_set = set(namelist)
+        self.lower_to_path = {}  # { 小写路径 : 原始路径 }，大小写冲突时以先出现者为准
+        for name in namelist:
+            self.lower_to_path.setdefault(name.lower(), name)
+        self._bookpaths = {}  # { (href, 引用文件所在目录) : bookpath }
+        self._relpaths = {}  # { (from_path, to_path) : 相对路径 }
+
+    def bookpath(self, href, refer_bkpath):
+        # 与 get_bookpath 相同；结果只取决于引用文件所在的目录，同目录的文件共用缓存
+        key = (href, _refer_dir(refer_bkpath))
+        try:
+            return self._bookpaths[key]
+        except KeyError:
+            result = self._bookpaths[key] = sys.intern(get_bookpath(href, refer_bkpath))
+            return result
+
+    def relpath(self, from_path, to_path):
+        key = (from_path, to_path)
+        try:
+            return self._relpaths[key]
+        except KeyError:
+            result = self._relpaths[key] = get_relpath(from_path, to_path)
+            return result
+
+    def real_path(self, bkpath):
+        if bkpath in self.name_set:
+            return bkpath
+        return self.lower_to_path.get(bkpath.lower())
+
+    @staticmethod
+    def normpath(bkpath):
+        return normalize_bookpath(bkpath)
+
+
+def _refer_dir(refer_bkpath):
+    # get_bookpath 按 / 和 \ 切分引用路径并丢弃最后一段；不含分隔符时返回 None (与空目录区分)
+    i = max(refer_bkpath.rfind("/"), refer_bkpath.rfind("\\"))
+    return refer_bkpath[:i] if i >= 0 else None
+
+
+@lru_cache(maxsize=4096)
+def normalize_bookpath(bkpath):
+    # 处理路径中任意位置的 . 和 ..，分隔符为 /
+    stack = []
+    for part in bkpath.split("/"):
+        if part == "..":
+            if stack:
+                stack.pop()
+        elif part != ".":
+            stack.append(part)
+    return "/".join(stack)
+
+
+# ---------- 成员原样复制 ----------
+
+_COPY_CHUNK = 1 << 20
+_FLAG_ENCRYPTED = 0x1
+_FLAG_DATA_DESCRIPTOR = 0x8
+_ZIP64_EXTRA_ID = 0x0001
+
+
+def _strip_zip64_extra(extra):
+    # 去掉源文件中的 ZIP64 扩展字段，写入时按需重新生成
+    result = b""
+    i = 0
+    while i + 4 <= len(extra):
+        tag, size = struct.unpack("<HH", extra[i : i + 4])
+        if tag != _ZIP64_EXTRA_ID:
+            result += extra[i : i + 4 + size]
+        i += 4 + size
+    return result
+
+
+# 原样复制依赖 zipfile 的内部实现 (ZipFile 的 fp/_lock/_seekable/_writing/start_dir/_didModify/_writecheck
+# 及本地文件头常量)，这些可能随 CPython 版本变化 (已在 3.8~3.13 上验证)。首次使用时检查这些接口
+# 并在内存中试复制一次，不可用时所有成员退回 stream_member (按块解压再写入)
+_ZIPFILE_STATE = ("fp", "_lock", "_seekable", "_writing", "start_dir", "_didModify", "filelist", "NameToInfo")
+
+
+@lru_cache(maxsize=None)
+def raw_copy_supported():
+    required = ("sizeFileHeader", "structFileHeader", "stringFileHeader")
+    if not all(hasattr(zipfile, name) for name in required) or not (
+        hasattr(zipfile.ZipFile, "_writecheck") and hasattr(zipfile.ZipInfo, "FileHeader")
+    ):
+        logger.write(f"当前 Python ({sys.version.split()[0]}) 的 zipfile 不支持原样复制成员，改为解压后写入")
+        return False
+    try:
+        source = io.BytesIO()
+        with zipfile.ZipFile(source, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr("a.txt", b"epub_tool" * 64)
+            z.writestr("b.txt", b"raw copy")
+        target = io.BytesIO()
+        with zipfile.ZipFile(source) as zin, zipfile.ZipFile(target, "w") as zout:
+            for info in zin.infolist():
+                _raw_copy(zin, zout, info)
+        with zipfile.ZipFile(target) as z:
+            ok = z.testzip() is None and z.read("a.txt") == b"epub_tool" * 64 and z.read("b.txt") == b"raw copy"
+    except Exception as e:
+        logger.write(f"zipfile 原样复制自检失败，改为解压后写入: {e}")
+        return False
+    if not ok:
+        logger.write("zipfile 原样复制自检结果不符，改为解压后写入")
+    return ok
+
+
+def copy_member(zin, zout, member):
+    """把 zin 中未修改的成员原样写入 zout：直接搬运已压缩的数据及其 CRC/大小，不解压也不重新压缩。
+    member 为路径或 ZipInfo；加密成员、目标不可随机写入或 zipfile 不支持时退回按块解压再写入"""
+    info = member if isinstance(member, zipfile.ZipInfo) else zin.getinfo(member)
+    if (
+        info.flag_bits & _FLAG_ENCRYPTED
+        or not all(hasattr(z, name) for z in (zin, zout) for name in _ZIPFILE_STATE)
+        or not zout._seekable
+        or not raw_copy_supported()
+    ):
+        stream_member(zin, zout, info)
+        return
+    _raw_copy(zin, zout, info)
+
+
+def _raw_copy(zin, zout, info):
+    zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.comment = info.comment
+    zinfo.extra = _strip_zip64_extra(info.extra)
+    zinfo.create_system = info.create_system
+    zinfo.create_version = info.create_version
+    zinfo.extract_version = info.extract_version
+    zinfo.external_attr = info.external_attr
+    zinfo.flag_bits = info.flag_bits & ~_FLAG_DATA_DESCRIPTOR
+    zinfo.CRC = info.CRC
+    zinfo.compress_size = info.compress_size
+    zinfo.file_size = info.file_size
+
+    with zin._lock, zout._lock:
+        if zout._writing:
+            raise ValueError("Can't write to the ZIP file while there is another write handle open on it.")
+        # 跳过源文件的本地文件头 (文件名与扩展字段长度可能与中央目录中不同)
+        zin.fp.seek(info.header_offset)
+        header = zin.fp.read(zipfile.sizeFileHeader)
+        if len(header) != zipfile.sizeFileHeader:
+            raise zipfile.BadZipFile("Truncated file header")
+        fields = struct.unpack(zipfile.structFileHeader, header)
+        if fields[0] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile("Bad magic number for file header")
+        zin.fp.seek(fields[-2] + fields[-1], 1)
+
+        zout.fp.seek(zout.start_dir)
+        zinfo.header_offset = zout.fp.tell()
+        zout._writecheck(zinfo)
+        zout._didModify = True
+        zout.fp.write(zinfo.FileHeader())
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = zin.fp.read(min(_COPY_CHUNK, remaining))
+            if not chunk:
+                raise EOFError(f"{info.filename} 数据不完整")
+            zout.fp.write(chunk)
+            remaining -= len(chunk)
+        zout.start_dir = zout.fp.tell()
+        zout.filelist.append(zinfo)
+        zout.NameToInfo[zinfo.filename] = zinfo
+
+
+# 相对路径计算函数
+def get_relpath(from_path, to_path):
+    # from_path 和 to_path 都需要是绝对路径
+    from_path = re.split(r"[\\/]", from_path)
+    to_path = re.split(r"[\\/]", to_path)
+    while from_path[0] == to_path[0]:
+        from_path.pop(0), to_path.pop(0)
+    to_path = "../" * (len(from_path) - 1) + "/".join(to_path)
+    return to_path
+
+
+# 计算bookpath
+def get_bookpath(relative_path, refer_bkpath):
+    # relative_path 相对路径，一般是href
+    # refer_bkpath 参考的绝对路径
+
+    relative_ = re.split(r"[\\/]", relative_path)
+    refer_ = re.split(r"[\\/]", refer_bkpath)
+
+    back_step = 0
+    while relative_[0] == "..":
+        back_step += 1
+        relative_.pop(0)
+
+    if len(refer_) <= 1:
+        return "/".join(relative_)
+    else:
+        refer_.pop(-1)
+
+    if back_step < 1:
+        return "/".join(refer_ + relative_)
+    elif back_step > len(refer_):
+        return "/".join(relative_)
+
+    # len(refer_) > 1 and back_setp <= len(refer_):
+    while back_step > 0 and len(refer_) > 0:
+        refer_.pop(-1)
+        back_step -= 1
+
+    return "/".join(refer_ + relative_)
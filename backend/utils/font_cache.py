@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# 字体子集的磁盘缓存
+#
+# 同一系列的书籍通常使用相同的商业字体，用字也大量重合。开启后以 (字体 SHA-256, 排序后的码位, 子集化选项)
+# 为键保存子集化结果，再次遇到相同的字体与用字时直接读取，不再调用 fontTools 的 subsetter。
+# 允许使用超集 (font_cache_superset) 时，同一字体已缓存的子集只要包含全部所需的字，也直接使用；
+# 结果会多出一些字形，但省去子集化。按最近使用时间淘汰，总大小不超过上限 (font_cache_size，单位 MB)。
+#
+#     python cli.py font_subset --input a.epub --output out --extra '{"font_cache": "~/.epub_tool_cache/fonts"}'
+#     python cli.py font_subset --input a.epub --output out --extra '{"font_cache": "...", "font_cache_superset": true}'
+#
+# 目录结构: <缓存目录>/<字体 SHA-256>/<子集键>.ttf 及同名的 .chars (所含的字，UTF-8)
+
+import hashlib
+import os
+import tempfile
+
+try:
+    from utils.log import logwriter
+    from utils.result_cache import parse_size
+except ImportError:
+    from log import logwriter
+    from result_cache import parse_size
+
+logger = logwriter()
+
+FONT_SUFFIX = ".ttf"
+CHARS_SUFFIX = ".chars"
+
+
+def open_font_cache(cache_dir, superset=False, max_size=None):
+    # cache_dir 为 --extra 中的 font_cache，为空时不启用
+    if not cache_dir:
+        return None
+    return FontCache(os.path.expanduser(cache_dir), superset, parse_size(max_size))
+
+
+class FontCache:
+    """可传入工作进程: 只保存路径与选项，读写都是独立的文件操作"""
+
+    def __init__(self, cache_dir, superset=False, max_size=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.superset = superset
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def font_dir(self, font_data):
+        return os.path.join(self.cache_dir, hashlib.sha256(font_data).hexdigest())
+
+    def subset_key(self, chars, options_key):
+        return hashlib.sha256(f"{options_key}\n{chars}".encode("utf-8")).hexdigest()
+
+    def get(self, font_data, text, options_key):
+        """返回缓存的子集；未命中时返回 None"""
+        chars = sorted_chars(text)
+        font_dir = self.font_dir(font_data)
+        data = self._read(os.path.join(font_dir, self.subset_key(chars, options_key) + FONT_SUFFIX))
+        if data is None and self.superset:
+            data = self._read_superset(font_dir, set(chars), options_key)
+        return data
+
+    def put(self, font_data, text, options_key, subset_data):
+        # 先写临时文件再改名，多个进程同时写入同一项时结果相同，保留任意一份即可
+        chars = sorted_chars(text)
+        font_dir = self.font_dir(font_data)
+        name = self.subset_key(chars, options_key)
+        try:
+            os.makedirs(font_dir, exist_ok=True)
+            self._write(os.path.join(font_dir, name + CHARS_SUFFIX), f"{options_key}\n{chars}".encode("utf-8"))
+            self._write(os.path.join(font_dir, name + FONT_SUFFIX), subset_data)
+        except OSError as e:
+            logger.write(f"写入字体子集缓存失败: {e}")
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # 以修改时间记录最近使用时间
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def _read_superset(self, font_dir, chars, options_key):
+        # 同一字体、相同选项、包含全部所需字符的子集中最小的一个
+        best = None
+        try:
+            entries = [entry for entry in os.scandir(font_dir) if entry.name.endswith(CHARS_SUFFIX)]
+        except OSError:
+            return None
+        for entry in entries:
+            try:
+                with open(entry.path, encoding="utf-8") as f:
+                    cached_options, cached_chars = f.read().split("\n", 1)
+                font_path = entry.path[: -len(CHARS_SUFFIX)] + FONT_SUFFIX
+                size = os.path.getsize(font_path)
+            except (OSError, ValueError):
+                continue
+            if cached_options != options_key or not chars.issubset(cached_chars):
+                continue
+            if best is None or size < best[0]:
+                best = (size, font_path)
+        if best is None:
+            return None
+        return self._read(best[1])
+
+    def _write(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def evict(self):
+        # 按最近使用时间从旧到新删除子集，直到总大小不超过上限
+        entries = []
+        total = 0
+        for font_dir in os.scandir(self.cache_dir):
+            if not font_dir.is_dir():
+                continue
+            for entry in os.scandir(font_dir.path):
+                if not entry.name.endswith(FONT_SUFFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            for file in (path, path[: -len(FONT_SUFFIX)] + CHARS_SUFFIX):
+                try:
+                    os.remove(file)
+                except OSError:
+                    pass
+            total -= size
+
+
+def sorted_chars(text):
+    # 与出现顺序无关的字符集合表示
+    return "".join(sorted(set(text)))
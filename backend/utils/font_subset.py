@@ -3,7 +3,7 @@ import os
 from bs4 import BeautifulSoup
 from tinycss2 import parse_stylesheet, serialize, parse_declaration_list
 import re
-from fontTools import subset
+from fontTools import subset, version as fonttools_version
 from fontTools.ttLib import TTFont
 from io import BytesIO
 import traceback
@@ -11,18 +11,211 @@ import logging
 
 try:
     from utils.log import logwriter
+    from utils.epub_container import EpubContainer, normalize_bookpath
+    from utils.html_engine import get_engine
+    from utils.parallel import OrderedExecutor
+    from utils.font_cache import open_font_cache
+    from utils import progress
 except ImportError:
     from log import logwriter
+    from epub_container import EpubContainer, normalize_bookpath
+    from html_engine import get_engine
+    from parallel import OrderedExecutor
+    from font_cache import open_font_cache
+    import progress
 
 logger = logwriter()
 
+
+def split_selectors(selector):
+    # 按顶层逗号拆分选择器列表
+    parts, depth, start = [], 0, 0
+    for i, char in enumerate(selector):
+        if char in "([":
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+        elif char == "," and depth == 0:
+            parts.append(selector[start:i].strip())
+            start = i + 1
+    parts.append(selector[start:].strip())
+    return [part for part in parts if part]
+
+
+def primary_font_family(declarations):
+    # font-family 声明中的第一个字体名
+    for declaration in declarations:
+        if declaration.type == "declaration" and declaration.lower_name == "font-family":
+            for token in declaration.value:
+                if token.type == "string" or token.type == "ident":
+                    return token.value.strip("'\"")
+    return None
+
+
+class FontRules:
+    """按 CSS 规则及 style 属性求元素生效的字体文件。
+    只含标签、class、id 的简单选择器按索引查找，其余交给解析引擎匹配"""
+
+    SIMPLE_SELECTOR = re.compile(r"(\*|[A-Za-z][\w-]*)?((?:[.#][\w-]+)*)")
+    PSEUDO_ELEMENT = re.compile(r"::?(?:first-letter|first-line|before|after|selection|marker)\b", re.I)
+    # 不显示为正文的元素
+    SKIP_TAGS = ("head", "script", "style")
+
+    def __init__(self, selector_to_font, family_to_font):
+        self.family_to_font = family_to_font
+        self.by_key = {}  # { 标签名 / ".class" / "#id" / "*" : [ (标签名, class 列表, id, 字体) , ... ] }
+        self.complex = []  # [ (选择器, 字体, 是否只作用于部分文字) , ... ]
+        self.styles = {}  # { style 属性 : 字体 }
+        self.fonts_cache = {}
+        for selector, font in selector_to_font.items():
+            for part in split_selectors(selector):
+                self.add(part, font)
+
+    def add(self, selector, font):
+        match = self.SIMPLE_SELECTOR.fullmatch(selector)
+        if not match:
+            # 伪元素只作用于元素的部分文字: 按元素本身匹配，字体与继承的字体一并计入 (宁多勿漏)
+            stripped = self.PSEUDO_ELEMENT.sub("", selector)
+            self.complex.append((stripped or "*", font, stripped != selector))
+            return
+        tag = match.group(1)
+        tag = None if tag in (None, "*") else tag.lower()
+        names = re.findall(r"[.#][\w-]+", match.group(2))
+        classes = [name[1:] for name in names if name[0] == "."]
+        ids = [name[1:] for name in names if name[0] == "#"]
+        if len(ids) > 1:
+            return
+        element_id = ids[0] if ids else None
+        if element_id:
+            key = "#" + element_id
+        elif classes:
+            key = "." + classes[0]
+        else:
+            key = tag or "*"
+        self.by_key.setdefault(key, []).append((tag, classes, element_id, font))
+
+    def style_font(self, style):
+        # style 属性中 font-family 指定的字体文件，未指定或不是书中的字体时为 None
+        if style not in self.styles:
+            family = primary_font_family(parse_declaration_list(style))
+            self.styles[style] = self.family_to_font.get(family)
+        return self.styles[style]
+
+    def collect(self, engine, doc):
+        """返回 { 字体文件集合 : 使用这些字体的文字 }"""
+        complex_rules = []
+        for selector, font, partial in self.complex:
+            try:
+                complex_rules.append((engine.matcher(doc, selector), font, partial))
+            except ValueError as e:
+                logger.write(f"无法解析CSS选择器 {selector}，已忽略: {str(e).splitlines()[0]}")
+        texts = {}
+        stack = [frozenset()]
+        for event in engine.walk(doc, self.SKIP_TAGS):
+            kind = event[0]
+            if kind == "text":
+                fonts = stack[-1]
+                if fonts and not event[1].isspace():
+                    texts.setdefault(fonts, []).append(event[1])
+            elif kind == "start":
+                fonts, partial = self.element_fonts(event, complex_rules)
+                fonts = stack[-1] if fonts is None else fonts
+                stack.append(self.intern(fonts.union(partial)) if partial else fonts)
+            else:
+                stack.pop()
+        return {fonts: "".join(parts) for fonts, parts in texts.items()}
+
+    def element_fonts(self, event, complex_rules):
+        # 返回 (元素自身匹配的字体集合, 伪元素等只作用于部分文字的字体)，前者未匹配任何规则时为 None (继承父元素)
+        _, element, tag, classes, element_id, style = event
+        tag = tag.lower()
+        if style and "font-family" in style.lower():
+            font = self.style_font(style)
+            if font is not None:
+                return self.intern((font,)), ()
+        fonts = []
+        partial = []
+        by_key = self.by_key
+        candidates = []
+        for key in [tag, "*"] + ["." + name for name in classes] + (["#" + element_id] if element_id else []):
+            candidates.extend(by_key.get(key, ()))
+        for rule_tag, rule_classes, rule_id, font in candidates:
+            if rule_tag is not None and rule_tag != tag:
+                continue
+            if rule_id is not None and rule_id != element_id:
+                continue
+            if any(name not in classes for name in rule_classes):
+                continue
+            fonts.append(font)
+        for match, font, is_partial in complex_rules:
+            if match(element):
+                (partial if is_partial else fonts).append(font)
+        return (self.intern(fonts) if fonts else None), partial
+
+    def intern(self, fonts):
+        # 相同的字体集合共用同一个 frozenset
+        fonts = frozenset(fonts)
+        return self.fonts_cache.setdefault(fonts, fonts)
+
+
+def subset_options():
+    options = subset.Options()
+    options.flavor = None # 保持原有 flavor (ttf/otf)
+    # 保留常用表，去除不需要的
+    # options.drop_tables = [] 
+    return options
+
+
+def options_key(options):
+    # 子集缓存键中的选项部分: fontTools 版本及全部选项
+    return fonttools_version + ";" + repr(sorted(vars(options).items()))
+
+
+def subset_font_data(font_path, font_data, text, cache=None):
+    """返回子集化后的字体数据；失败时返回原数据。模块级函数，可在进程池中执行"""
+    try:
+        options = subset_options()
+        if cache is not None:
+            key = options_key(options)
+            cached = cache.get(font_data, text, key)
+            if cached is not None:
+                logger.write(f"字体 {font_path} 使用缓存的子集")
+                return cached
+
+        font = TTFont(BytesIO(font_data))
+
+        # 配置 subsetter
+        subsetter = subset.Subsetter(options=options)
+        subsetter.populate(text=text)
+        subsetter.subset(font)
+
+        # 保存 subset 后的字体
+        font_stream = BytesIO()
+        font.save(font_stream)
+        logger.write(f"字体 {font_path} 子集化完成")
+        if cache is not None:
+            cache.put(font_data, text, key, font_stream.getvalue())
+        return font_stream.getvalue()
+
+    except Exception as e:
+        logger.write(f"字体 {font_path} 子集化失败: {e}")
+        traceback.print_exc()
+        # 失败则写入原文件
+        return font_data
+
+
 class FontSubset:
-    def __init__(self, epub_path, output_path):
+    def __init__(self, epub_path, output_path, html_engine=None, workers=1, font_cache=None):
         if not os.path.exists(epub_path):
             raise Exception("EPUB文件不存在")
 
+        # 统计用字只查询不修改文档，可使用只读引擎，见 html_engine.py
+        self.engine = get_engine(html_engine)
+        self.workers = workers  # 并行子集化字体的进程数
+        self.font_cache = font_cache  # 字体子集缓存 (FontCache)，见 font_cache.py
         self.epub_path = os.path.normpath(epub_path)
-        self.epub = zipfile.ZipFile(epub_path)
+        self.container = EpubContainer(epub_path)
+        self.epub = self.container.epub
         
         if output_path and os.path.exists(output_path):
             if os.path.isfile(output_path):
@@ -40,16 +233,20 @@ class FontSubset:
         if os.path.exists(self.file_write_path):
             os.remove(self.file_write_path)
             
+        self.target_epub = None
+        self.init_files(self.container.namelist)
+
+    def init_files(self, namelist):
         self.htmls = []
         self.css = []
         self.fonts = []
+        self.font_by_basename = {}  # { 字体文件名 : 字体路径 }，同名时以后出现者为准
         self.ori_files = []
         self.font_to_font_family_mapping = {}
         self.css_selector_to_font_mapping = {}
         self.font_to_char_mapping = {}
-        self.target_epub = None
         
-        for file in self.epub.namelist():
+        for file in namelist:
             if file.lower().endswith((".html", ".xhtml")):
                 self.htmls.append(file)
             elif file.lower().endswith(".css"):
@@ -57,10 +254,12 @@ class FontSubset:
                 self.css.append(file)
             elif file.lower().endswith((".ttf", ".otf", ".woff")):
                 self.fonts.append(file)
+                self.font_by_basename[os.path.basename(file)] = file
             else:
                 self.ori_files.append(file)
 
     def create_target_epub(self):
+        progress.output_file(self.file_write_path)
         self.target_epub = zipfile.ZipFile(
             self.file_write_path,
             "w",
@@ -95,9 +294,8 @@ class FontSubset:
                             for url in src_urls:
                                 # 尝试匹配文件名
                                 url_basename = os.path.basename(url).split('?')[0].split('#')[0]
-                                for font_path in self.fonts:
-                                    if os.path.basename(font_path) == url_basename:
-                                        mapping[font_family] = font_path
+                                if url_basename in self.font_by_basename:
+                                    mapping[font_family] = self.font_by_basename[url_basename]
                                         
         self.font_to_font_family_mapping = mapping
 
@@ -113,40 +311,38 @@ class FontSubset:
                         declarations = parse_declaration_list(rule.content)
                         for declaration in declarations:
                             if declaration.type == "declaration" and declaration.lower_name == "font-family":
-                                font_family_values = [
-                                    token.value
-                                    for token in declaration.value
-                                    if token.type == "string" or token.type == "ident"
-                                ]
-                                if font_family_values:
-                                    primary_font = font_family_values[0].strip("'\"")
+                                primary_font = primary_font_family([declaration])
+                                if primary_font:
                                     if primary_font in self.font_to_font_family_mapping:
                                         if primary_font not in mapping:
                                             mapping[selector] = self.font_to_font_family_mapping[primary_font]
         self.css_selector_to_font_mapping = dict(sorted(mapping.items(), reverse=True))
 
+    def member_size(self, name):
+        # 成员在压缩包中的大小 (进度报告用)
+        return self.container.getinfo(name).compress_size
+
+    def read_document(self, one_html):
+        with self.epub.open(one_html) as f:
+            content = f.read().decode("utf-8")
+        return self.engine.parse(content)
+
     def find_char_mapping(self):
+        # 每个文档只遍历一次: 按 CSS 规则及 style 属性求出每个元素生效的字体 (未指定时继承父元素)，
+        # 文本节点的字计入生效的字体。同一元素匹配多条规则时计入全部字体，宁多勿漏
         mapping = {}
-        # 初始化所有字体文件的字符集为空字符串
+        # 初始化所有字体文件的字符集为空集合
         for font in self.fonts:
             mapping[font] = set()
+        rules = FontRules(self.css_selector_to_font_mapping, self.font_to_font_family_mapping)
 
-        for one_html in self.htmls:
-            with self.epub.open(one_html) as f:
-                content = f.read().decode("utf-8")
-                soup = BeautifulSoup(content, "html.parser")
-                
-                # 1. 按照 CSS 选择器查找
-                for css_selector, font_file in self.css_selector_to_font_mapping.items():
-                    elements = soup.select(css_selector)
-                    for element in elements:
-                        text = element.get_text(strip=True)
+        with progress.stage("scan", len(self.htmls)) as stage:
+            for one_html in self.htmls:
+                doc = self.read_document(one_html)
+                for fonts, text in rules.collect(self.engine, doc).items():
+                    for font_file in fonts:
                         mapping[font_file].update(text)
-                
-                # TODO: 这里可能漏掉没有特定 class 但继承了 font-family 的文本
-                # 或者直接定义在 style 属性里的 font-family
-                # 为了保险起见，如果字体被全局应用（如 body），应该包含所有文本
-                # 目前逻辑仅处理 explicit selector mapping，类似 encrypt_font 的逻辑
+                stage.advance(read=self.member_size(one_html))
 
         self.font_to_char_mapping = mapping
 
@@ -154,130 +350,133 @@ class FontSubset:
         self.find_local_fonts_mapping()
         self.find_selector_to_font_mapping()
         self.find_char_mapping()
-        logger.write(f"字体文件映射: {self.font_to_font_family_mapping}")
-        logger.write(f"CSS选择器映射: {self.css_selector_to_font_mapping}")
+        logger.debug("字体文件映射: %s", self.font_to_font_family_mapping)
+        logger.debug("CSS选择器映射: %s", self.css_selector_to_font_mapping)
         # logger.write(f"字体文件到字符映射: {self.font_to_char_mapping}") # 可能太大，不打印
         return self.font_to_char_mapping
 
+    def font_text(self, font_path):
+        """字体用到的文字；未被使用时返回 None"""
+        if not (font_path in self.font_to_char_mapping and self.font_to_char_mapping[font_path]):
+            logger.write(f"字体 {font_path} 未检测到使用文本，从EPUB中移除")
+            return None
+
+        text = "".join(self.font_to_char_mapping[font_path])
+        logger.write(f"正在处理字体: {font_path}, 字符数: {len(text)}")
+        return text
+
+    def subset_font(self, font_path):
+        """返回子集化后的字体数据；字体未被使用时返回 None"""
+        text = self.font_text(font_path)
+        if text is None:
+            return None
+        return subset_font_data(font_path, self.epub.read(font_path), text, self.font_cache)
+
+    def subset_all(self):
+        """按字体顺序产出 (字体路径, 子集化后的数据)，未被使用的字体数据为 None。
+        各字体在进程池中并行子集化，读取与写回留在调用方"""
+        with OrderedExecutor(self.workers) as executor:
+            for font_path in self.fonts:
+                text = self.font_text(font_path)
+                if text is None:
+                    executor.put(font_path, None)
+                else:
+                    executor.submit(
+                        font_path, subset_font_data, font_path, self.epub.read(font_path), text, self.font_cache
+                    )
+                yield from executor.results()
+            yield from executor.results(wait=True)
+        if self.font_cache is not None:
+            self.font_cache.evict()
+
+    def remove_fonts_from_opf(self, file, content, removed_fonts):
+        """从 OPF 中移除被删除字体的 manifest item，返回修改后的 OPF；无需修改时返回 None"""
+        try:
+            soup = BeautifulSoup(content, 'xml')
+            manifest = soup.find('manifest')
+            if manifest:
+                items_to_remove = []
+                for item in manifest.find_all('item'):
+                    href = item.get('href')
+                    if href:
+                        # 解析相对路径。OPF 中的 href 是相对于 OPF 文件所在目录的
+                        opf_dir = os.path.dirname(file)
+                        # 注意：EPUB 路径分隔符为 /，需要确保处理正确
+                        abs_href = opf_dir + '/' + href if opf_dir else href
+                        # 简单规范化路径（处理 .. 等）
+                        # 这里我们简单模拟，因为 zipfile 里的路径通常是规范的
+                        # 如果 abs_href 匹配 removed_fonts 中的某一项
+                        # 考虑到路径可能包含 ..，我们尝试匹配文件名或者使用更复杂的解析
+                        # 这里为了健壮性，我们尝试多种匹配
+
+                        # 1. 直接匹配
+                        if abs_href in removed_fonts:
+                            items_to_remove.append(item)
+                            continue
+
+                        # 2. 处理规范化路径 (Python os.path.normpath 在 Windows 下用 \，所以要小心)
+                        norm_abs_href = normalize_bookpath(abs_href)
+                        if norm_abs_href in removed_fonts:
+                            items_to_remove.append(item)
+                            continue
+
+                        # 3. 尝试匹配文件名（如果结构简单）
+                        # 如果字体文件名唯一，这通常有效
+                        font_name = os.path.basename(href)
+                        for rm_font in removed_fonts:
+                            if os.path.basename(rm_font) == font_name:
+                                # 再次确认路径后缀匹配，防止误删同名文件
+                                if rm_font.endswith(href):
+                                    items_to_remove.append(item)
+                                    break
+
+                if items_to_remove:
+                    logger.write(f"从OPF中移除 {len(items_to_remove)} 个无效字体引用")
+                    for item in items_to_remove:
+                        item.decompose()
+
+                    return str(soup)
+
+        except Exception as e:
+            logger.write(f"清理OPF失败: {e}，将写入原始OPF")
+            traceback.print_exc()
+        return None
+
     def subset_fonts(self):
         self.create_target_epub()
         
         removed_fonts = set()
         
         # 处理字体文件
-        for font_path in self.fonts:
-            if font_path in self.font_to_char_mapping and self.font_to_char_mapping[font_path]:
-                text = "".join(self.font_to_char_mapping[font_path])
-                logger.write(f"正在处理字体: {font_path}, 字符数: {len(text)}")
-                
-                try:
-                    # 读取原始字体
-                    font_data = self.epub.read(font_path)
-                    font = TTFont(BytesIO(font_data))
-                    
-                    # 配置 subsetter
-                    options = subset.Options()
-                    options.flavor = None # 保持原有 flavor (ttf/otf)
-                    # 保留常用表，去除不需要的
-                    # options.drop_tables = [] 
-                    
-                    subsetter = subset.Subsetter(options=options)
-                    subsetter.populate(text=text)
-                    subsetter.subset(font)
-                    
-                    # 保存 subset 后的字体
-                    font_stream = BytesIO()
-                    font.save(font_stream)
-                    self.target_epub.writestr(font_path, font_stream.getvalue(), zipfile.ZIP_DEFLATED)
-                    logger.write(f"字体 {font_path} 子集化完成")
-                    
-                except Exception as e:
-                    logger.write(f"字体 {font_path} 子集化失败: {e}")
-                    traceback.print_exc()
-                    # 失败则写入原文件
-                    self.target_epub.writestr(font_path, self.epub.read(font_path), zipfile.ZIP_DEFLATED)
-            else:
-                logger.write(f"字体 {font_path} 未检测到使用文本，从EPUB中移除")
-                removed_fonts.add(font_path)
-                # 不写入 target_epub，即删除
-
-        # 复制其他文件
-        for file in self.ori_files:
-            # 如果是 OPF 文件，需要移除被删除的字体 manifest item
-            if file.lower().endswith(".opf") and removed_fonts:
-                content = self.epub.read(file).decode('utf-8')
-                try:
-                    soup = BeautifulSoup(content, 'xml')
-                    manifest = soup.find('manifest')
-                    if manifest:
-                        items_to_remove = []
-                        for item in manifest.find_all('item'):
-                            href = item.get('href')
-                            if href:
-                                # 解析相对路径。OPF 中的 href 是相对于 OPF 文件所在目录的
-                                opf_dir = os.path.dirname(file)
-                                # 注意：EPUB 路径分隔符为 /，需要确保处理正确
-                                abs_href = opf_dir + '/' + href if opf_dir else href
-                                # 简单规范化路径（处理 .. 等）
-                                # 这里我们简单模拟，因为 zipfile 里的路径通常是规范的
-                                # 如果 abs_href 匹配 removed_fonts 中的某一项
-                                # 考虑到路径可能包含 ..，我们尝试匹配文件名或者使用更复杂的解析
-                                # 这里为了健壮性，我们尝试多种匹配
-                                
-                                # 1. 直接匹配
-                                if abs_href in removed_fonts:
-                                    items_to_remove.append(item)
-                                    continue
-                                    
-                                # 2. 处理规范化路径 (Python os.path.normpath 在 Windows 下用 \，所以要小心)
-                                # 我们可以自己写个简单的 normpath for url
-                                def simple_normpath(path):
-                                    parts = path.split('/')
-                                    stack = []
-                                    for part in parts:
-                                        if part == '..':
-                                            if stack: stack.pop()
-                                        elif part == '.':
-                                            continue
-                                        else:
-                                            stack.append(part)
-                                    return '/'.join(stack)
-                                    
-                                norm_abs_href = simple_normpath(abs_href)
-                                if norm_abs_href in removed_fonts:
-                                    items_to_remove.append(item)
-                                    continue
-                                    
-                                # 3. 尝试匹配文件名（如果结构简单）
-                                # 如果字体文件名唯一，这通常有效
-                                font_name = os.path.basename(href)
-                                for rm_font in removed_fonts:
-                                    if os.path.basename(rm_font) == font_name:
-                                        # 再次确认路径后缀匹配，防止误删同名文件
-                                        if rm_font.endswith(href):
-                                            items_to_remove.append(item)
-                                            break
-                        
-                        if items_to_remove:
-                            logger.write(f"从OPF中移除 {len(items_to_remove)} 个无效字体引用")
-                            for item in items_to_remove:
-                                item.decompose()
-                            
-                            # 写入修改后的 OPF
-                            self.target_epub.writestr(file, str(soup).encode('utf-8'), zipfile.ZIP_DEFLATED)
-                            continue
+        with progress.stage("subset", len(self.fonts), self.target_epub) as stage:
+            for font_path, font_data in self.subset_all():
+                stage.advance(read=self.member_size(font_path))
+                if font_data is None:
+                    removed_fonts.add(font_path)
+                    # 不写入 target_epub，即删除
+                else:
+                    self.target_epub.writestr(font_path, font_data, zipfile.ZIP_DEFLATED)
+
+        with progress.stage("copy", len(self.ori_files) + len(self.htmls), self.target_epub) as stage:
+            # 复制其他文件
+            for file in self.ori_files:
+                stage.advance(read=self.member_size(file))
+                # 如果是 OPF 文件，需要移除被删除的字体 manifest item
+                if file.lower().endswith(".opf") and removed_fonts:
+                    opf = self.remove_fonts_from_opf(file, self.epub.read(file).decode('utf-8'), removed_fonts)
+                    if opf is not None:
+                        # 写入修改后的 OPF
+                        self.target_epub.writestr(file, opf.encode('utf-8'), zipfile.ZIP_DEFLATED)
+                        continue
+
+                # 默认情况：直接复制
+                self.container.copy_to(self.target_epub, file)
+
+            # 复制 HTML 文件 (无需修改内容)
+            for file in self.htmls:
+                stage.advance(read=self.member_size(file))
+                self.container.copy_to(self.target_epub, file)
 
-                except Exception as e:
-                    logger.write(f"清理OPF失败: {e}，将写入原始OPF")
-                    traceback.print_exc()
-            
-            # 默认情况：直接复制
-            self.target_epub.writestr(file, self.epub.read(file), zipfile.ZIP_DEFLATED)
-            
-        # 复制 HTML 文件 (无需修改内容)
-        for file in self.htmls:
-            self.target_epub.writestr(file, self.epub.read(file), zipfile.ZIP_DEFLATED)
-            
         self.close_file()
         logger.write(f"EPUB字体子集化完成，输出路径: {self.file_write_path}")
 
@@ -292,9 +491,13 @@ class FontSubset:
             os.remove(self.file_write_path)
             logger.write(f"删除临时文件: {self.file_write_path}")
 
-def run_epub_font_subset(epub_path, output_path=None):
+def run_epub_font_subset(
+    epub_path, output_path=None, html_engine=None, workers=1,
+    font_cache=None, font_cache_superset=False, font_cache_size=None,
+):
     logger.write(f"\n正在尝试对EPUB进行字体子集化: {epub_path}")
-    fs = FontSubset(epub_path, output_path)
+    cache = open_font_cache(font_cache, font_cache_superset, font_cache_size)
+    fs = FontSubset(epub_path, output_path, html_engine, workers, cache)
     if len(fs.fonts) == 0:
         logger.write("没有找到字体文件，退出")
         return "skip"
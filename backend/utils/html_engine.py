@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+# HTML 文档解析引擎
+#
+# 各功能模块原先都直接使用 BeautifulSoup(text, "html.parser")，这是 bs4 支持的最慢的解析器。
+# 这里把解析、文本节点遍历、CSS 选择和序列化收拢为引擎，可按次选择 (--extra '{"html_engine": "lxml"}'):
+#
+#   html.parser  默认。bs4 + 标准库解析器，输出与原来逐字节相同
+#   lxml         bs4 + lxml (C 实现) 解析器，树与 API 相同。文档开头的 XML 声明与文档类型按 html.parser 的方式
+#                生成节点 (lxml 会把 <?xml ...?> 变成注释)；对不规范的标记 (如非空元素的 <a/>) 处理不同，
+#                这类文档的序列化结果可能与 html.parser 有差异
+#   selectolax   lexbor (C 实现)，只读: 仅用于统计字体用字等只查询不修改的场合，需要修改文档时改用 lxml
+#
+# lxml 与 selectolax 已列入 requirements.txt，打包环境按其安装后会一并打包。两者仍是可选的:
+# 未安装时退回 html.parser 并记录日志，结果 JSON 中不会报错。
+#
+# python utils/html_engine.py a.epub ... 逐个比较 lxml 与 html.parser 对书中 XHTML 的序列化结果。
+
+import re
+
+from bs4 import BeautifulSoup, Comment, Declaration, Doctype, NavigableString, ProcessingInstruction, Tag
+import soupsieve
+
+try:
+    import lxml  # noqa: F401 (bs4 按名称加载 lxml 解析器)
+except ImportError:
+    lxml = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+try:
+    from utils.log import logwriter
+except ImportError:
+    from log import logwriter
+
+logger = logwriter()
+
+DEFAULT_ENGINE = "html.parser"
+# 不属于正文的特殊节点
+SPECIAL_STRINGS = (Comment, Doctype, ProcessingInstruction, Declaration)
+# 文档开头的空白、处理指令 (XML 声明) 与文档类型
+PROLOG_ITEM = re.compile(r"(\s*)(<\?[^>]*>|<!doctype[^>]*>)?", re.IGNORECASE)
+
+
+def whitespace_node(space):
+    # bs4 把只含空白的文本折叠为一个换行或空格
+    return NavigableString("\n" if "\n" in space else " ")
+
+
+def split_prolog(text):
+    # 返回 (与 html.parser 相同的序言节点, 其余文本)
+    nodes = []
+    pos = 0
+    while pos < len(text):
+        match = PROLOG_ITEM.match(text, pos)
+        space, item = match.groups()
+        if not item:
+            break
+        if space:
+            nodes.append(whitespace_node(space))
+        if item.startswith("<?"):
+            nodes.append(ProcessingInstruction(item[2:-1]))
+        else:
+            nodes.append(Doctype(item[len("<!DOCTYPE "):-1]))
+        pos = match.end()
+    # 序言之后、根元素之前的空白 html.parser 也保留为文本节点
+    if nodes:
+        space = PROLOG_ITEM.match(text, pos).group(1)
+        if space:
+            nodes.append(whitespace_node(space))
+            pos += len(space)
+    return nodes, text[pos:]
+
+
+class SoupEngine:
+    """bs4 文档树，可修改"""
+
+    editable = True
+
+    def __init__(self, name, features):
+        self.name = name
+        self.features = features
+
+    def parse(self, text):
+        if self.features != "lxml":
+            return BeautifulSoup(text, self.features)
+        prolog, text = split_prolog(text)
+        doc = BeautifulSoup(text, self.features)
+        for index, node in enumerate(prolog):
+            doc.insert(index, node)
+        return doc
+
+    def text_nodes(self, doc, skip_parents=()):
+        # 正文文本节点 (跳过注释、声明等)，父元素在 skip_parents 中的不计入
+        for string in doc.find_all(string=True):
+            if isinstance(string, SPECIAL_STRINGS):
+                continue
+            if string.parent.name in skip_parents:
+                continue
+            yield string
+
+    def select_text(self, doc, selector):
+        # 与 element.get_text(strip=True) 相同: 各文本节点去除首尾空白后直接拼接
+        return [element.get_text(strip=True) for element in doc.select(selector)]
+
+    def walk(self, doc, skip_tags=()):
+        # 深度优先遍历整个文档，依次产出 ("start", 元素, 标签名, class 列表, id, style)、("text", 文本)、("end",)；
+        # 标签在 skip_tags 中的元素整体跳过 (不产出任何事件)
+        stack = [iter(doc.contents)]
+        while stack:
+            node = next(stack[-1], None)
+            if node is None:
+                stack.pop()
+                if stack:
+                    yield ("end",)
+                continue
+            if isinstance(node, Tag):
+                if node.name in skip_tags:
+                    continue
+                attrs = node.attrs
+                classes = attrs.get("class") or ()
+                if isinstance(classes, str):
+                    classes = classes.split()
+                yield ("start", node, node.name, classes, attrs.get("id"), attrs.get("style"))
+                stack.append(iter(node.contents))
+            elif not isinstance(node, SPECIAL_STRINGS):
+                yield ("text", node)
+
+    def matcher(self, doc, selector):
+        # 返回判断元素是否匹配选择器的函数；选择器无效时抛出 ValueError (soupsieve 自行缓存编译结果)
+        try:
+            return soupsieve.compile(selector).match
+        except soupsieve.SelectorSyntaxError as e:
+            raise ValueError(str(e)) from e
+
+    def serialize(self, doc):
+        return str(doc)
+
+
+class LexborEngine:
+    """selectolax (lexbor) 文档，只读"""
+
+    editable = False
+    name = "selectolax"
+
+    def parse(self, text):
+        return LexborHTMLParser(text)
+
+    def select_text(self, doc, selector):
+        return [node.text(deep=True, separator="", strip=True) for node in doc.css(selector)]
+
+    def walk(self, doc, skip_tags=()):
+        # 与 SoupEngine.walk 相同的事件
+        root = doc.root
+        if root is None:
+            return
+        stack = [iter((root,))]
+        while stack:
+            node = next(stack[-1], None)
+            if node is None:
+                stack.pop()
+                if stack:
+                    yield ("end",)
+                continue
+            tag = node.tag
+            if tag == "-text":
+                yield ("text", node.text_content or "")
+            elif tag.startswith(("_", "!", "-")) or tag in skip_tags:
+                # 注释、文档类型等
+                continue
+            else:
+                attrs = node.attributes
+                classes = (attrs.get("class") or "").split()
+                yield ("start", node, tag, classes, attrs.get("id"), attrs.get("style"))
+                stack.append(node.iter(include_text=True))
+
+    def matcher(self, doc, selector):
+        # 先在文档中选出全部匹配的节点
+        try:
+            matched = {node.mem_id for node in doc.css(selector)}
+        except Exception as e:
+            raise ValueError(str(e)) from e
+        return lambda node: node.mem_id in matched
+
+
+def _make_engine(name):
+    if name == "html.parser":
+        return SoupEngine(name, "html.parser")
+    if name == "lxml" and lxml is not None:
+        return SoupEngine(name, "lxml")
+    if name == "selectolax" and LexborHTMLParser is not None:
+        return LexborEngine()
+    return None
+
+
+ENGINE_NAMES = ("html.parser", "lxml", "selectolax")
+_engines = {}  # { (名称, 是否需要修改) : 引擎 }，每个进程各自保留一份
+
+
+def get_engine(name=None, editable=False):
+    """返回解析引擎；editable 为 True 时只返回可修改文档的引擎"""
+    name = name or DEFAULT_ENGINE
+    key = (name, editable)
+    if key in _engines:
+        return _engines[key]
+    if name not in ENGINE_NAMES:
+        raise ValueError(f"未知的 HTML 解析引擎: {name} (可选: {', '.join(ENGINE_NAMES)})")
+
+    engine = _make_engine(name)
+    if engine is not None and editable and not engine.editable:
+        engine = _make_engine("lxml")
+    if engine is None:
+        engine = _make_engine(DEFAULT_ENGINE)
+    if engine.name != name:
+        logger.write(f"HTML 解析引擎 {name} 不可用，使用 {engine.name}")
+    _engines[key] = engine
+    return engine
+
+
+if __name__ == "__main__":
+    # 检查 lxml 引擎的序列化结果与 html.parser 是否逐字节相同
+    import sys
+    import zipfile
+
+    reference = get_engine(DEFAULT_ENGINE)
+    engine = get_engine("lxml", editable=True)
+    if engine.name != "lxml":
+        sys.exit("lxml 未安装")
+    checked = 0
+    differ = []
+    for book in sys.argv[1:]:
+        with zipfile.ZipFile(book) as epub:
+            for name in epub.namelist():
+                if not name.lower().endswith((".xhtml", ".html", ".htm")):
+                    continue
+                text = epub.read(name).decode("utf-8")
+                checked += 1
+                if engine.serialize(engine.parse(text)) != reference.serialize(reference.parse(text)):
+                    differ.append(f"{book}: {name}")
+    for item in differ:
+        print("不同:", item)
+    print(f"{checked} 个文档，{len(differ)} 个不同")
+    sys.exit(1 if differ else 0)
@@ -9,12 +9,20 @@ import zipfile
 from PIL import Image
 import io
 import re
-from urllib.parse import unquote
+from urllib.parse import quote
 
 try:
     from utils.log import logwriter
+    from utils.epub_container import EpubContainer
+    from utils.parallel import map_members
+    from utils.streaming import SpillBuffer, open_budget, write_member
+    from utils import progress
 except:
     from log import logwriter
+    from epub_container import EpubContainer
+    from parallel import map_members
+    from streaming import SpillBuffer, open_budget, write_member
+    import progress
 
 logger = logwriter()
 
@@ -93,24 +101,24 @@ def convert_png_to_jpg(img, quality=85):
     return img, 'jpg'
 
 
-def process_image(img_data, filename):
-    """处理单张图片"""
+def compress_image(filename, img_data):
+    """处理单张图片，返回 (新数据, 新扩展名, 状态, 日志)；可在工作进程中执行"""
     try:
         img = Image.open(io.BytesIO(img_data))
         original_format = img.format
         
         # 只处理PNG图片
         if original_format != 'PNG':
-            return None, None, 'skip'
+            return None, None, 'skip', None
         
         if has_transparency(img):
             # 有透明度：转为PNG-8二值透明
             new_img, new_ext = convert_to_binary_alpha(img)
-            logger.write(f"  {filename}: PNG(透明) -> PNG-8(二值透明)")
+            message = f"  {filename}: PNG(透明) -> PNG-8(二值透明)"
         else:
             # 无透明度：转为JPG
             new_img, new_ext = convert_png_to_jpg(img)
-            logger.write(f"  {filename}: PNG(无透明) -> JPG")
+            message = f"  {filename}: PNG(无透明) -> JPG"
         
         # 保存到内存
         output = io.BytesIO()
@@ -119,15 +127,100 @@ def process_image(img_data, filename):
         else:
             new_img.save(output, format='PNG', optimize=True)
         
-        return output.getvalue(), new_ext, 'success'
+        return output.getvalue(), new_ext, 'success', message
     
     except Exception as e:
-        logger.write(f"  {filename}: 处理失败 - {e}")
-        return None, None, 'error'
+        return None, None, 'error', f"  {filename}: 处理失败 - {e}"
+
+
+def process_image(img_data, filename):
+    """处理单张图片"""
+    new_data, new_ext, status, message = compress_image(filename, img_data)
+    if message:
+        logger.write(message)
+    return new_data, new_ext, status
+
+
+def compress_images(epub, namelist, max_workers=1, budget=None, spill=None):
+    """压缩所有PNG图片
+
+    epub 只需提供 read(arcname)。max_workers > 1 时在进程池中并行转码。
+    返回 ({ 原路径: (新路径, 新数据) }, { 原路径: 新路径 })，后者仅包含 PNG 转 JPG 的重命名。
+    流式处理时 (budget 为 MemoryBudget，epub 需提供 getinfo 与 open)，解码后超过单个成员上限的图片保留原样，
+    新数据暂存到 spill (SpillBuffer)，返回的是其中的数据句柄。
+    """
+    compressed = {}
+    rename_map = {}
+    pngs = [arcname for arcname in namelist if arcname.lower().endswith('.png')]
+    max_in_flight_bytes = None
+    size_of = None
+    if budget is not None:
+        kept = []
+        for arcname in pngs:
+            if budget.fits(epub, arcname):
+                kept.append(arcname)
+            else:
+                logger.write(f"  {arcname}: 超过内存上限，保留原图")
+        pngs = kept
+        max_in_flight_bytes = budget.member_limit
+        size_of = budget.member_size
+    with progress.stage("compress", len(pngs)) as stage:
+        for arcname, result in map_members(
+            epub, pngs, compress_image, max_workers, max_in_flight_bytes=max_in_flight_bytes, size_of=size_of
+        ):
+            stage.advance()
+            new_data, new_ext, status, message = result
+            if message:
+                logger.write(message)
+            if status == 'success' and new_data:
+                if new_ext == 'jpg':
+                    # 修改文件名
+                    new_arcname = arcname[:-4] + '.jpg'
+                    rename_map[arcname] = new_arcname
+                else:
+                    # 保持PNG但压缩了
+                    new_arcname = arcname
+                if spill is not None:
+                    new_data = spill.put(new_data)
+                compressed[arcname] = (new_arcname, new_data)
+    return compressed, rename_map
+
+
+def is_reference_file(arcname):
+    """可能引用图片文件名的文本文件"""
+    return arcname.lower().endswith(('.opf', '.xhtml', '.html', '.css', '.ncx'))
+
+
+def update_text_references(text, rename_map):
+    """更新文本中的文件引用"""
+    for old_name, new_name in rename_map.items():
+        # 获取相对路径的文件名
+        old_basename = os.path.basename(old_name)
+        new_basename = os.path.basename(new_name)
+        
+        # 替换引用
+        text = text.replace(old_basename, new_basename)
+        
+        # 也替换URL编码的版本
+        text = text.replace(quote(old_basename), quote(new_basename))
+    
+    # 更新media-type
+    text = re.sub(
+        r'media-type="image/png"([^>]*href="[^"]*\.jpg")',
+        r'media-type="image/jpeg"\1',
+        text
+    )
+    text = re.sub(
+        r'(href="[^"]*\.jpg"[^>]*)media-type="image/png"',
+        r'\1media-type="image/jpeg"',
+        text
+    )
+    return text
 
 
-def run(epub_src, output_path=None):
-    """压缩EPUB中的图片"""
+def run(epub_src, output_path=None, max_workers=1, memory_limit=None):
+    """压缩EPUB中的图片；memory_limit (MB) 启用有界内存的流式处理，见 streaming.py"""
+    spill = None
     try:
         logger.write(f"\n正在压缩图片: {epub_src}")
         
@@ -145,126 +238,58 @@ def run(epub_src, output_path=None):
             out_epub = epub_src.replace('.epub', '_compressed.epub')
         
         # 读取原始EPUB
-        with zipfile.ZipFile(epub_src, 'r') as zin:
-            namelist = zin.namelist()
+        with EpubContainer(epub_src) as container:
+            zin = container.epub
+            namelist = container.namelist
             
             # 找到OPF文件
-            opf_path = None
-            for name in namelist:
-                if name.lower().endswith('.opf'):
-                    opf_path = name
-                    break
-            
-            if not opf_path:
+            try:
+                container.opfpath
+            except RuntimeError:
                 logger.write("错误: 找不到OPF文件")
                 return "error"
             
-            opf_content = zin.read(opf_path).decode('utf-8')
-            opf_dir = os.path.dirname(opf_path)
-            
-            # 记录需要修改的文件名映射 (旧路径 -> 新路径)
-            rename_map = {}  # { old_arcname: new_arcname }
-            processed_count = 0
+            # 先处理图片，得到文件名映射后一次写出，引用更新不再需要二次打包
+            budget = open_budget(memory_limit)
+            if budget is not None:
+                spill = SpillBuffer(budget.member_limit)
+            compressed, rename_map = compress_images(zin, namelist, max_workers, budget, spill)
+            if rename_map:
+                logger.write(f"更新文件引用: {len(rename_map)} 个文件名变更")
             
+            progress.output_file(out_epub)
             with zipfile.ZipFile(out_epub, 'w', zipfile.ZIP_DEFLATED) as zout:
-                for arcname in namelist:
-                    data = zin.read(arcname)
+                with progress.stage("write", len(namelist), zout) as stage:
+                    for arcname in namelist:
+                        stage.advance(read=zin.getinfo(arcname).compress_size)
+                        if arcname in compressed:
+                            new_arcname, data = compressed[arcname]
+                            write_member(zout, new_arcname, data)
+                            continue
                     
-                    # 检查是否是PNG图片
-                    if arcname.lower().endswith('.png'):
-                        new_data, new_ext, status = process_image(data, arcname)
-                        
-                        if status == 'success' and new_data:
-                            processed_count += 1
-                            if new_ext == 'jpg':
-                                # 修改文件名
-                                new_arcname = arcname[:-4] + '.jpg'
-                                rename_map[arcname] = new_arcname
-                                zout.writestr(new_arcname, new_data)
-                            else:
-                                # 保持PNG但压缩了
+                        # 如果有PNG转JPG，需要更新OPF和相关文件中的引用
+                        if rename_map and is_reference_file(arcname):
+                            data = zin.read(arcname)
+                            try:
+                                new_data = update_text_references(data.decode('utf-8'), rename_map).encode('utf-8')
+                            except:
+                                new_data = data
+                            if new_data != data:
                                 zout.writestr(arcname, new_data)
-                        else:
-                            # 保持原样
-                            zout.writestr(arcname, data)
-                    else:
-                        zout.writestr(arcname, data)
-                
-                # 如果有PNG转JPG，需要更新OPF和相关文件中的引用
-                if rename_map:
-                    logger.write(f"更新文件引用: {len(rename_map)} 个文件名变更")
-                    
-                    # 重新写入修正后的文件
-                    # 这需要重新处理EPUB，先关闭再重新打开
-            
-            # 如果有重命名，需要更新引用
-            if rename_map:
-                update_references(out_epub, rename_map, opf_path)
+                                continue
+                        # 未修改的文件原样复制，不重新压缩
+                        container.copy_to(zout, arcname)
         
-        logger.write(f"图片压缩完成: 处理了 {processed_count} 张图片")
+        logger.write(f"图片压缩完成: 处理了 {len(compressed)} 张图片")
         logger.write(f"输出文件: {out_epub}")
         return 0
     
     except Exception as e:
         logger.write(f"压缩失败: {e}")
         return "error"
-
-
-def update_references(epub_path, rename_map, opf_path):
-    """更新EPUB中的文件引用"""
-    try:
-        temp_path = epub_path + '.tmp'
-        
-        with zipfile.ZipFile(epub_path, 'r') as zin:
-            with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED) as zout:
-                for arcname in zin.namelist():
-                    data = zin.read(arcname)
-                    
-                    # 跳过已经被重命名的旧文件
-                    if arcname in rename_map:
-                        continue
-                    
-                    # 更新文本文件中的引用
-                    if arcname.lower().endswith(('.opf', '.xhtml', '.html', '.css', '.ncx')):
-                        try:
-                            text = data.decode('utf-8')
-                            for old_name, new_name in rename_map.items():
-                                # 获取相对路径的文件名
-                                old_basename = os.path.basename(old_name)
-                                new_basename = os.path.basename(new_name)
-                                
-                                # 替换引用
-                                text = text.replace(old_basename, new_basename)
-                                
-                                # 也替换URL编码的版本
-                                from urllib.parse import quote
-                                text = text.replace(quote(old_basename), quote(new_basename))
-                            
-                            # 更新media-type
-                            text = re.sub(
-                                r'media-type="image/png"([^>]*href="[^"]*\.jpg")',
-                                r'media-type="image/jpeg"\1',
-                                text
-                            )
-                            text = re.sub(
-                                r'(href="[^"]*\.jpg"[^>]*)media-type="image/png"',
-                                r'\1media-type="image/jpeg"',
-                                text
-                            )
-                            
-                            data = text.encode('utf-8')
-                        except:
-                            pass
-                    
-                    zout.writestr(arcname, data)
-        
-        # 替换原文件
-        os.replace(temp_path, epub_path)
-        
-    except Exception as e:
-        logger.write(f"更新引用失败: {e}")
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+    finally:
+        if spill is not None:
+            spill.close()
 
 
 if __name__ == "__main__":
@@ -1,6 +1,5 @@
 import zipfile
 import os
-import shutil
 from io import BytesIO
 from xml.etree import ElementTree
 
@@ -11,14 +10,38 @@ except ImportError:
 
 try:
     from utils.log import logwriter
+    from utils.epub_container import EpubContainer
+    from utils.parallel import map_members
+    from utils.streaming import open_budget
+    from utils import progress
 except:
     from log import logwriter
+    from epub_container import EpubContainer
+    from parallel import map_members
+    from streaming import open_budget
+    import progress
 
 logger = logwriter()
 
 
+def convert_image(img_path, img_data):
+    """将单张图片转为 WebP，返回 (新路径, 新数据, 错误信息)；可在工作进程中执行"""
+    try:
+        image = Image.open(BytesIO(img_data))
+        img_basename = os.path.basename(img_path)
+        filename_no_ext, ext = os.path.splitext(img_basename)
+        
+        # Convert to WebP
+        new_name = filename_no_ext + ".webp"
+        buffer = BytesIO()
+        image.save(buffer, format="WEBP", quality=80) 
+        return img_path.replace(img_basename, new_name), buffer.getvalue(), None
+    except Exception as e:
+        return img_path, None, str(e)
+
+
 class ImageToWebP:
-    def __init__(self, epub_path, output_path):
+    def __init__(self, epub_path, output_path, max_workers=1, memory_limit=None):
         if not Image:
              raise ImportError("Pillow library not found. Please install it with 'pip install Pillow'")
 
@@ -60,6 +83,8 @@ class ImageToWebP:
         self.opf = ""
         self.ori_files = []
         self.img_dict = {}
+        self.max_workers = max_workers  # 并行转码图片的进程数
+        self.budget = open_budget(memory_limit)  # 有界内存的流式处理，见 streaming.py
 
     def process(self):
         # Clean up existing target file
@@ -70,8 +95,10 @@ class ImageToWebP:
                 pass
 
         try:
-            with zipfile.ZipFile(self.epub_path, 'r') as self.epub, \
+            progress.output_file(self.file_write_path)
+            with EpubContainer(self.epub_path) as self.container, \
                  zipfile.ZipFile(self.file_write_path, "w", zipfile.ZIP_DEFLATED) as self.target_epub:
+                self.epub = self.container.epub
                 
                 # 0. Write mimetype file first (must be uncompressed and first)
                 try:
@@ -82,7 +109,7 @@ class ImageToWebP:
                     self.target_epub.writestr("mimetype", b"application/epub+zip", zipfile.ZIP_STORED)
 
                 # Scan files
-                for file in self.epub.namelist():
+                for file in self.container.namelist:
                     if file == "mimetype":
                         continue
                     elif file.lower().endswith(".html") or file.endswith(".xhtml"):
@@ -97,7 +124,8 @@ class ImageToWebP:
                         self.ori_files.append(file)
                 
                 # 1. Process Images
-                self._process_images()
+                with progress.stage("convert", len(self.images), self.target_epub) as self.stage:
+                    self._process_images()
                 
                 # 2. Copy original files
                 self._copy_original_files()
@@ -128,59 +156,41 @@ class ImageToWebP:
             raise e
 
     def _process_images(self):
-        for img_path in self.images:
-            img_data = self.epub.read(img_path)
-            img_file = BytesIO(img_data)
-            try:
-                image = Image.open(img_file)
+        # 转码在进程池中并行，写入仍在当前线程按原顺序进行
+        images = self.images
+        max_in_flight_bytes = None
+        size_of = None
+        if self.budget is not None:
+            # 超过单个成员内存上限的图片不转换，按块原样复制
+            images = []
+            for img_path in self.images:
+                if self.budget.fits(self.epub, img_path):
+                    images.append(img_path)
+                else:
+                    logger.write(f"图片 {img_path} 超过内存上限，保留原图")
+                    self.container.copy_to(self.target_epub, img_path)
+                    self.stage.advance(read=self.epub.getinfo(img_path).compress_size)
+            max_in_flight_bytes = self.budget.member_limit
+            size_of = self.budget.member_size
+        for img_path, (new_img_path, data, error) in map_members(
+            self.epub, images, convert_image, self.max_workers,
+            max_in_flight_bytes=max_in_flight_bytes, size_of=size_of,
+        ):
+            self.stage.advance(read=self.epub.getinfo(img_path).compress_size)
+            if error is None:
                 img_basename = os.path.basename(img_path)
-                filename_no_ext, ext = os.path.splitext(img_basename)
-                
-                # Convert to WebP
-                new_name = filename_no_ext + ".webp"
-                self.img_dict[img_basename] = [new_name, "image/webp"]
-                
-                buffer = BytesIO()
-                image.save(buffer, format="WEBP", quality=80) 
-                
+                self.img_dict[img_basename] = [os.path.basename(new_img_path), "image/webp"]
                 # Write to new epub with new name
-                new_img_path = img_path.replace(img_basename, new_name)
-                self.target_epub.writestr(new_img_path, buffer.getvalue())
-
-            except Exception as e:
-                logger.write(f"无法处理图片 {img_path}: {str(e)}")
+                self.target_epub.writestr(new_img_path, data)
+            else:
+                logger.write(f"无法处理图片 {img_path}: {error}")
                 # Keep original if conversion fails
-                self.target_epub.writestr(img_path, img_data)
+                self.container.copy_to(self.target_epub, img_path)
 
     def _copy_original_files(self):
+        # 原样复制已压缩的数据，不解压也不重新压缩
         for item in self.ori_files:
-            # Use stream copying to avoid loading large files into memory
-            with self.epub.open(item) as source_file:
-                # ZipInfo is needed to preserve/set permissions or compression
-                # Simple writestr with stream requires us to be careful.
-                # However, zipfile.open(name, 'w') is available in newer Python versions
-                # and allows writing streams.
-                
-                # Check if we can open target as stream or if we need to use writestr
-                # writestr accepts bytes, so streaming requires reading chunks.
-                # shutil.copyfileobj works between file-like objects.
-                
-                # ZipFile.open(name, 'w') was added in Python 3.6.
-                # We want to use ZIP_DEFLATED for these files usually.
-                
-                # Create a ZipInfo object to specify compression
-                zinfo = zipfile.ZipInfo(filename=item)
-                zinfo.compress_type = zipfile.ZIP_DEFLATED
-                
-                # Preserve permissions if possible (optional)
-                try:
-                    src_info = self.epub.getinfo(item)
-                    zinfo.external_attr = src_info.external_attr
-                except:
-                    pass
-
-                with self.target_epub.open(zinfo, 'w') as target_file:
-                    shutil.copyfileobj(source_file, target_file)
+            self.container.copy_to(self.target_epub, item)
 
     def _replace_references(self):
         # Replace in OPF
@@ -264,7 +274,11 @@ class ImageToWebP:
         updated_content = re.sub(pattern, lambda m: replace_match(m), content, flags=re.IGNORECASE)
         updated_content = re.sub(pattern2, lambda m: replace_match(m), updated_content, flags=re.IGNORECASE)
         
-        self.target_epub.writestr(html_path, updated_content.encode("utf-8"))
+        if updated_content == content:
+            # 没有需要替换的引用，原样复制
+            self.container.copy_to(self.target_epub, html_path)
+        else:
+            self.target_epub.writestr(html_path, updated_content.encode("utf-8"))
 
     def _replace_css(self, css_path, content):
         def replace_match(match):
@@ -279,13 +293,17 @@ class ImageToWebP:
         import re
         pattern = r'url\(\s*([\'"]?)\s*(.*?)\.(jpg|jpeg|png|bmp)\s*(?:\?\S*)?\s*\1\s*\)'
         updated_css = re.sub(pattern, replace_match, content, flags=re.IGNORECASE)
-        self.target_epub.writestr(css_path, updated_css.encode("utf-8"))
+        if updated_css == content:
+            # 没有需要替换的引用，原样复制
+            self.container.copy_to(self.target_epub, css_path)
+        else:
+            self.target_epub.writestr(css_path, updated_css.encode("utf-8"))
 
 
-def run(epub_path, output_path):
+def run(epub_path, output_path, max_workers=1, memory_limit=None):
     logger.write(f"\n正在尝试将EPUB图片转为WebP: {epub_path}")
     try:
-        it = ImageToWebP(epub_path, output_path)
+        it = ImageToWebP(epub_path, output_path, max_workers, memory_limit)
         return it.process()
     except Exception as e:
         logger.write(f"处理EPUB文件时发生错误: {str(e)}")
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# 增量处理: 只重新转换内容有变化的章节
+#
+# 修改一章后重新执行 s2t/t2s/add_pinyin 时，其余章节的转换结果与上次相同。
+# 启用后在输出文件旁 (或指定目录) 保存一个清单，记录每个成员输入内容的摘要及上次输出的 CRC；
+# 再次执行时，输入摘要未变且上次的输出文件中仍有对应成员的，直接从上次的输出原样复制，不再转换。
+# 命令、工具版本 (代码或字典) 变化，或清单/上次输出缺失时整本重新处理。
+#
+#     python cli.py s2t --input a.epub --output out --extra '{"incremental": true}'
+#     python cli.py s2t --input a.epub --output out --extra '{"incremental": "/path/to/manifests"}'
+
+import hashlib
+import json
+import os
+import zipfile
+import zlib
+
+try:
+    from utils.log import logwriter
+    from utils.epub_container import copy_member
+    from utils.result_cache import tool_version
+except ImportError:
+    from log import logwriter
+    from epub_container import copy_member
+    from result_cache import tool_version
+
+logger = logwriter()
+
+MANIFEST_FORMAT = 1
+MANIFEST_SUFFIX = ".manifest.json"
+PREVIOUS_SUFFIX = ".prev"
+
+
+def member_digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def open_manifest(option, output_file, command):
+    # option 为 --extra 中的 incremental: 假值不启用，字符串为清单目录，其余为输出文件旁
+    if not option:
+        return None
+    manifest_dir = option if isinstance(option, str) else None
+    return IncrementalManifest(output_file, command, manifest_dir)
+
+
+class IncrementalManifest:
+    def __init__(self, output_file, command, manifest_dir=None):
+        self.output_file = output_file
+        self.command = command
+        if manifest_dir:
+            os.makedirs(manifest_dir, exist_ok=True)
+            self.path = os.path.join(manifest_dir, os.path.basename(output_file) + MANIFEST_SUFFIX)
+        else:
+            self.path = output_file + MANIFEST_SUFFIX
+        self.previous_path = output_file + PREVIOUS_SUFFIX
+        self.previous = None  # 上次的输出 (ZipFile)
+        self.old_members = {}  # 上次的清单 { 成员 : 记录 }
+        self.members = {}  # 本次的清单
+        self.reused = 0
+
+    def begin(self):
+        """须在删除上次输出之前调用: 读取清单，并把上次的输出移到一旁供复制"""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return
+        if (
+            manifest.get("format") != MANIFEST_FORMAT
+            or manifest.get("command") != self.command
+            or manifest.get("version") != tool_version()
+            or not os.path.isfile(self.output_file)
+        ):
+            logger.write("增量清单已失效，整本重新处理")
+            return
+        try:
+            os.replace(self.output_file, self.previous_path)
+            self.previous = zipfile.ZipFile(self.previous_path)
+        except (OSError, zipfile.BadZipFile) as e:
+            logger.write(f"无法读取上次的输出，整本重新处理: {e}")
+            self.discard_previous()
+            return
+        self.old_members = manifest.get("members", {})
+
+    def unchanged(self, name, digest):
+        """输入内容未变化，且上次的输出中仍有与清单相符的成员"""
+        old = self.old_members.get(name)
+        if self.previous is None or old is None or old["input"] != digest:
+            return False
+        try:
+            return self.previous.getinfo(name).CRC == old["crc"]
+        except KeyError:
+            return False
+
+    def reuse(self, target, name):
+        """把上次的输出成员原样写入 target，返回上次记录的附加信息"""
+        old = self.old_members[name]
+        copy_member(self.previous, target, self.previous.getinfo(name))
+        self.members[name] = old
+        self.reused += 1
+        return old.get("extra", {})
+
+    def record(self, name, digest, output, extra=None):
+        entry = {"input": digest, "crc": zlib.crc32(output)}
+        if extra:
+            entry["extra"] = extra
+        self.members[name] = entry
+
+    def commit(self):
+        # 先写临时文件再改名，中途失败不会留下与输出不符的清单
+        manifest = {
+            "format": MANIFEST_FORMAT,
+            "command": self.command,
+            "version": tool_version(),
+            "members": self.members,
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        if self.reused:
+            logger.write(f"增量处理: {self.reused} 个文件沿用上次的结果，{len(self.members) - self.reused} 个重新处理")
+        self.discard_previous()
+
+    def abort(self):
+        # 输出已被删除，清单随之作废
+        self.discard_previous()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def discard_previous(self):
+        if self.previous is not None:
+            self.previous.close()
+            self.previous = None
+        if os.path.exists(self.previous_path):
+            os.remove(self.previous_path)
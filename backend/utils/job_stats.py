@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# 单个任务的资源统计
+#
+# 加上 --stats 后，结果 JSON 中增加 stats 字段:
+#
+#   python cli.py s2t --input a.epub --output out --stats
+#   {"status": "success", ..., "stats": {
+#       "wall_ms": 2410, "cpu_user_s": 2.31, "cpu_system_s": 0.12,      (含已结束的工作进程)
+#       "peak_rss_delta": 18350080, "children_peak_rss": 61440000,      (字节，不支持的平台及 serve 模式下没有)
+#       "input": {"path": "a.epub", "size": 5123456, "members": 318},
+#       "outputs": [{"path": "out/a_traditional.epub", "size": 5234567, "members": 318}],
+#       "stages": [{"stage": "convert", "done": 318, "total": 318, "bytes_read": ..., "bytes_written": ...,
+#                   "elapsed_ms": 2331}]}}
+#
+# 以上只在任务前后各取一次计数，各阶段的汇总来自 progress.stage，开销可忽略。
+# 输出文件为各模块以 progress.output_file 登记、任务结束时仍存在的文件 (流水线的中间文件、
+# 结果缓存的暂存文件不计入)，同一目录中其他任务写出的文件不会混入。
+# --stats-memory 另外用 tracemalloc 记录每个阶段 Python 分配的峰值 (tracemalloc_peak，字节，
+# 相对阶段开始时)。tracemalloc 会明显拖慢处理 (常见 1.5~3 倍)，只在排查内存问题时使用；
+# 它也只统计主进程，工作进程中的分配不计入。
+# serve 模式下任务在常驻的工作进程中运行，进程的 RSS 峰值是此前所有任务的峰值，
+# 已结束的子进程也不只属于本任务，因此不输出 peak_rss_delta 与 children_peak_rss。
+
+import multiprocessing
+import os
+import sys
+import time
+import tracemalloc
+import zipfile
+
+try:
+    import resource
+except ImportError:
+    # Windows 没有 resource 模块，不统计 RSS
+    resource = None
+
+try:
+    from utils import progress
+except ImportError:
+    import progress
+
+
+def peak_rss(who):
+    # 进程 (或已结束的子进程中) 的最大常驻内存，字节
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # Linux 以 KB 为单位，macOS 以字节为单位
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def archive_info(path):
+    info = {"path": path, "size": None, "members": None}
+    try:
+        info["size"] = os.path.getsize(path)
+        with zipfile.ZipFile(path) as z:
+            info["members"] = len(z.infolist())
+    except (OSError, zipfile.BadZipFile):
+        pass
+    return info
+
+
+def find_outputs(result, reported):
+    # 结果中的输出路径与任务登记的输出文件，只取任务结束时仍存在的
+    outputs = []
+    output_path = result.get("output_path") if isinstance(result, dict) else None
+    for path in ([output_path] if output_path else []) + reported:
+        if path not in outputs and os.path.isfile(path):
+            outputs.append(path)
+    return outputs
+
+
+class JobStats:
+    """汇总一个任务的各阶段 (progress.set_collector)；memory 为 True 时记录每个阶段的 tracemalloc 峰值"""
+
+    def __init__(self, memory=False):
+        self.pid = os.getpid()
+        self.memory = memory
+        self.stages = []
+        self.outputs = []  # progress.output_file 登记的输出文件
+        self.active = []  # 进行中的阶段 [[阶段, 开始时已分配, 峰值]]，阶段可嵌套 (流水线)
+
+    def enter_stage(self, stage):
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # reset_peak 会清除外层阶段到目前为止的峰值，先记下来
+            for entry in self.active:
+                entry[2] = max(entry[2], peak)
+            tracemalloc.reset_peak()
+            self.active.append([stage, current, current])
+
+    def add_output(self, path):
+        self.outputs.append(path)
+
+    def exit_stage(self, stage, fields):
+        summary = dict(fields)
+        if self.memory and self.active and self.active[-1][0] is stage:
+            _, start, saved_peak = self.active.pop()
+            peak = max(saved_peak, tracemalloc.get_traced_memory()[1])
+            for entry in self.active:
+                entry[2] = max(entry[2], peak)
+            summary["tracemalloc_peak"] = peak - start
+        self.stages.append(summary)
+
+
+def collect_stats(func, input_path, memory=False):
+    """运行 func()，返回 (func 的结果, 统计)"""
+    stats = JobStats(memory)
+    started_tracing = memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    # 在进程池的工作进程中 (serve 模式) 不统计 RSS
+    track_rss = resource is not None and multiprocessing.parent_process() is None
+    rss_before = peak_rss(resource.RUSAGE_SELF) if track_rss else None
+    times_before = os.times()
+    perf_start = time.perf_counter()
+    progress.set_collector(stats)
+    try:
+        result = func()
+    finally:
+        progress.set_collector(None)
+        if started_tracing:
+            tracemalloc.stop()
+
+    times_after = os.times()
+    summary = {
+        "wall_ms": int((time.perf_counter() - perf_start) * 1000),
+        # 子进程的 CPU 时间在其结束 (进程池关闭) 后计入
+        "cpu_user_s": round(
+            (times_after.user - times_before.user) + (times_after.children_user - times_before.children_user), 3
+        ),
+        "cpu_system_s": round(
+            (times_after.system - times_before.system)
+            + (times_after.children_system - times_before.children_system), 3
+        ),
+    }
+    if track_rss:
+        summary["peak_rss_delta"] = peak_rss(resource.RUSAGE_SELF) - rss_before
+        summary["children_peak_rss"] = peak_rss(resource.RUSAGE_CHILDREN)
+    summary["input"] = archive_info(input_path)
+    summary["outputs"] = [archive_info(path) for path in find_outputs(result, stats.outputs)]
+    summary["stages"] = stats.stages
+    return result, summary
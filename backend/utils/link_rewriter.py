@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+# 重构 (reformat/encrypt/decrypt 的 restructure) 时的链接改写
+#
+# 原实现对每个 XHTML 依次做 href、src、(poster)、url() 几遍整篇 re.sub，CSS 再做 @import、url() 两遍，
+# 每次回调都重复 unquote 和 get_bookpath。这里对每篇文档只扫描一次:
+# 只在含有 href=/src=/poster=/url( 的标签及 url( 处停下，同一标签上依次套用各规则，结果一次拼接。
+#
+# 规则和回调都沿用原有实现，回调仍按原来逐遍替换的顺序调用 (链接错误的登记顺序不变)，输出与逐遍替换相同。
+# 遇到跨越标签边界的匹配 (如属性值的引号未闭合) 时，在调用任何回调之前整篇退回逐遍替换。
+#
+# 改名表算好后各文档的改写互不相关，可在进程池中进行 (--extra '{"workers": 4}')。改名表以 LinkMap 快照
+# 通过进程池的 initializer 传给每个工作进程一次 (install_links)，各文档的问题链接随结果返回，由主进程按原顺序合并。
+
+import re
+from urllib.parse import unquote
+
+try:
+    from utils.epub_container import PathIndex, get_bookpath
+except ImportError:
+    from epub_container import PathIndex, get_bookpath
+
+HREF_RE = re.compile(r"(<[^>]*href=([\'\"]))(.*?)(\2[^>]*>)")
+SRC_RE = re.compile(r"(<[^>]* src=([\'\"]))(.*?)(\2[^>]*>)")
+POSTER_RE = re.compile(r"(<[^>]* poster=([\'\"]))(.*?)(\2[^>]*>)")
+URL_RE = re.compile(r"(url\([\'\"]?)(.*?)([\'\"]?\))")
+
+# 各标签规则必须出现在标签内的字面量，用于快速跳过无关标签
+MARKERS = {HREF_RE: "href=", SRC_RE: " src=", POSTER_RE: " poster="}
+
+_IMPORT_SCAN_RE = re.compile(r"@import|url\(")
+
+
+class IrregularMatch(Exception):
+    """匹配跨越了标签边界，单次扫描的结果可能与逐遍替换不同"""
+
+
+def link_resolver(refer_bkpath, bookpath=get_bookpath):
+    """返回当前文档的链接解析函数: 原始链接 -> (解码后的链接, #锚点, bookpath)，相同的链接只解析一次。
+    split_target 为 True 时拆出 #锚点 (与原 re_href 相同，含多个 # 时同样抛出 ValueError)；
+    bookpath 通常传入 EpubContainer.paths.bookpath，跨文档共用路径缓存"""
+    cache = {}
+
+    def resolve(raw, split_target=False):
+        key = (raw, split_target)
+        if key in cache:
+            return cache[key]
+        href = unquote(raw).strip()
+        target_id = ""
+        if split_target and "#" in href:
+            href, target_id = href.split("#")
+            target_id = "#" + target_id
+        result = cache[key] = (href, target_id, bookpath(href, refer_bkpath))
+        return result
+
+    return resolve
+
+
+class LinkMap:
+    """restructure 算好的改名表的只读快照，可传入工作进程"""
+
+    # 不检查的外部链接
+    EXTERNAL = ("http://", "https://", "res:/", "file:/", "data:")
+
+    def __init__(self, re_path_map, lower_to_origin, paths=None):
+        self.re_path_map = re_path_map  # { 类型 : { 原 bookpath : 新文件名 } }
+        self.lower_to_origin = lower_to_origin  # { 小写路径 : 原始路径 }
+        self.paths = paths if paths is not None else PathIndex(())
+
+    def bookpath(self, href, refer_bkpath):
+        return self.paths.bookpath(href, refer_bkpath)
+
+    def check(self, errors, bkpath, href, target_id=""):
+        """与原 check_link 相同: 返回纠正大小写后的 bookpath，无需处理或找不到文件时返回 None；
+        问题链接以 (链接, 纠正后的路径或 None) 追加到 errors"""
+        if href == "" or href.startswith(self.EXTERNAL):
+            return None
+        correct_path = self.lower_to_origin.get(bkpath.lower())
+        if correct_path is not None:
+            if bkpath != correct_path:  # 大小写不一致
+                errors.append((href + target_id, correct_path))
+                bkpath = correct_path
+        else:  # 链接路径找不到对应文件
+            errors.append((href + target_id, None))
+            return None
+        return bkpath
+
+
+_links = None  # 当前进程的 LinkMap
+
+
+def install_links(links):
+    # 进程池的 initializer；串行处理时在主进程中调用
+    global _links
+    _links = links
+
+
+def current_links():
+    return _links
+
+
+def merge_errors(error_log, filename, errors):
+    # 与原来逐条 setdefault/append 的结果相同: 没有问题链接的文件不登记
+    if errors:
+        error_log.setdefault(filename, []).extend(errors)
+
+
+def _check_url(match):
+    text = match.group()
+    if "<" in text or ">" in text:
+        raise IrregularMatch(text)
+
+
+def _check_tag(text, later_rules):
+    # 标签内只能有结尾一个 ">"，且后续规则与标签内的 url( 都应在标签内结束
+    if text.find(">") != len(text) - 1 or "<" in text[1:]:
+        raise IrregularMatch(text)
+    for pattern in later_rules:
+        if MARKERS[pattern] in text and pattern.match(text) is None:
+            raise IrregularMatch(text)
+    if "url(" in text:
+        matches = list(URL_RE.finditer(text))
+        if len(matches) != text.count("url("):
+            raise IrregularMatch(text)
+        for match in matches:
+            _check_url(match)
+
+
+def _plan_xhtml(text, patterns):
+    # 第一遍只定位，不调用回调: [(起点, 终点, 首个匹配的规则序号, 匹配), ...]，url( 的规则序号为 None
+    # 用 str.find 查找各规则的字面量，命中后才回到所在标签的 "<" 处尝试匹配
+    markers = [MARKERS[pattern] for pattern in patterns] + ["url("]
+    found = [text.find(marker) for marker in markers]
+    edits = []
+    pos = 0
+    while True:
+        for k, marker in enumerate(markers):
+            if 0 <= found[k] < pos:
+                found[k] = text.find(marker, pos)
+        hits = [at for at in found if at >= 0]
+        if not hits:
+            return edits
+        at = min(hits)
+
+        # 与字面量之间没有 ">" 的各个 "<" 都可能是某条规则的起点，按原有的从左到右顺序尝试
+        start = text.find("<", max(text.rfind(">", pos, at) + 1, pos), at)
+        match = None
+        while start != -1:
+            for index, pattern in enumerate(patterns):
+                match = pattern.match(text, start)
+                if match is not None:
+                    break
+            if match is not None:
+                break
+            start = text.find("<", start + 1, at)
+        if match is not None:
+            _check_tag(match.group(), patterns[index + 1 :])
+            edits.append((start, match.end(), index, match))
+            pos = match.end()
+            continue
+
+        if text.startswith("url(", at):
+            match = URL_RE.match(text, at)
+            if match is not None:
+                _check_url(match)
+                edits.append((at, match.end(), None, match))
+                pos = match.end()
+                continue
+        pos = at + 1
+
+
+def _apply(text, edits, rules, url_callback):
+    # 按原有的逐遍顺序调用回调: 先对所有标签应用第一条规则，再应用第二条……最后是 url()
+    pieces = {}  # { 编辑序号 : 当前文本 }
+    for rule_index, (pattern, callback) in enumerate(rules):
+        for i, (start, end, first, match) in enumerate(edits):
+            if first is None or first > rule_index:
+                continue
+            if first == rule_index:
+                pieces[i] = callback(match)
+                continue
+            current = pieces[i]
+            match = pattern.match(current)
+            if match is not None:
+                pieces[i] = callback(match) + current[match.end() :]
+    for i, (start, end, first, match) in enumerate(edits):
+        if first is None:
+            pieces[i] = url_callback(match)
+        else:
+            pieces[i] = URL_RE.sub(url_callback, pieces[i])
+
+    out = []
+    pos = 0
+    for i, (start, end, first, match) in enumerate(edits):
+        out.append(text[pos:start])
+        out.append(pieces[i])
+        pos = end
+    out.append(text[pos:])
+    return "".join(out)
+
+
+def rewrite_xhtml(text, rules, url_callback):
+    """rules: [(HREF_RE, 回调), (SRC_RE, 回调), ...]，顺序与原有的逐遍替换相同；url_callback 处理 url()"""
+    patterns = tuple(pattern for pattern, _ in rules)
+    try:
+        edits = _plan_xhtml(text, patterns)
+    except IrregularMatch:
+        for pattern, callback in rules:
+            text = pattern.sub(callback, text)
+        return URL_RE.sub(url_callback, text)
+    return _apply(text, edits, rules, url_callback)
+
+
+def rewrite_css(css, import_re, import_callback, url_callback):
+    """先 @import 后 url() 的两遍替换合为一次扫描，import_re 为各模块原有的 @import 正则"""
+    edits = []
+    pos = 0
+    try:
+        while True:
+            found = _IMPORT_SCAN_RE.search(css, pos)
+            if found is None:
+                break
+            start = found.start()
+            if found.group() == "url(":
+                match = URL_RE.match(css, start)
+                if match is None:
+                    pos = start + 4
+                    continue
+                if "@import" in match.group():
+                    raise IrregularMatch(match.group())
+                edits.append((start, match.end(), None, match))
+                pos = match.end()
+                continue
+            match = import_re.match(css, start)
+            if match is None:
+                pos = start + 1
+                continue
+            # @import url(...) 形式的匹配内恰有一个 url(，引号形式没有
+            expected = 0 if match.group(2) is not None else 1
+            if match.group().count("url(") != expected:
+                raise IrregularMatch(match.group())
+            edits.append((start, match.end(), 0, match))
+            pos = match.end()
+    except IrregularMatch:
+        css = import_re.sub(import_callback, css)
+        return URL_RE.sub(url_callback, css)
+    return _apply(css, edits, [(import_re, import_callback)], url_callback)
@@ -1,25 +1,256 @@
+# -*- coding: utf-8 -*-
+# 处理日志
+#
+# 各模块以 logger = logwriter() 取得日志对象，logger.write(text) 记录一行 (INFO 级别)。
+# 另有 debug / info / warning / error(msg, *args)，write 也可带参数；带参数时按 % 延迟格式化，
+# 低于当前级别的记录直接丢弃，不做任何格式化。映射表之类的大段内容记为 debug，默认不输出:
+#
+#     logger.debug("CSS选择器映射: %s", mapping)
+#
+# 同一进程的所有 logwriter 共用一个缓冲，缓冲满 64KB、距上次写出超过 1 秒、出现 ERROR 或进程退出时
+# 一次写出，不再每行打开文件。导入模块不再清空日志。输出目标:
+#
+#   默认          sys.argv[0] 所在目录的 log.txt，追加写入，每个进程先写一行 "time: ... pid: ..."；
+#                 超过 4MB 时由下一个写入的进程清空重写。并行运行的多个 cli.py 互不覆盖
+#   日志文件      configure_logs(path=...) (cli.py --log-file)，每个任务单独的日志文件，开始时清空
+#   环形缓冲      configure_logs(ring=N) (cli.py --log-ring)，只在内存中保留最近 N 行，由 take_log_ring() 取出
+#
+# 级别由 configure_logs(level=...) (cli.py --log-level) 或环境变量 EPUB_TOOL_LOG_LEVEL 指定，默认 info。
+# 日志文件与级别通过环境变量传给进程池的工作进程；工作进程只追加，不写进程头，环形缓冲模式下其日志丢弃。
+
+import atexit
+import collections
+import multiprocessing
+import multiprocessing.util
 import os
 import sys
+import threading
 import time
 
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {DEBUG: "DEBUG", WARNING: "WARNING", ERROR: "ERROR"}  # INFO 不加前缀，与原来的日志相同
+
+BUFFER_SIZE = 64 * 1024
+FLUSH_INTERVAL = 1.0  # 秒
+MAX_LOG_SIZE = 4 * 1024 * 1024  # 默认 log.txt 的大小上限
+
+# 传给工作进程的设置: 日志文件 (空字符串表示不写文件) 与级别
+ENV_LOG_FILE = "EPUB_TOOL_LOG_FILE"
+ENV_LOG_LEVEL = "EPUB_TOOL_LOG_LEVEL"
+
+
+def default_path():
+    return os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), "log.txt")
+
+
+def parse_level(level):
+    if isinstance(level, int) or str(level).isdigit():
+        return int(level)
+    try:
+        return LEVELS[str(level).strip().lower()]
+    except KeyError:
+        raise ValueError(f"未知的日志级别: {level} (可选: {', '.join(LEVELS)})") from None
+
+
+def is_worker():
+    return multiprocessing.parent_process() is not None
+
+
+class LogSink:
+    """进程内共用的日志缓冲"""
 
-class logwriter:
     def __init__(self):
-        self.path = os.path.join(
-            os.path.dirname(os.path.abspath(sys.argv[0])), "log.txt"
-        )
-        # print(self.path)
-        with open(self.path, "w", encoding="utf-8") as f:
-            current_time = time.strftime(
-                "%Y-%m-%d %H:%M:%S", time.localtime(time.time())
-            )
-            f.write(f"time: {current_time}\n")
+        self.lock = threading.RLock()
+        try:
+            self.level = parse_level(os.environ.get(ENV_LOG_LEVEL) or INFO)
+        except ValueError:
+            self.level = INFO
+        path = os.environ.get(ENV_LOG_FILE)
+        self.default = path is None
+        self.path = default_path() if path is None else (path or None)
+        self.ring = None  # 环形缓冲 (deque)，为 None 时写文件
+        self.header = is_worker()  # 是否已写过进程头；工作进程不写
+        self.buffer = []
+        self.size = 0
+        self.last_flush = time.monotonic()
+
+    def configure(self, path=None, ring=None, level=None):
+        with self.lock:
+            self.flush()
+            if level is not None:
+                self.level = parse_level(level)
+                os.environ[ENV_LOG_LEVEL] = str(self.level)
+            if ring:
+                self.ring = collections.deque(maxlen=int(ring))
+                self.path = None
+                self.default = False
+                os.environ[ENV_LOG_FILE] = ""
+            elif path:
+                self.ring = None
+                self.path = os.path.abspath(path)
+                self.default = False
+                self.header = is_worker()
+                if not is_worker():
+                    # 立即清空，即使本次没有任何记录也不会留下上次的内容；工作进程 (serve 模式) 只追加
+                    open(self.path, "w", encoding="utf-8").close()
+                os.environ[ENV_LOG_FILE] = self.path
+
+    def emit(self, level, text):
+        with self.lock:
+            if not self.header:
+                self.header = True
+                current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time.time()))
+                self.add(f"time: {current_time} pid: {os.getpid()}")
+            self.add(text)
+            if (
+                level >= ERROR
+                or self.size >= BUFFER_SIZE
+                or time.monotonic() - self.last_flush >= FLUSH_INTERVAL
+            ):
+                self.flush()
+
+    def add(self, line):
+        if self.ring is not None:
+            self.ring.append(line)
+            return
+        self.buffer.append(line)
+        self.size += len(line) + 1
+
+    def flush(self):
+        with self.lock:
+            self.last_flush = time.monotonic()
+            if not self.buffer:
+                return
+            data = "\n".join(self.buffer) + "\n"
+            self.buffer = []
+            self.size = 0
+            if self.path is None:
+                return
+            mode = "a"
+            if self.default and not is_worker():
+                try:
+                    if os.path.getsize(self.path) > MAX_LOG_SIZE:
+                        mode = "w"
+                except OSError:
+                    pass
+            try:
+                with open(self.path, mode, encoding="utf-8") as f:
+                    f.write(data)
+            except OSError:
+                pass
+
+    def take_ring(self):
+        """取出并清空环形缓冲中的日志行"""
+        with self.lock:
+            if self.ring is None:
+                return []
+            lines = list(self.ring)
+            self.ring.clear()
+            return lines
+
+    def after_fork(self):
+        # fork 出的工作进程继承了主进程的缓冲，清空后只写自己的日志
+        self.lock = threading.RLock()
+        self.buffer = []
+        self.size = 0
+        self.header = True
+        if self.ring is not None:
+            self.ring = None
+            self.path = None
+
+
+_sink = LogSink()
+
+
+def register_exit_flush():
+    # 进程池的工作进程退出时不执行 atexit，由 multiprocessing 的退出处理写出
+    multiprocessing.util.Finalize(None, _sink.flush, exitpriority=0)
 
-    def write(self, text):
-        with open(self.path, "a", encoding="utf-8") as f:
-            f.write(f"{text}\n")
+
+atexit.register(_sink.flush)
+register_exit_flush()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_sink.after_fork)
+# multiprocessing 启动工作进程时会清空继承来的退出处理 (含上面登记的)，之后才调用 after-fork 回调，
+# 在回调中重新登记。fork 与 spawn 启动方式都会调用
+multiprocessing.util.register_after_fork(_sink, lambda sink: register_exit_flush())
+
+
+class logwriter:
+    """日志对象，各模块的实例共用同一缓冲"""
+
+    def log(self, level, msg, *args):
+        if level < _sink.level:
+            return
+        if args:
+            msg = msg % args
+        if level in LEVEL_NAMES:
+            msg = f"[{LEVEL_NAMES[level]}] {msg}"
+        _sink.emit(level, msg)
+
+    def write(self, text, *args):
+        self.log(INFO, text, *args)
+
+    def debug(self, msg, *args):
+        self.log(DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        self.log(ERROR, msg, *args)
+
+    def enabled(self, level):
+        return level >= _sink.level
+
+    def flush(self):
+        _sink.flush()
+
+    @property
+    def path(self):
+        return _sink.path
+
+
+def configure_logs(path=None, ring=None, level=None):
+    """path: 每个任务单独的日志文件；ring: 只在内存中保留最近的行数；level: debug/info/warning/error"""
+    _sink.configure(path, ring, level)
+
+
+def take_log_ring():
+    return _sink.take_ring()
+
+
+def flush_logs():
+    _sink.flush()
+
+
+def _worker_write(i):
+    logwriter().write("worker %d", i)
+    return os.getpid()
 
 
 if __name__ == "__main__":
+    # 自检: 进程池工作进程中的日志在其退出时写入文件
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+
     log = logwriter()
-    log.write("hello world")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "log.txt")
+        configure_logs(path=path)
+        log.write("hello world")
+        with ProcessPoolExecutor(max_workers=3) as pool:
+            pids = set(pool.map(_worker_write, range(6)))
+        flush_logs()
+        with open(path, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        missing = [i for i in range(6) if f"worker {i}" not in lines]
+        assert not missing, f"工作进程 ({len(pids)} 个) 的日志丢失: {missing}"
+        print(f"ok: {len(lines)} 行，{len(pids)} 个工作进程")
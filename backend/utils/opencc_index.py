@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# 简繁转换的词典编译与匹配器
+#
+# opencc-python-reimplemented 转换时对每个片段反复截取子串查表，并为每次匹配新建树节点。
+# 这里由 OpenCC 的文本词典编译出前缀表 (键及键前缀 -> 转换结果)，每个进程只编译一次；
+# 转换时对每个片段只从各位置沿前缀表查一次可匹配的长度，再按 OpenCC 的规则选取，
+# 结果与 OpenCC(mode).convert 完全一致:
+#
+# - 文本先按空白及标点切分，各段独立转换，分隔符原样保留；
+# - 同一组内的词典依次使用: 在片段中取最长的匹配 (同长取最左)，左右剩余部分继续用同一词典，
+#   无匹配的片段交给组内下一个词典；一个值有多个候选时取第一个；
+# - 多个组依次作用于上一组的结果。
+#
+# 升级 OpenCC 后与其输出逐行对比:
+#     python backend/utils/opencc_index.py --verify a.epub b.txt
+
+import functools
+import json
+import os
+import re
+import sys
+
+try:
+    from utils.log import logwriter
+except ImportError:
+    from log import logwriter
+
+logger = logwriter()
+
+MODES = ("s2t", "t2s")
+_MISSING = object()
+
+# 与 OpenCC 相同的分隔符 (来自 OpenCC PhraseExtract.cpp)，词典中的键不含这些字符
+SPLIT_CHARS_RE = re.compile(
+    r'(\s+|-|,|\.|\?|!|\*|　|，|。|、|；|：|？|！|…|“|”|‘|’|『|』|「|」|﹁|﹂|—|－|（|）|《|》|〈|〉|～|．|／|＼|︒|︑|︔|︓|︿|﹀|︹|︺|︙|︐|［|﹇|］|﹈|︕|︖|︰|︳|︴|︽|︾|︵|︶|｛|︷|｝|︸|﹃|﹄|【|︻|】|︼)')
+
+
+def opencc_dir():
+    # 已安装的 opencc 包目录；未安装 (如打包后) 时返回 None
+    try:
+        import opencc
+    except ImportError:
+        return None
+    return os.path.dirname(os.path.abspath(opencc.__file__))
+
+
+def chain_files(mode, base_dir):
+    # 按配置文件得到词典链: [[组内词典文件, ...], ...]
+    with open(os.path.join(base_dir, "config", mode + ".json"), encoding="utf-8") as f:
+        config = json.load(f)
+    chain = []
+    for item in config.get("conversion_chain"):
+        entry = item.get("dict")
+        dicts = entry.get("dicts") if entry.get("type") == "group" else [entry]
+        chain.append([os.path.join(base_dir, "dictionary", d.get("file")) for d in dicts])
+    return chain
+
+
+def load_dict(file):
+    # 与 OpenCC 相同的读法: 每行 "键<TAB>值"，多个候选以空格分隔时只取第一个
+    mapping = {}
+    with open(file, encoding="utf-8") as f:
+        for line in f:
+            key, value = line.strip().split("\t")
+            mapping[key] = value.split(" ")[0]
+    return mapping
+
+
+def compile_dict(mapping):
+    # (最长键长, 最短键长, 查找表)，键长的默认值与 OpenCC 相同；
+    # 查找表包含全部键及键前缀，仅为前缀者值为 None
+    max_len = max([1] + [len(key) for key in mapping])
+    min_len = min([1000] + [len(key) for key in mapping])
+    table = {}
+    for key in mapping:
+        for i in range(1, len(key)):
+            table.setdefault(key[:i], None)
+    table.update(mapping)
+    return max_len, min_len, table
+
+
+def compile_chain(mode):
+    base_dir = opencc_dir()
+    if base_dir is None:
+        raise RuntimeError("未安装 opencc，无法编译简繁转换词典")
+    return [[compile_dict(load_dict(file)) for file in group] for group in chain_files(mode, base_dir)]
+
+
+class OpenCCMatcher:
+    """与 OpenCC(mode).convert 结果相同的转换器"""
+
+    # 片段转换结果的缓存上限 (条)，超过后清空
+    CACHE_SIZE = 200000
+
+    def __init__(self, chain):
+        self.chain = chain
+        self.cache = {}
+
+    def convert(self, string):
+        parts = SPLIT_CHARS_RE.split(string)
+        cache = self.cache
+        for i in range(0, len(parts), 2):
+            segment = parts[i]
+            if not segment:
+                continue
+            result = cache.get(segment)
+            if result is None:
+                result = segment
+                for group in self.chain:
+                    result = self.convert_group(result, group)
+                if len(cache) >= self.CACHE_SIZE:
+                    cache.clear()
+                cache[segment] = result
+            parts[i] = result
+        return "".join(parts)
+
+    def convert_group(self, segment, group):
+        # 每个词典只扫描一次: 各位置可匹配的键长 (从长到短)
+        n = len(segment)
+        lengths = []
+        for _, _, table in group:
+            found = []
+            for i in range(n):
+                matched = []
+                j = i + 1
+                while j <= n:
+                    value = table.get(segment[i:j], _MISSING)
+                    if value is _MISSING:
+                        break
+                    if value is not None:
+                        matched.append(j - i)
+                    j += 1
+                matched.reverse()
+                found.append(matched)
+            lengths.append(found)
+        out = []
+        self._emit(segment, 0, n, 0, group, lengths, out)
+        return "".join(out)
+
+    def _emit(self, segment, start, end, level, group, lengths, out):
+        # 在 segment[start:end] 中按 OpenCC 的规则替换，结果依次追加到 out
+        while True:
+            if start >= end:
+                return
+            if level == len(group):
+                out.append(segment[start:end])
+                return
+            table = group[level][2]
+            # 最长的匹配，同长取最左 (与 OpenCC 从长到短、从左到右的查找顺序相同)
+            best_at, best_len = -1, 0
+            for i in range(start, end):
+                for length in lengths[level][i]:
+                    if i + length <= end:
+                        if length > best_len:
+                            best_at, best_len = i, length
+                        break
+            if best_len == 0:
+                # 无匹配: 整个片段交给组内下一个词典
+                level += 1
+                continue
+            self._emit(segment, start, best_at, level, group, lengths, out)
+            out.append(table[segment[best_at : best_at + best_len]])
+            # 右侧部分继续用同一词典 (循环代替尾递归)
+            start = best_at + best_len
+
+
+@functools.lru_cache(maxsize=None)
+def load_matcher(mode):
+    """由 OpenCC 的词典文件编译匹配器，每个进程每种模式只编译一次；不可用时返回 None"""
+    try:
+        return OpenCCMatcher(compile_chain(mode))
+    except (OSError, ValueError, RuntimeError) as e:
+        logger.write(f"简繁转换词典编译失败: {e}")
+        return None
+
+
+def iter_texts(path):
+    # 校验用语料: EPUB 中的各 HTML/NCX/OPF 文档，或文本文件
+    if path.lower().endswith(".epub"):
+        import zipfile
+
+        with zipfile.ZipFile(path) as z:
+            for name in z.namelist():
+                if name.lower().endswith((".html", ".xhtml", ".htm", ".ncx", ".opf")):
+                    yield name, z.read(name).decode("utf-8", "replace")
+    else:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            yield path, f.read()
+
+
+def verify(paths):
+    """与 OpenCC(mode).convert 逐行对比，返回不一致的行数"""
+    from opencc import OpenCC
+
+    mismatches = 0
+    for mode in MODES:
+        reference = OpenCC(mode)
+        matcher = load_matcher(mode)
+        lines = 0
+        for path in paths:
+            for name, text in iter_texts(path):
+                for line in text.splitlines():
+                    lines += 1
+                    expected = reference.convert(line)
+                    if matcher.convert(line) != expected:
+                        mismatches += 1
+                        print(f"[{mode}] {name}: {line[:80]!r}")
+        print(f"[{mode}] 已对比 {lines} 行")
+    return mismatches
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "--verify":
+        print("用法: python opencc_index.py --verify a.epub b.txt ...")
+        sys.exit(2)
+    sys.exit(1 if verify(sys.argv[2:]) else 0)
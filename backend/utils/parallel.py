@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# 进程池辅助: 按提交顺序取回结果
+#
+# 各功能模块在主线程中按压缩包原有顺序提交任务，工作进程并行处理，
+# 结果仍按提交顺序写回，保证输出确定。在途任务数有上限，避免整本书同时驻留内存。
+
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+
+def resolve_workers(workers):
+    # None / 1: 串行；0 或 "auto": 使用全部 CPU；其余为进程数
+    if workers in (None, ""):
+        return 1
+    if workers == "auto":
+        return os.cpu_count() or 1
+    workers = int(workers)
+    if workers <= 0:
+        return os.cpu_count() or 1
+    return workers
+
+
+class OrderedExecutor:
+    def __init__(self, workers=1, initializer=None, initargs=(), max_in_flight=None, max_in_flight_bytes=None):
+        self.workers = resolve_workers(workers)
+        self.max_in_flight = max_in_flight or self.workers * 4
+        # 在途数据的总字节数上限 (流式处理时使用)，submit 时登记各任务的数据大小
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.pending_size = 0
+        self.pending = deque()  # [ (key, Future, 数据大小) , ... ]
+        self.pool = None
+        if self.workers > 1:
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.workers, initializer=initializer, initargs=initargs
+            )
+
+    def submit(self, key, func, *args, size=0):
+        # 单进程时直接在当前进程执行
+        if self.pool is not None:
+            future = self.pool.submit(func, *args)
+        else:
+            future = Future()
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+        self.pending.append((key, future, size))
+        self.pending_size += size
+
+    def put(self, key, value):
+        # 无需处理的项也排队，保持顺序
+        future = Future()
+        future.set_result(value)
+        self.pending.append((key, future, 0))
+
+    def results(self, wait=False):
+        # 依次取出队首已完成的结果；在途任务或数据量超过上限、或 wait 为 True 时阻塞等待
+        while self.pending:
+            key, future, size = self.pending[0]
+            if not (wait or future.done() or self.over_limit()):
+                break
+            self.pending.popleft()
+            self.pending_size -= size
+            yield key, future.result()
+
+    def over_limit(self):
+        if len(self.pending) > self.max_in_flight:
+            return True
+        return self.max_in_flight_bytes is not None and self.pending_size > self.max_in_flight_bytes
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+        self.pending.clear()
+        self.pending_size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def map_members(epub, names, func, workers=1, max_in_flight=None, max_in_flight_bytes=None, size_of=None):
+    # 按 names 顺序产出 (name, func(name, data))，func 需为模块级函数以便在工作进程中执行；
+    # 读取与写回都留在调用方线程，在途的成员数据不超过 max_in_flight 个 (及 max_in_flight_bytes 字节)。
+    # size_of(name, data) 给出计入 max_in_flight_bytes 的大小，默认为数据长度
+    with OrderedExecutor(workers, max_in_flight=max_in_flight, max_in_flight_bytes=max_in_flight_bytes) as executor:
+        for name in names:
+            data = epub.read(name)
+            size = size_of(name, data) if size_of is not None else len(data)
+            executor.submit(name, func, name, data, size=size)
+            del data
+            yield from executor.results()
+        yield from executor.results(wait=True)
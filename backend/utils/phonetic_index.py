@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# 注音字典的预编译索引
+#
+# 字典以 Python 字面量形式存放 (dict/ShengPiZi.py、dict/Phrases.py)，导入时要反序列化数万个列表对象，
+# 再合并、建表。这里把合并后的字典预先编译为 dict/phonetic.idx：
+# 键及键前缀按 UTF-8 字节序排列为定长记录，是否为键/是否有子节点的标志已预先算好。
+# 运行时首次查询才 mmap 索引文件，按需二分查找，各工作进程共享同一份页缓存。
+#
+# 修改字典后重新生成索引:
+#     python backend/utils/phonetic_index.py
+
+import hashlib
+import importlib
+import mmap
+import os
+import struct
+import sys
+
+try:
+    from utils.log import logwriter
+    from utils.phonetic_matcher import PhoneticMatcher, PhoneticTable, build_table, make_entry
+except ImportError:
+    from log import logwriter
+    from phonetic_matcher import PhoneticMatcher, PhoneticTable, build_table, make_entry
+
+logger = logwriter()
+
+DICT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dict")
+INDEX_PATH = os.path.join(DICT_DIR, "phonetic.idx")
+# 合并顺序: 后者覆盖前者
+SOURCES = (("ShengPiZi", "shengpizi_dict"), ("Phrases", "phrases_dict"))
+
+MAGIC = b"EPUBPHI1"
+# 文件头: 标识, 字典源文件摘要, 记录数
+HEADER = struct.Struct("<8s20sI")
+# 单字位图: 每个码位一位，标记该字是否为键或键前缀，用于快速跳过无关字符
+BITMAP_SIZE = 0x110000 // 8
+# 记录: 键偏移, 注音偏移, 键长度, 注音长度, 标志
+RECORD = struct.Struct("<IIHHB3x")
+IS_KEY, HAVE_CHILD, EMPTY_VALUE = 1, 2, 4
+SEP = "\x1f"  # 多个读音之间的分隔符
+
+
+def import_dict(module_name):
+    # 与原有各模块相同的导入顺序: 包内导入，其次从 dict 目录直接导入
+    for name in ("utils.dict." + module_name, "dict." + module_name):
+        try:
+            return importlib.import_module(name)
+        except ImportError:
+            continue
+    if DICT_DIR not in sys.path:
+        sys.path.append(DICT_DIR)
+    return importlib.import_module(module_name)
+
+
+def load_mapping():
+    mapping = {}
+    for module_name, attr in SOURCES:
+        mapping.update(getattr(import_dict(module_name), attr))
+    return mapping
+
+
+def source_digest():
+    # 字典源文件的摘要；打包后没有源文件时返回 None
+    sha1 = hashlib.sha1()
+    for module_name, _ in SOURCES:
+        source = os.path.join(DICT_DIR, module_name + ".py")
+        if not os.path.exists(source):
+            return None
+        with open(source, "rb") as f:
+            sha1.update(f.read())
+    return sha1.digest()
+
+
+def build_index(mapping, path=INDEX_PATH, digest=None):
+    have_child = set()
+    for key in mapping:
+        for i in range(1, len(key)):
+            have_child.add(key[:i])
+    keys = sorted(set(mapping) | have_child, key=lambda k: k.encode("utf-8"))
+
+    bitmap = bytearray(BITMAP_SIZE)
+    records = bytearray()
+    pool = bytearray()
+    for key in keys:
+        if len(key) == 1:
+            bitmap[ord(key) >> 3] |= 1 << (ord(key) & 7)
+        bkey = key.encode("utf-8")
+        key_offset = len(pool)
+        pool += bkey
+        flags = HAVE_CHILD if key in have_child else 0
+        value_offset, value_len = len(pool), 0
+        if key in mapping:
+            flags |= IS_KEY
+            value = mapping[key]
+            if not value:
+                flags |= EMPTY_VALUE
+            else:
+                bvalue = SEP.join(value).encode("utf-8")
+                pool += bvalue
+                value_len = len(bvalue)
+        records += RECORD.pack(key_offset, value_offset, len(bkey), value_len, flags)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, digest or bytes(20), len(keys)))
+        f.write(bitmap)
+        f.write(records)
+        f.write(pool)
+    os.replace(tmp_path, path)
+    return len(keys)
+
+
+class PhoneticIndex:
+    """只读的预编译索引，首次查询时才打开并 mmap 文件"""
+
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        self.mm = None
+
+    def open(self):
+        with open(self.path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.digest, self.count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            self.mm.close()
+            self.mm = None
+            raise ValueError(f"无效的注音索引文件: {self.path}")
+        self.bitmap_offset = HEADER.size
+        self.records_offset = self.bitmap_offset + BITMAP_SIZE
+        self.pool_offset = self.records_offset + self.count * RECORD.size
+
+    def read_digest(self):
+        with open(self.path, "rb") as f:
+            magic, digest, _ = HEADER.unpack(f.read(HEADER.size))
+        return digest if magic == MAGIC else None
+
+    def lookup(self, key):
+        # 返回与 build_table 相同的表项，不是键也不是键前缀时返回 None
+        if self.mm is None:
+            self.open()
+        mm = self.mm
+        if len(key) == 1:
+            code = ord(key)
+            if not mm[self.bitmap_offset + (code >> 3)] & (1 << (code & 7)):
+                return None
+        bkey = key.encode("utf-8")
+        pool = self.pool_offset
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key_offset, value_offset, key_len, value_len, flags = RECORD.unpack_from(
+                mm, self.records_offset + mid * RECORD.size
+            )
+            current = mm[pool + key_offset : pool + key_offset + key_len]
+            if current < bkey:
+                lo = mid + 1
+            elif current > bkey:
+                hi = mid
+            else:
+                if not flags & IS_KEY:
+                    return make_entry(key, None, True)
+                if flags & EMPTY_VALUE:
+                    value = []
+                else:
+                    start = pool + value_offset
+                    value = mm[start : start + value_len].decode("utf-8").split(SEP)
+                return make_entry(key, value, bool(flags & HAVE_CHILD))
+        return None
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+
+def load_matcher():
+    """优先使用预编译索引；索引缺失或与字典源文件不一致时直接由字典建表"""
+    if os.path.exists(INDEX_PATH):
+        index = PhoneticIndex(INDEX_PATH)
+        digest = source_digest()
+        if digest is None or digest == index.read_digest():
+            return PhoneticMatcher(PhoneticTable(index))
+        logger.write("注音索引与字典不一致，改为直接加载字典 (可运行 phonetic_index.py 重新生成)")
+    return PhoneticMatcher(build_table(load_mapping()))
+
+
+if __name__ == "__main__":
+    count = build_index(load_mapping(), INDEX_PATH, source_digest())
+    print(f"已生成注音索引: {INDEX_PATH} ({count} 条记录)")
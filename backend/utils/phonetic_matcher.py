@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# 生僻字/短语注音匹配器
+#
+# 原 Converter 逐字喂给 StatesMachine，每个分支都 deepcopy 状态机，每次查表都新建 Node。
+# 这里把字典编译成查找表 (键及键前缀 -> 是否为键、是否有子节点)，对一段文本单次线性扫描完成注音，
+# 结果与原状态机完全一致：
+#
+# - 原状态机并行尝试所有切分方式（单字，或字典中的多字键），所有分支同时结束时
+#   (即没有任何未完成的前缀) 取其中词数最少者；词数相同时取最早创建的分支。
+# - 分支创建顺序等价于: 把每种切分在各位置 "继续匹配更长的键" 的选择记为二进制位，
+#   数值越小越早。因此在每个同步段内按 (词数, 该数值) 做动态规划即可得到相同结果。
+# - 注音记录 (LOG) 同样按原状态机的顺序写入: 每个位置上结束的叶子键按分支创建顺序登记。
+
+__all__ = ["PhoneticMatcher", "PhoneticTable", "build_table", "render_phonetic"]
+
+
+def render_phonetic(word, phonetic):
+    """与原 Node.add_phonetic 相同的输出格式"""
+    if isinstance(phonetic, str):
+        return phonetic
+    if len(word) == 1:
+        return "<ruby>" + word + "<rt>" + phonetic[0] + "</rt></ruby>"
+    if len(word) == len(phonetic):
+        result = ""
+        for char, rt in zip(word, phonetic):
+            result += "<ruby>" + char + "<rt>" + rt + "</rt></ruby>" if rt else char
+        return result
+    return word
+
+
+def make_entry(key, value, have_child):
+    # 表项: (键信息, 是否有子节点)，键信息为 (键, 注音, 输出文本)，仅为键前缀时为 None
+    if value is None:
+        return None, have_child
+    phonetic = value or key  # 字典中存在该键但对应值为空，则返回原值
+    return (key, phonetic, render_phonetic(key, phonetic)), have_child
+
+
+class PhoneticTable(dict):
+    """{ 键或键前缀 : 表项 }，查不到的键由 index 补全 (预编译索引按需读取)，结果缓存在表中"""
+
+    def __init__(self, index=None):
+        super().__init__()
+        self.index = index
+
+    def __missing__(self, key):
+        entry = self.index.lookup(key) if self.index is not None else None
+        self[key] = entry
+        return entry
+
+
+def build_table(mapping):
+    """由字典直接建表 (无预编译索引时使用)"""
+    have_child = {}
+    for key in mapping:
+        for i in range(1, len(key)):
+            have_child[key[:i]] = True
+    table = PhoneticTable()
+    for key in have_child:
+        if key not in mapping:
+            table[key] = make_entry(key, None, True)
+    for key, value in mapping.items():
+        table[key] = make_entry(key, value, key in have_child)
+    return table
+
+
+class PhoneticMatcher:
+    def __init__(self, table):
+        self.table = table
+
+    def convert(self, string, logs=(), record_matched=False):
+        """为一段文本注音；logs 为需要登记注音记录的 dict，
+        record_matched 为 True 时长键匹配失败也登记其中已匹配的较短键 (phonetic_notation 的行为)"""
+        table = self.table
+        out = []
+        # 同步段: 段首位置、各边界的最优切分 [(词数, 分支序, 起点, 输出), ...]
+        seg_start = 0
+        best = [(0, 0, 0, "")]
+        # 进行中的多字匹配: [(起点, 已匹配的前缀, 分支序, 最近一次匹配到的键信息), ...]
+        walks = []
+
+        for i, char in enumerate(string):
+            r = i - seg_start
+            entry = table[char]
+            if entry is None and not walks:
+                # 无关字符，且没有进行中的匹配: 直接输出
+                out.append(char)
+                seg_start = i + 1
+                continue
+
+            count, order = best[r][0] + 1, best[r][1]
+            info, have_child = entry if entry is not None else (None, False)
+            # 单字切分总是可行
+            candidate = (count, order, r, info[2] if info is not None else char)
+            events = None
+            if info is not None and not have_child:
+                events = [(0, info)]
+
+            next_walks = []
+            for start, prefix, worder, matched in walks:
+                prefix += char
+                child = table[prefix]
+                if child is None:
+                    if record_matched and matched is not None:
+                        events = events or []
+                        events.append((worder, matched))
+                    continue
+                cinfo, cchild = child
+                if cinfo is not None:
+                    prev = best[start]
+                    token = (prev[0] + 1, prev[1] + worder, start, cinfo[2])
+                    if token < candidate:
+                        candidate = token
+                    if not cchild:
+                        events = events or []
+                        events.append((worder, cinfo))
+                        continue
+                    next_walks.append((start, prefix, worder | (1 << r), cinfo))
+                else:
+                    next_walks.append((start, prefix, worder, matched))
+
+            if have_child:
+                next_walks.append((r, char, 1 << r, info))
+
+            if events is not None:
+                if len(events) > 1:
+                    events.sort(key=lambda event: event[0])
+                for _, (key, phonetic, _) in events:
+                    for log in logs:
+                        log[key] = phonetic
+
+            best.append(candidate)
+            walks = next_walks
+            if not walks:
+                self._flush(best, out)
+                best = [(0, 0, 0, "")]
+                seg_start = i + 1
+
+        # 未完成的匹配直接丢弃
+        if len(best) > 1:
+            self._flush(best, out)
+        return "".join(out)
+
+    def _flush(self, best, out):
+        # 从段尾回溯出最优切分
+        tokens = []
+        r = len(best) - 1
+        while r > 0:
+            _, _, start, text = best[r]
+            tokens.append(text)
+            r = start
+        out.extend(reversed(tokens))
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import importlib
 import os
 import re
 import zipfile
@@ -10,8 +11,14 @@ from typing import Sized
 
 try:
     from utils.log import logwriter
+    from utils.epub_container import EpubContainer
+    from utils.parallel import OrderedExecutor
+    from utils.phonetic_index import import_dict, load_matcher
 except ImportError:
     from log import logwriter
+    from epub_container import EpubContainer
+    from parallel import OrderedExecutor
+    from phonetic_index import import_dict, load_matcher
 
 logger = logwriter()
 
@@ -28,23 +35,23 @@ UEMPTY = ''
 
 # 全局变量
 MAPS = {}
+MATCHER = None  # 编译后的匹配器，未开启不重复注音时使用
 LOG = {}
 LOG_PER_PAGE = {}
 
-# 导入字典 - 尝试多种导入方式
-try:
-    # 首先尝试相对导入（作为模块使用时）
-    from .dict.ShengPiZi import shengpizi_dict
-    from .dict.Phrases import phrases_dict
-    from .dict.国标一二级汉字 import GB_lev_1
-    from .dict.完整拼音字典 import pinyin_dict
-except ImportError:
+# 字典模块 (体积较大，首次访问时才导入)
+DICT_MODULES = {
+    'shengpizi_dict': 'ShengPiZi',
+    'phrases_dict': 'Phrases',
+    'GB_lev_1': '国标一二级汉字',
+    'pinyin_dict': '完整拼音字典',
+}
+
+
+def load_dict(name):
+    """按需导入字典，导入后缓存为模块属性"""
     try:
-        # 尝试绝对导入（直接运行时）
-        from dict.ShengPiZi import shengpizi_dict
-        from dict.Phrases import phrases_dict
-        from dict.国标一二级汉字 import GB_lev_1
-        from dict.完整拼音字典 import pinyin_dict
+        module = import_dict(DICT_MODULES[name])
     except ImportError as e:
         logger.write(f"导入字典失败: {e}")
         # 尝试从PhoneticNotation目录导入
@@ -52,13 +59,20 @@ except ImportError:
         phonetic_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'PhoneticNotation', 'Dict')
         sys.path.insert(0, phonetic_path)
         try:
-            from ShengPiZi import shengpizi_dict
-            from Phrases import phrases_dict
-            from 国标一二级汉字 import GB_lev_1
-            from 完整拼音字典 import pinyin_dict
+            module = importlib.import_module(DICT_MODULES[name])
         except ImportError as e2:
             logger.write(f"所有字典导入尝试均失败: {e2}")
             raise ImportError("无法导入生僻字字典，请检查字典文件是否存在")
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+
+def __getattr__(name):
+    # 兼容原有的 phonetic_notation.shengpizi_dict 等访问方式
+    if name in DICT_MODULES:
+        return load_dict(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 
@@ -153,16 +167,24 @@ class ConvertMap(object):
 
 
 def init_maps():
-    """初始化转换映射表"""
+    """初始化匹配器 (优先使用预编译索引)"""
+    global MATCHER
+    MATCHER = load_matcher()
+
+
+def init_legacy_maps():
+    """初始化逐字状态机使用的转换映射表，仅开启不重复注音时需要"""
     global MAPS
     
     mapping = {}
     
     # 合并生僻字字典
+    shengpizi_dict = load_dict('shengpizi_dict')
     for code in shengpizi_dict:
         mapping[code] = shengpizi_dict[code]
     
     # 合并短语词典
+    phrases_dict = load_dict('phrases_dict')
     for key in phrases_dict:
         mapping[key] = phrases_dict[key]
     
@@ -304,6 +326,13 @@ class Converter(object):
 
     def convert(self, string):
         """转换字符串"""
+        if not (BOOK_NOREPEAT_SWITCH or PAGE_NOREPEAT_SWITCH):
+            # 不重复注音依赖逐字更新的注音记录，只有关闭时才能整段一次匹配
+            self.final = MATCHER.convert(string, (LOG, LOG_PER_PAGE), record_matched=True)
+            return self.get_result()
+        if not MAPS:
+            init_legacy_maps()
+        self.map = MAPS
         self.start()
         for char in string:
             self.feed(char)
@@ -317,9 +346,9 @@ class Converter(object):
 def convert_chars(match):
     """简单的字符转换函数（不使用短语词典）"""
     text = ''
+    shengpizi_dict = load_dict('shengpizi_dict')
     for char in match.group():
         try:
-            MAPS[char]
             if BOOK_NOREPEAT_SWITCH and char in LOG.keys():
                 text += char
             elif PAGE_NOREPEAT_SWITCH and char in LOG_PER_PAGE.keys():
@@ -364,14 +393,59 @@ def generate_log(output_file=None):
     return text
 
 
+def annotate_html(html_content):
+    """处理HTML内容"""
+    # 查找body标签
+    body_match = re.search(r'<body[^>]*>.*</body>', html_content, re.S)
+    if body_match is None:
+        return html_content
+    
+    body_text = body_match.group()
+    
+    # 清空当前页面的日志
+    global LOG_PER_PAGE
+    LOG_PER_PAGE.clear()
+    
+    # 根据开关选择转换方式
+    if READ_PHRASES:
+        # 使用完整的转换器（支持短语词典）
+        conv_text = re.sub(
+            r'(?<!<ruby>)[^\x20-\x7E\r\n]+',
+            lambda x: Converter().convert(x.group()),
+            body_text
+        )
+    else:
+        # 使用简单的字符转换
+        conv_text = re.sub(
+            r'(?<!<ruby>)[^\x20-\x7E\r\n]+',
+            convert_chars,
+            body_text
+        )
+    
+    # 替换原body内容
+    new_html = html_content[:body_match.start()] + conv_text + html_content[body_match.end():]
+    return new_html
+
+
+def annotate_document(content):
+    """为单个 HTML 文档注音，返回 (新内容, 本文档注音记录, 错误信息)；可在工作进程中执行"""
+    LOG.clear()
+    try:
+        new_content = annotate_html(content.decode('utf-8')).encode('utf-8')
+        return new_content, dict(LOG), None
+    except Exception as e:
+        return None, dict(LOG), str(e)
+
+
 class PhoneticAnnotate:
     """EPUB生僻字注音处理器"""
-    def __init__(self, epub_path, output_path=None):
+    def __init__(self, epub_path, output_path=None, workers=1):
         if not os.path.exists(epub_path):
             raise Exception("EPUB文件不存在")
 
         self.epub_path = os.path.normpath(epub_path)
-        self.epub = zipfile.ZipFile(epub_path)
+        self.container = EpubContainer(epub_path)
+        self.epub = self.container.epub
         
         if output_path is None:
             # 未指定输出路径，使用原始EPUB文件所在目录
@@ -400,6 +474,7 @@ class PhoneticAnnotate:
             os.remove(self.file_write_path)
         
         self.target_epub = None
+        self.workers = workers  # 并行注音章节的进程数
         
         # 初始化全局变量
         global LOG, LOG_PER_PAGE
@@ -412,24 +487,34 @@ class PhoneticAnnotate:
             # 创建目标EPUB文件
             self.target_epub = zipfile.ZipFile(self.file_write_path, 'w', zipfile.ZIP_DEFLATED)
             
-            # 遍历EPUB中的所有文件
-            for file_info in self.epub.infolist():
-                file_name = file_info.filename
-                
-                # 跳过不需要处理的文件
-                if file_name.startswith('__MACOSX') or file_name.startswith('.DS_Store'):
-                    continue
-                
-                # 读取文件内容
-                content = self.epub.read(file_name)
-                
-                # 处理HTML/XHTML文件
-                if file_name.lower().endswith(('.html', '.xhtml', '.htm')):
-                    processed_content = self.process_html_content(content.decode('utf-8'))
-                    self.target_epub.writestr(file_name, processed_content.encode('utf-8'))
-                else:
-                    # 非HTML文件直接复制
-                    self.target_epub.writestr(file_info, content)
+            # 整本书不重复注音依赖前面章节的注音记录，只能按顺序处理
+            workers = 1 if BOOK_NOREPEAT_SWITCH else self.workers
+            book_log = {}
+            with OrderedExecutor(workers) as executor:
+                # 遍历EPUB中的所有文件
+                for file_info in self.epub.infolist():
+                    file_name = file_info.filename
+                    
+                    # 跳过不需要处理的文件
+                    if file_name.startswith('__MACOSX') or file_name.startswith('.DS_Store'):
+                        continue
+                    
+                    # 处理HTML/XHTML文件
+                    if file_name.lower().endswith(('.html', '.xhtml', '.htm')):
+                        if workers > 1:
+                            executor.submit(file_info, annotate_document, self.epub.read(file_name))
+                        else:
+                            processed_content = self.process_html_content(self.epub.read(file_name).decode('utf-8'))
+                            executor.put(file_info, (processed_content.encode('utf-8'), None, None))
+                    else:
+                        # 非HTML文件直接复制
+                        executor.put(file_info, None)
+                    self.write_results(executor.results(), book_log)
+                self.write_results(executor.results(wait=True), book_log)
+            if workers > 1:
+                # 各文档的注音记录按原有顺序合并
+                LOG.clear()
+                LOG.update(book_log)
             
             logger.write(f"生僻字注音完成，输出文件: {self.file_write_path}")
             return self.file_write_path
@@ -440,38 +525,21 @@ class PhoneticAnnotate:
         finally:
             self.close_file()
 
+    def write_results(self, results, book_log):
+        for file_info, result in results:
+            if result is None:
+                self.container.copy_to(self.target_epub, file_info)
+                continue
+            processed_content, doc_log, error = result
+            if error is not None:
+                raise Exception(f"文件 {file_info.filename} 注音失败: {error}")
+            if doc_log:
+                book_log.update(doc_log)
+            self.target_epub.writestr(file_info.filename, processed_content)
+
     def process_html_content(self, html_content):
         """处理HTML内容"""
-        # 查找body标签
-        body_match = re.search(r'<body[^>]*>.*</body>', html_content, re.S)
-        if body_match is None:
-            return html_content
-        
-        body_text = body_match.group()
-        
-        # 清空当前页面的日志
-        global LOG_PER_PAGE
-        LOG_PER_PAGE.clear()
-        
-        # 根据开关选择转换方式
-        if READ_PHRASES:
-            # 使用完整的转换器（支持短语词典）
-            conv_text = re.sub(
-                r'(?<!<ruby>)[^\x20-\x7E\r\n]+',
-                lambda x: Converter().convert(x.group()),
-                body_text
-            )
-        else:
-            # 使用简单的字符转换
-            conv_text = re.sub(
-                r'(?<!<ruby>)[^\x20-\x7E\r\n]+',
-                convert_chars,
-                body_text
-            )
-        
-        # 替换原body内容
-        new_html = html_content[:body_match.start()] + conv_text + html_content[body_match.end():]
-        return new_html
+        return annotate_html(html_content)
 
     def close_file(self):
         """关闭ZIP文件"""
@@ -487,17 +555,17 @@ class PhoneticAnnotate:
             logger.write(f"删除临时文件: {self.file_write_path}")
 
 
-def run_add_pinyin(epub_path, output_path=None):
+def run_add_pinyin(epub_path, output_path=None, workers=1):
     """运行生僻字注音功能的主函数"""
     logger.write(f"\n正在尝试给EPUB添加生僻字注音: {epub_path}")
     
     # 确保字典已初始化
-    if not MAPS:
+    if MATCHER is None:
         init_maps()
     
     phonetic_tool = None
     try:
-        phonetic_tool = PhoneticAnnotate(epub_path, output_path)
+        phonetic_tool = PhoneticAnnotate(epub_path, output_path, workers)
         output_file = phonetic_tool.process_file()
         
         # 生成日志
@@ -2,185 +2,31 @@ import zipfile
 import os
 import re
 import time
-from copy import deepcopy
-from bs4 import BeautifulSoup, NavigableString, Comment, Doctype, ProcessingInstruction, Declaration
+from bs4 import BeautifulSoup
 import traceback
 
 try:
     from utils.log import logwriter
+    from utils.epub_container import EpubContainer
+    from utils.parallel import OrderedExecutor
+    from utils.phonetic_index import load_matcher
+    from utils.incremental import member_digest, open_manifest
+    from utils.html_engine import get_engine
+    from utils import progress
 except ImportError:
     from log import logwriter
-
-try:
-    # Attempt relative import first
-    from .dict import ShengPiZi
-    from .dict import Phrases
-except ImportError:
-    # Fallback to absolute import if running from root
-    try:
-        from utils.dict import ShengPiZi
-        from utils.dict import Phrases
-    except ImportError:
-        # Last resort for direct execution
-        import sys
-        sys.path.append(os.path.join(os.path.dirname(__file__), 'dict'))
-        import ShengPiZi
-        import Phrases
+    from epub_container import EpubContainer
+    from parallel import OrderedExecutor
+    from phonetic_index import load_matcher
+    from incremental import member_digest, open_manifest
+    from html_engine import get_engine
+    import progress
 
 logger = logwriter()
 
-# Global Constants
-UEMPTY = ''
-# states
-(START, END, FAIL, WAIT_TAIL) = list(range(4))
-# conditions
-(TAIL, ERROR, MATCHED_SWITCH, UNMATCHED_SWITCH, CONNECTOR) = list(range(5))
-
 MAPS = None
 LOG = {}
-
-class Node(object):
-    def __init__(self, from_word, to_phonetic=None, is_tail=True,
-            have_child=False):
-        self.from_word = from_word
-        if to_phonetic is None: #字典中没有该键
-            self.to_phonetic = from_word
-            self.is_original = True #需返回原值
-        else: #字典中存在该键
-            self.to_phonetic = to_phonetic or from_word 
-            self.is_original = False
-
-        self.is_tail = is_tail 
-        self.have_child = have_child
-
-    def is_original_long_word(self): # 在字典中找不到键的短语
-        return self.is_original and len(self.from_word)>1
-
-    def is_follow(self, chars): #查询传入字符串是否该节点键值前缀部分
-        return chars != self.from_word[:-1]
-
-    def add_phonetic(self):
-        if type(self.to_phonetic) == str:
-            return self.to_phonetic
-        elif type(self.to_phonetic) == list:
-            if len(self.from_word) == 1:
-                return '<ruby>' + self.from_word+'<rt>'+self.to_phonetic[0] +'</rt></ruby>'
-            elif len(self.from_word) > 1 and len(self.from_word) == len(self.to_phonetic):
-                index,result = 0,''
-                for char in self.from_word:
-                    result = result + char if not self.to_phonetic[index]\
-                           else result + '<ruby>' + char + '<rt>' + self.to_phonetic[index] +'</rt></ruby>'
-                    index += 1
-                return result
-        return self.from_word
-
-class ConvertMap(object):
-    def __init__(self, mapping=None):
-        self._map = {}
-        if mapping:
-            self.set_convert_map(mapping)
-
-    def set_convert_map(self, mapping):
-        convert_map = {}
-        have_child = {}
-        max_key_length = 0
-        for key in sorted(mapping.keys()):
-            if len(key)>1:
-                for i in range(1, len(key)):
-                    parent_key = key[:i]
-                    have_child[parent_key] = True
-            have_child[key] = False
-            max_key_length = max(max_key_length, len(key))
-        for key in sorted(have_child.keys()):
-            convert_map[key] = (key in mapping, have_child[key],
-                    mapping.get(key, UEMPTY))
-        self._map = convert_map
-        self.max_key_length = max_key_length
-
-    def __getitem__(self, k):
-        try:
-            is_tail, have_child, to_phonetic  = self._map[k]
-            return Node(k, to_phonetic, is_tail, have_child)
-        except:
-            return Node(k)
-
-    def __contains__(self, k):
-        return k in self._map
-
-class StatesMachineException(Exception): pass
-
-class StatesMachine(object):
-    def __init__(self):
-        self.state = START
-        self.final = UEMPTY
-        self.len = 0
-        self.pool = UEMPTY
-        self.last_matched = None 
-
-    def clone(self, pool):
-        new = deepcopy(self)
-        new.state = WAIT_TAIL
-        new.pool = pool
-        new.last_matched = self.last_matched
-        return new
-
-    def feed(self, char, map):
-        self.node = node = map[self.pool+char]
-        if node.have_child:
-            if node.is_tail:
-                if node.is_original: 
-                    cond = UNMATCHED_SWITCH
-                else: 
-                    cond = MATCHED_SWITCH
-            else: 
-                cond = CONNECTOR
-        else: 
-            if node.is_tail: 
-                cond = TAIL
-            else: 
-                cond = ERROR
-
-        new = None
-        if cond == ERROR:
-            self.state = FAIL
-        elif cond == TAIL:
-            if self.state == WAIT_TAIL and node.is_original_long_word():
-                self.state = FAIL
-            else:
-                self.final += node.add_phonetic()
-                self.len += 1
-                self.pool = UEMPTY
-                self.state = END
-                if not node.is_original:
-                    LOG[node.from_word] = node.to_phonetic
-        elif self.state == START or self.state == WAIT_TAIL:
-            if cond == MATCHED_SWITCH:
-                self.last_matched = [node.from_word,node.to_phonetic]
-                new = self.clone(node.from_word)
-                self.final += node.add_phonetic()
-                self.len += 1
-                self.state = END
-                self.pool = UEMPTY
-            elif cond == UNMATCHED_SWITCH or cond == CONNECTOR:
-                if self.state == START:
-                    new = self.clone(node.from_word)
-                    self.final += node.add_phonetic()
-                    self.len += 1
-                    self.state = END
-                else:
-                    if node.is_follow(self.pool):
-                        self.state = FAIL
-                    else:
-                        self.pool = node.from_word
-        elif self.state == END:
-            self.state = START
-            new = self.feed(char, map)
-        elif self.state == FAIL:
-            raise StatesMachineException('Translate States Machine Error')
-        return new
-
-    def __len__(self):
-        return self.len + 1
+_converter = None
 
 class Converter(object):
     def __init__(self):
@@ -190,61 +36,21 @@ class Converter(object):
         self.map = MAPS
         self.start()
 
-    def feed(self, char):
-        branches = []
-        for fsm in self.machines:
-            new = fsm.feed(char, self.map)
-            if new:
-                branches.append(new)
-        if branches:
-            self.machines.extend(branches)
-        self.machines = [fsm for fsm in self.machines if fsm.state != FAIL]
-        all_ok = True
-        for fsm in self.machines:
-            if fsm.state != END:
-                all_ok = False
-        if all_ok:
-            self._clean()
-        return self.get_result()
-
-    def _clean(self):
-        if len(self.machines):
-            self.machines.sort(key=lambda x: len(x))
-            self.final += self.machines[0].final
-            
-        self.machines = [StatesMachine()]
-
     def start(self):
-        self.machines = [StatesMachine()]
-        self.final = UEMPTY
-
-    def end(self):
-        self.machines = [fsm for fsm in self.machines
-                if fsm.state == FAIL or fsm.state == END]
-        self._clean()
+        self.final = ''
 
     def convert(self, string):
-        self.start()
-        for char in string:
-            self.feed(char)
-        self.end()
+        # 整段文本一次扫描完成注音，注音记录写入 LOG
+        self.final = self.map.convert(string, (LOG,))
         return self.get_result()
 
     def get_result(self):
         return self.final
 
 def initMaps():
-    mapping = {}
-    # Load ShengPiZi dict
-    for code in ShengPiZi.shengpizi_dict:
-        mapping[code] = ShengPiZi.shengpizi_dict[code]
-    
-    # Load Phrases dict
-    for key in Phrases.phrases_dict:
-        mapping[key] = Phrases.phrases_dict[key]
-
+    # 生僻字字典 + 短语字典，优先使用预编译索引 (dict/phonetic.idx)
     global MAPS
-    MAPS = ConvertMap(mapping)
+    MAPS = load_matcher()
 
 def log_result():
     text = ''
@@ -253,13 +59,53 @@ def log_result():
     text += ''.join(LOG.keys())+ '\n\n'
     return text
 
+def annotate_soup(soup, converter, engine=None):
+    """就地为 HTML 文档中的生僻字添加 ruby 注音"""
+    engine = engine or get_engine(editable=True)
+
+    def replace_func(match):
+        return converter.convert(match.group())
+
+    for string in engine.text_nodes(soup, ('style', 'script', 'ruby', 'rt', 'rp')):
+        original_text = str(string)
+        new_text = re.sub(r'(?<!<ruby>)[^\x20-\x7E\r\n]+', replace_func, original_text)
+
+        if new_text != original_text:
+            # 片段始终用 html.parser 解析: lxml 会为片段补上 <html><body>
+            new_fragment = BeautifulSoup(new_text, 'html.parser')
+            string.replace_with(new_fragment)
+
+def get_converter():
+    # 每个进程各自保留一份已加载字典的转换器
+    global _converter
+    if _converter is None:
+        _converter = Converter()
+    return _converter
+
+def annotate_document(content, html_engine=None):
+    """为单个 HTML 文档注音，返回 (新内容, 本文档注音记录, 错误信息)；可在工作进程中执行"""
+    converter = get_converter()
+    LOG.clear()
+    try:
+        text_content = content.decode('utf-8')
+
+        # Use regex to find text blocks to avoid parsing huge HTML with BS4 if possible
+        # But keeping BS4 logic for safety and correctness with tags
+        engine = get_engine(html_engine, editable=True)
+        soup = engine.parse(text_content)
+        annotate_soup(soup, converter, engine)
+        return engine.serialize(soup).encode('utf-8'), dict(LOG), None
+    except Exception as e:
+        return None, dict(LOG), str(e)
+
 class PinyinAnnotate:
-    def __init__(self, epub_path, output_path):
+    def __init__(self, epub_path, output_path, workers=1, incremental=None, html_engine=None):
         if not os.path.exists(epub_path):
             raise Exception("EPUB文件不存在")
 
         self.epub_path = os.path.normpath(epub_path)
-        self.epub = zipfile.ZipFile(epub_path)
+        self.container = EpubContainer(epub_path)
+        self.epub = self.container.epub
         
         if output_path and os.path.exists(output_path):
             if os.path.isfile(output_path):
@@ -272,70 +118,69 @@ class PinyinAnnotate:
             self.output_path,
             os.path.basename(self.epub_path).replace(".epub", "_pinyin.epub"),
         )
-        
+
+        self.html_engine = get_engine(html_engine, editable=True).name  # HTML 解析引擎，见 html_engine.py
+
+        # 增量处理: 须在删除上次输出之前读取清单；不同解析引擎的输出可能不同，各自记录
+        self.manifest = open_manifest(incremental, self.file_write_path, f"add_pinyin:{self.html_engine}")
+        if self.manifest:
+            self.manifest.begin()
+        self.digests = {}  # { 文件名 : 输入内容摘要 }，仅增量处理时记录
+
         if os.path.exists(self.file_write_path):
             os.remove(self.file_write_path)
             
+        progress.output_file(self.file_write_path)
         self.target_epub = zipfile.ZipFile(
             self.file_write_path,
             "w",
             zipfile.ZIP_DEFLATED,
         )
-        # Initialize dictionary maps
-        initMaps()
+        # Initialize dictionary maps (kept across runs in a long-lived worker)
+        if MAPS is None:
+            initMaps()
         # Initialize Converter
-        self.converter = Converter()
+        self.converter = get_converter()
+        self.workers = workers  # 并行注音章节的进程数
 
     def process_file(self):
         """处理EPUB文件中的所有HTML/XML文件"""
         LOG.clear()
+        book_log = {}
         
         opf_filename = None
         opf_content = None
         
-        for item in self.epub.infolist():
-            content = self.epub.read(item.filename)
-            
-            # 记录OPF文件，稍后处理
-            if item.filename.lower().endswith('.opf'):
-                opf_filename = item.filename
-                opf_content = content
-                continue
-
-            # 处理HTML/XHTML文件
-            if item.filename.lower().endswith(('.html', '.xhtml', '.htm')):
-                try:
-                    text_content = content.decode('utf-8')
-                    
-                    # Use regex to find text blocks to avoid parsing huge HTML with BS4 if possible
-                    # But keeping BS4 logic for safety and correctness with tags
-                    soup = BeautifulSoup(text_content, 'html.parser')
-                    
-                    for string in soup.find_all(string=True):
-                        if isinstance(string, (Comment, Doctype, ProcessingInstruction, Declaration)):
+        items = self.epub.infolist()
+        self.stage = progress.stage("annotate", len(items), self.target_epub)
+        with self.stage, OrderedExecutor(self.workers) as executor:
+            for item in items:
+                # 记录OPF文件，稍后处理
+                if item.filename.lower().endswith('.opf'):
+                    opf_filename = item.filename
+                    opf_content = self.epub.read(item.filename)
+                    self.stage.advance(read=item.compress_size)
+                    continue
+
+                # 处理HTML/XHTML文件
+                if item.filename.lower().endswith(('.html', '.xhtml', '.htm')):
+                    content = self.epub.read(item.filename)
+                    if self.manifest:
+                        digest = member_digest(content)
+                        if self.manifest.unchanged(item.filename, digest):
+                            executor.put(item, False)
+                            self.write_results(executor.results(), book_log)
                             continue
-                        if string.parent.name in ['style', 'script', 'ruby', 'rt', 'rp']:
-                            continue
-                            
-                        original_text = str(string)
-                        
-                        def replace_func(match):
-                            return self.converter.convert(match.group())
-
-                        new_text = re.sub(r'(?<!<ruby>)[^\x20-\x7E\r\n]+', replace_func, original_text)
-                        
-                        if new_text != original_text:
-                            new_fragment = BeautifulSoup(new_text, 'html.parser')
-                            string.replace_with(new_fragment)
+                        self.digests[item.filename] = digest
+                    executor.submit(item, annotate_document, content, self.html_engine)
+                else:
+                    executor.put(item, None)
+                self.write_results(executor.results(), book_log)
+            self.write_results(executor.results(wait=True), book_log)
 
-                    new_content = str(soup).encode('utf-8')
-                    self.target_epub.writestr(item.filename, new_content)
-                    
-                except Exception as e:
-                    logger.write(f"文件 {item.filename} 处理失败，使用原内容: {e}")
-                    self.target_epub.writestr(item, content)
-            else:
-                self.target_epub.writestr(item, content)
+        # 各文档的注音记录按原有顺序合并
+        LOG.clear()
+        LOG.update(book_log)
 
         # Generate Log Content for system log
         log_content = log_result()
@@ -346,8 +191,30 @@ class PinyinAnnotate:
             self.target_epub.writestr(opf_filename, opf_content)
 
         self.close_file()
+        if self.manifest:
+            self.manifest.commit()
         return 0, self.file_write_path
 
+    def write_results(self, results, book_log):
+        for item, result in results:
+            self.stage.advance(read=item.compress_size)
+            if result is False:
+                # 内容未变化，沿用上次的输出及注音记录 (增量处理)
+                book_log.update(self.manifest.reuse(self.target_epub, item.filename))
+                continue
+            if result is None:
+                self.container.copy_to(self.target_epub, item)
+                continue
+            new_content, doc_log, error = result
+            book_log.update(doc_log)
+            if error is None:
+                self.target_epub.writestr(item.filename, new_content)
+                if self.manifest:
+                    self.manifest.record(item.filename, self.digests.pop(item.filename), new_content, doc_log)
+            else:
+                logger.write(f"文件 {item.filename} 处理失败，使用原内容: {error}")
+                self.container.copy_to(self.target_epub, item)
+
     def close_file(self):
         if self.epub:
             self.epub.close()
@@ -358,13 +225,15 @@ class PinyinAnnotate:
         if self.file_write_path and os.path.exists(self.file_write_path):
             os.remove(self.file_write_path)
             logger.write(f"删除临时文件: {self.file_write_path}")
+        if self.manifest:
+            self.manifest.abort()
 
-def run_add_pinyin(epub_path, output_path=None):
+def run_add_pinyin(epub_path, output_path=None, workers=1, incremental=None, html_engine=None):
     logger.write(f"\n正在尝试给EPUB添加生僻字注音: {epub_path}")
     
     pinyin_tool = None
     try:
-        pinyin_tool = PinyinAnnotate(epub_path, output_path)
+        pinyin_tool = PinyinAnnotate(epub_path, output_path, workers, incremental, html_engine)
         result = pinyin_tool.process_file()
         return result
     except Exception as e:
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+# 多操作流水线: 一次读入，一次写出
+#
+# 串联多个操作时，每个操作原本都要完整地解压、处理、重新压缩一次，并留下中间 EPUB。
+# 流水线把书籍读入内存 (Book)，文本文档只解码/解析一次，解析结果直接在各步骤间传递，
+# 最后只写出一次压缩包。
+#
+# 逐文档处理的操作 (简繁转换、生僻字注音、阅微转多看、字体子集化、图片压缩) 直接作用于内存模型；
+# 需要整体重建书籍的操作 (重构、加密、解密、字体加密、图片格式转换) 仍调用原有实现，
+# 内存模型以不压缩的方式写入临时目录后交给它处理，再读回结果。
+
+import os
+import shutil
+import tempfile
+import traceback
+import zipfile
+from io import BytesIO
+
+from bs4 import BeautifulSoup
+
+try:
+    from utils.log import logwriter
+    from utils.encrypt_epub import run as encrypt_run
+    from utils.decrypt_epub import run as decrypt_run
+    from utils.reformat_epub import run as reformat_run
+    from utils.encrypt_font import run_epub_font_encrypt
+    from utils.webp_to_img import run as run_webp_to_img
+    from utils.img_to_webp import run as run_img_to_webp
+    from utils.img_compress import compress_images, is_reference_file, update_text_references
+    from utils.font_subset import FontSubset
+    from utils.chinese_convert import convert_html_soup, convert_xml_soup, get_opencc
+    from utils import pinyin_annotate
+    from utils.yuewei_to_duokan import convert_footnotes
+    from utils.html_engine import get_engine
+    from utils import progress
+except ImportError:
+    from log import logwriter
+    from encrypt_epub import run as encrypt_run
+    from decrypt_epub import run as decrypt_run
+    from reformat_epub import run as reformat_run
+    from encrypt_font import run_epub_font_encrypt
+    from webp_to_img import run as run_webp_to_img
+    from img_to_webp import run as run_img_to_webp
+    from img_compress import compress_images, is_reference_file, update_text_references
+    from font_subset import FontSubset
+    from chinese_convert import convert_html_soup, convert_xml_soup, get_opencc
+    import pinyin_annotate
+    from yuewei_to_duokan import convert_footnotes
+    from html_engine import get_engine
+    import progress
+
+logger = logwriter()
+
+HTML_EXTS = (".html", ".xhtml", ".htm")
+
+
+class Book:
+    """内存中的书籍模型"""
+
+    def __init__(self, epub_src):
+        self.infos = {}  # { 路径 : ZipInfo }，保持原有顺序，新增文件为 None
+        self.files = {}  # { 路径 : bytes }
+        self.docs = {}  # { 路径 : (解析器, soup) }，解析器为 None 时为已解码的文本
+        with zipfile.ZipFile(epub_src) as zin:
+            for info in zin.infolist():
+                self.infos[info.filename] = info
+                self.files[info.filename] = zin.read(info)
+
+    def namelist(self):
+        return list(self.infos)
+
+    def read(self, name):
+        if name in self.docs:
+            return self.text(name).encode("utf-8")
+        return self.files[name]
+
+    def open(self, name, mode="r"):
+        return BytesIO(self.read(name))
+
+    def text(self, name):
+        if name in self.docs:
+            features, doc = self.docs[name]
+            return doc if features is None else str(doc)
+        text = self.files[name].decode("utf-8")
+        self.docs[name] = (None, text)
+        return text
+
+    def soup(self, name, features="html.parser"):
+        # 同一文档在各步骤之间共用一次解析结果
+        if name in self.docs and self.docs[name][0] == features:
+            return self.docs[name][1]
+        soup = BeautifulSoup(self.text(name), features)
+        self.docs[name] = (features, soup)
+        return soup
+
+    def set_text(self, name, text):
+        self.docs[name] = (None, text)
+
+    def write(self, name, data):
+        self.docs.pop(name, None)
+        self.files[name] = data
+        self.infos.setdefault(name, None)
+
+    def remove(self, name):
+        self.docs.pop(name, None)
+        self.files.pop(name, None)
+        self.infos.pop(name, None)
+
+    def rename(self, old, new):
+        # 保持文件在压缩包中的位置
+        self.infos = {new if k == old else k: v for k, v in self.infos.items()}
+        self.files[new] = self.files.pop(old)
+        if old in self.docs:
+            self.docs[new] = self.docs.pop(old)
+
+    def save(self, file_write_path, compression=zipfile.ZIP_DEFLATED):
+        with zipfile.ZipFile(file_write_path, "w", compression) as zout:
+            if "mimetype" in self.infos:
+                zout.writestr("mimetype", self.read("mimetype"), zipfile.ZIP_STORED)
+            for name, info in self.infos.items():
+                if name == "mimetype":
+                    continue
+                if info is None:
+                    zout.writestr(name, self.read(name))
+                else:
+                    zinfo = zipfile.ZipInfo(name, date_time=info.date_time)
+                    zinfo.external_attr = info.external_attr
+                    zinfo.compress_type = compression
+                    zout.writestr(zinfo, self.read(name))
+
+
+class BookFontSubset(FontSubset):
+    """在内存书籍上统计字体用字，HTML 沿用前面步骤已解析的文档 (html.parser)"""
+
+    def __init__(self, book):
+        self.epub = book
+        self.engine = get_engine()
+        self.workers = 1
+        self.font_cache = None
+        self.file_write_path = None
+        self.target_epub = None
+        self.init_files(book.namelist())
+
+    def member_size(self, name):
+        info = self.epub.infos.get(name)
+        return info.compress_size if info is not None else 0
+
+    def read_document(self, one_html):
+        # 只读不改: 没有现成的解析结果时临时解析，不存入 book.docs，保存时仍写出原文本
+        doc = self.epub.docs.get(one_html)
+        if doc is not None and doc[0] == "html.parser":
+            return doc[1]
+        return self.engine.parse(self.epub.text(one_html))
+
+
+def chinese_convert(book, mode):
+    cc = get_opencc(mode)
+
+    def convert_text(text):
+        if not text:
+            return text
+        return cc.convert(text)
+
+    for name in book.namelist():
+        lower = name.lower()
+        if not lower.endswith(HTML_EXTS + (".ncx", ".opf")):
+            continue
+        try:
+            if lower.endswith(HTML_EXTS):
+                soup = book.soup(name)
+            else:
+                soup = book.soup(name, "xml")
+        except Exception as e:
+            logger.write(f"文件 {name} 转换失败，使用原内容: {e}")
+            continue
+        if lower.endswith(HTML_EXTS):
+            convert_html_soup(soup, convert_text)
+        else:
+            convert_xml_soup(soup, convert_text)
+    logger.write(f"EPUB简繁转换完成 ({mode})")
+
+
+def add_pinyin(book):
+    pinyin_annotate.LOG.clear()
+    converter = pinyin_annotate.get_converter()
+    for name in book.namelist():
+        if not name.lower().endswith(HTML_EXTS):
+            continue
+        try:
+            soup = book.soup(name)
+        except Exception as e:
+            logger.write(f"文件 {name} 处理失败，使用原内容: {e}")
+            continue
+        pinyin_annotate.annotate_soup(soup, converter)
+    logger.write(pinyin_annotate.log_result())
+
+
+def yuewei_to_duokan(book):
+    for name in book.namelist():
+        if not name.lower().endswith(HTML_EXTS):
+            continue
+        try:
+            book.set_text(name, convert_footnotes(book.text(name)))
+        except Exception as e:
+            logger.write(f"处理文件 {name} 失败: {e}")
+            traceback.print_exc()
+
+
+def font_subset(book):
+    fs = BookFontSubset(book)
+    if len(fs.fonts) == 0:
+        logger.write("没有找到字体文件，跳过")
+        return
+    fs.get_mapping()
+
+    removed_fonts = set()
+    for font_path, font_data in fs.subset_all():
+        if font_data is None:
+            removed_fonts.add(font_path)
+            book.remove(font_path)
+        else:
+            book.write(font_path, font_data)
+
+    if removed_fonts:
+        for name in fs.ori_files:
+            if name.lower().endswith(".opf"):
+                opf = fs.remove_fonts_from_opf(name, book.text(name), removed_fonts)
+                if opf is not None:
+                    book.set_text(name, opf)
+    logger.write("EPUB字体子集化完成")
+
+
+def img_compress(book):
+    compressed, rename_map = compress_images(book, book.namelist())
+    for arcname, (new_arcname, data) in compressed.items():
+        book.write(arcname, data)
+        if new_arcname != arcname:
+            book.rename(arcname, new_arcname)
+
+    if rename_map:
+        logger.write(f"更新文件引用: {len(rename_map)} 个文件名变更")
+        for name in book.namelist():
+            if is_reference_file(name):
+                try:
+                    book.set_text(name, update_text_references(book.text(name), rename_map))
+                except UnicodeDecodeError:
+                    pass
+    logger.write(f"图片压缩完成: 处理了 {len(compressed)} 张图片")
+
+
+# 直接作用于内存模型的操作
+BOOK_STAGES = {
+    "s2t": lambda book: chinese_convert(book, "s2t"),
+    "t2s": lambda book: chinese_convert(book, "t2s"),
+    "add_pinyin": add_pinyin,
+    "yuewei_to_duokan": yuewei_to_duokan,
+    "font_subset": font_subset,
+    "img_compress": img_compress,
+}
+
+# 需要整体重建书籍、以文件形式调用原有实现的操作
+FILE_STAGES = {
+    "reformat": reformat_run,
+    "encrypt": encrypt_run,
+    "decrypt": decrypt_run,
+    "font_encrypt": run_epub_font_encrypt,
+    "img_to_webp": run_img_to_webp,
+    "webp_to_img": run_webp_to_img,
+}
+
+
+def parse_operations(operations):
+    if isinstance(operations, str):
+        operations = [op.strip() for op in operations.split(",")]
+    return [op for op in (operations or []) if op]
+
+
+def run_file_stage(run, epub_src, workdir):
+    # 原有实现按输入文件名命名输出，每一步使用独立的输出目录
+    out_dir = tempfile.mkdtemp(dir=workdir)
+    result = run(epub_src, out_dir)
+    if isinstance(result, tuple):
+        if result[0] != 0:
+            raise Exception(result[1])
+    elif result == "skip":
+        return None
+    elif result != 0:
+        raise Exception(str(result))
+    outputs = [f for f in os.listdir(out_dir) if f.lower().endswith(".epub")]
+    if not outputs:
+        return None
+    return os.path.join(out_dir, outputs[0])
+
+
+def run_pipeline(epub_path, output_path=None, operations=None):
+    logger.write(f"\n正在执行流水线: {epub_path}")
+    operations = parse_operations(operations)
+    if not operations:
+        return 1, "未指定流水线操作"
+    unknown = [op for op in operations if op not in BOOK_STAGES and op not in FILE_STAGES]
+    if unknown:
+        return 1, f"未知的流水线操作: {', '.join(unknown)}"
+    if not os.path.exists(epub_path):
+        return 1, "EPUB文件不存在"
+
+    if output_path and os.path.exists(output_path):
+        if os.path.isfile(output_path):
+            return 1, "输出路径不能是文件"
+    else:
+        output_path = os.path.dirname(epub_path)
+    epub_name = os.path.basename(epub_path)
+    file_write_path = os.path.join(
+        os.path.normpath(output_path), epub_name.replace(".epub", "_pipeline.epub")
+    )
+
+    progress.output_file(file_write_path)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            book = None  # 内存模型；为 None 时当前内容在 current_path 文件中
+            current_path = epub_path
+            for i, op in enumerate(operations, 1):
+                logger.write(f"流水线步骤 {i}/{len(operations)}: {op}")
+                # 每个步骤一个阶段，调用原有实现的步骤内部的阶段事件嵌套在其中
+                with progress.stage(op):
+                    if op in BOOK_STAGES:
+                        if book is None:
+                            book = Book(current_path)
+                        BOOK_STAGES[op](book)
+                        continue
+
+                    if book is not None:
+                        current_path = os.path.join(tempfile.mkdtemp(dir=workdir), epub_name)
+                        book.save(current_path, zipfile.ZIP_STORED)
+                        book = None
+                    stage_output = run_file_stage(FILE_STAGES[op], current_path, workdir)
+                    if stage_output:
+                        current_path = stage_output
+
+            if os.path.exists(file_write_path):
+                os.remove(file_write_path)
+            if book is not None:
+                book.save(file_write_path)
+            else:
+                shutil.copyfile(current_path, file_write_path)
+    except Exception as e:
+        logger.write(f"流水线执行失败: {e}")
+        traceback.print_exc()
+        if os.path.exists(file_write_path):
+            os.remove(file_write_path)
+        return 1, str(e)
+
+    logger.write(f"流水线执行完成，输出路径: {file_write_path}")
+    return 0, file_write_path
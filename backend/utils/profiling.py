@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# 单个任务的性能剖析
+#
+# 定位慢的书籍时，可对单次处理开启剖析，不必修改代码:
+#
+#     python cli.py s2t --input a.epub --output out --profile ~/epub_profile [--profile-top 30]
+#
+# 每个任务在剖析目录下生成两个文件 (文件名含命令、书名、时间与进程号，并行的任务互不覆盖):
+#   <命令>_<书名>_<时间>_<pid>.pstats      cProfile 统计，可用 python -m pstats 或 snakeviz 查看
+#   <命令>_<书名>_<时间>_<pid>.collapsed   按调用栈定时采样的折叠栈 (每行 "根;...;叶 次数")，
+#                                          可直接交给 flamegraph.pl 或 speedscope 生成火焰图
+# 结果 JSON 中增加 profile 字段: 两个文件的路径及累计耗时最多的前 N 个函数
+# (不含 cli.py 与各模块的 run / run_* 入口，它们的累计耗时就是整个任务)。
+# 只剖析主进程；进程池中工作进程的耗时体现在主进程等待结果的函数上 (可用 workers=1 对比)。
+
+import cProfile
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+
+# 结果中列出的函数个数
+TOP_N = 20
+# 不列入前 N 个函数的文件 (任务入口)
+ENTRY_FILES = ("cli.py", "profiling.py")
+# 调用栈采样间隔 (秒)
+SAMPLE_INTERVAL = 0.005
+
+
+class StackSampler(threading.Thread):
+    """在后台线程中定时采样指定线程的调用栈，累计为折叠栈；各栈去掉最外层的 skip 层 (剖析本身的调用)"""
+
+    def __init__(self, thread_id, skip=0, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.skip = skip
+        self.interval = interval
+        self.counts = {}  # { "根;...;叶" : 次数 }
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            names.reverse()
+            stack = ";".join(names[self.skip:])
+            if not stack:
+                continue
+            self.counts[stack] = self.counts.get(stack, 0) + 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write(f"{stack} {count}\n")
+
+
+def entry_point(func):
+    # cli.py 的分发代码、本模块及各模块的 run / run_* 入口: 累计耗时即整个任务，列出来没有信息量
+    filename, _, name = func
+    if os.path.basename(filename) in ENTRY_FILES:
+        return True
+    name = name.lstrip("_")
+    return name == "run" or name.startswith("run_")
+
+
+def top_functions(stats, top=TOP_N):
+    # 按累计耗时排序的前 top 个函数，不含任务入口
+    stats.sort_stats("cumulative")
+    functions = []
+    for func in stats.fcn_list:
+        if len(functions) >= top:
+            break
+        if entry_point(func):
+            continue
+        primitive_calls, calls, tottime, cumtime, _ = stats.stats[func]
+        functions.append({
+            "function": pstats.func_std_string(func),
+            "calls": calls,
+            "primitive_calls": primitive_calls,
+            "tottime": round(tottime, 6),
+            "cumtime": round(cumtime, 6),
+        })
+    return functions
+
+
+def profile_name(name, input_path):
+    book = os.path.splitext(os.path.basename(input_path or ""))[0] or "job"
+    stem = re.sub(r"[^\w.-]+", "_", f"{name}_{book}")
+    return f"{stem}_{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}"
+
+
+def profile_call(profile_dir, name, input_path, func, *args, top=TOP_N, **kwargs):
+    """运行 func(*args, **kwargs)，返回 (func 的结果, 剖析摘要)"""
+    profile_dir = os.path.abspath(os.path.expanduser(profile_dir))
+    os.makedirs(profile_dir, exist_ok=True)
+    base = os.path.join(profile_dir, profile_name(name, input_path))
+
+    depth = 0
+    frame = sys._getframe()
+    while frame is not None:
+        depth += 1
+        frame = frame.f_back
+    sampler = StackSampler(threading.get_ident(), skip=depth)
+    profiler = cProfile.Profile()
+    sampler.start()
+    profiler.enable()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        sampler.stop()
+
+    summary = {
+        "stats": base + ".pstats",
+        "collapsed": base + ".collapsed",
+        "top": top_functions(pstats.Stats(profiler), top),
+    }
+    try:
+        profiler.dump_stats(summary["stats"])
+        sampler.write(summary["collapsed"])
+    except OSError as e:
+        summary["error"] = str(e)
+    return result, summary
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# 处理进度与各阶段耗时的事件流
+#
+# cli.py 默认只在结束时输出一个结果 JSON。加上 --progress (输出到 stdout，结果 JSON 仍是最后一行)
+# 或 --progress-fd <fd> (输出到另一个文件描述符) 后，处理过程中逐行输出 JSON 事件:
+#
+#   {"event": "job_start", "command": "s2t", "file": "a.epub"}
+#   {"event": "stage_start", "stage": "convert", "total": 312}
+#   {"event": "progress", "stage": "convert", "done": 40, "total": 312}
+#   {"event": "stage_end", "stage": "convert", "done": 312, "total": 312,
+#    "bytes_read": 5123456, "bytes_written": 5234567, "elapsed_ms": 2331}
+#   {"event": "job_end", "status": "success", "elapsed_ms": 2410}
+#
+# 字节数均按压缩包中的大小计: 读入为处理过的成员的压缩后大小，写出为输出文件在该阶段的增长量。
+# 各功能模块通过 progress.stage(...) 报告，未开启时为空操作。progress 事件按时间节流，
+# 每个阶段的最后一个文档总会报告。事件只在主进程中产生 (进程池的结果在主进程中写回时计数)。
+# 阶段的汇总同时交给 --stats 的统计 (见 job_stats.py)，两者可分别开启；各模块创建输出文件时
+# 以 progress.output_file(path) 登记，供统计只计入本任务写出的文件。
+
+import json
+import os
+import threading
+import time
+
+# 两次 progress 事件的最小间隔 (秒)
+MIN_INTERVAL = 0.1
+
+
+class ProgressReporter:
+    def __init__(self, stream, min_interval=MIN_INTERVAL):
+        self.stream = stream
+        # 进程池的工作进程 (fork) 会继承本对象，只在创建它的进程中报告
+        self.pid = os.getpid()
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        line = json.dumps({"event": event, **fields}, ensure_ascii=False)
+        with self.lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+
+class Stage:
+    """reporter 为 None 时不输出事件，collector 为 None 时不汇总"""
+
+    def __init__(self, reporter, name, total=None, target=None, collector=None):
+        self.reporter = reporter
+        self.collector = collector
+        self.name = name
+        self.total = total
+        self.target = target  # 输出的 ZipFile
+        self.done = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.started = None
+        self.last_report = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.target_start = self.target_size()
+        if self.collector is not None:
+            self.collector.enter_stage(self)
+        if self.reporter is not None:
+            self.reporter.emit("stage_start", stage=self.name, total=self.total)
+        return self
+
+    def advance(self, count=1, read=0):
+        """完成 count 个文档 (或其他处理单位)，read 为读入的字节数"""
+        self.done += count
+        self.bytes_read += read
+        if self.reporter is None:
+            return
+        now = time.perf_counter()
+        if now - self.last_report >= self.reporter.min_interval or self.done == self.total:
+            self.last_report = now
+            self.reporter.emit("progress", stage=self.name, done=self.done, total=self.total)
+
+    def target_size(self):
+        # 写入中的压缩包取当前位置，已关闭的取文件大小
+        try:
+            if self.target.fp is None:
+                return os.path.getsize(self.target.filename)
+            return self.target.fp.tell()
+        except (AttributeError, TypeError, OSError, ValueError):
+            return 0
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.target is not None:
+            self.bytes_written = self.target_size() - self.target_start
+        fields = {
+            "stage": self.name,
+            "done": self.done,
+            "total": self.total,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "elapsed_ms": int((time.perf_counter() - self.started) * 1000),
+        }
+        if exc_type is not None:
+            fields["error"] = str(exc_value)
+        if self.collector is not None:
+            self.collector.exit_stage(self, fields)
+        if self.reporter is not None:
+            self.reporter.emit("stage_end", **fields)
+        return False
+
+
+class NullStage:
+    """未开启进度报告时使用，所有操作为空"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+    def advance(self, count=1, read=0):
+        pass
+
+
+_NULL_STAGE = NullStage()
+_reporter = None  # 当前进程的 ProgressReporter，未开启时为 None
+_collector = None  # 当前任务的阶段汇总 (job_stats.JobStats)，未开启时为 None
+
+
+def open_reporter(options, stdout):
+    # --progress 输出到 stdout，--progress-fd <fd> 输出到指定的文件描述符；都没有时不开启
+    global _reporter
+    if options.get("progress-fd"):
+        stream = os.fdopen(int(options["progress-fd"]), "w", encoding="utf-8", buffering=1)
+    elif options.get("progress"):
+        stream = stdout
+    else:
+        return None
+    _reporter = ProgressReporter(stream)
+    return _reporter
+
+
+def get_reporter():
+    return _reporter
+
+
+def set_collector(collector):
+    # collector 需提供 pid、enter_stage(stage)、exit_stage(stage, fields) 与 add_output(path)
+    global _collector
+    _collector = collector
+
+
+def stage(name, total=None, target=None):
+    """with progress.stage("convert", len(items), target_epub) as stage: ... stage.advance(read=info.compress_size)"""
+    pid = os.getpid()
+    reporter = _reporter if _reporter is not None and _reporter.pid == pid else None
+    collector = _collector if _collector is not None and _collector.pid == pid else None
+    if reporter is None and collector is None:
+        return _NULL_STAGE
+    return Stage(reporter, name, total, target, collector)
+
+
+def output_file(path):
+    """登记本任务写出的输出文件 (中间文件随后被删除的不计入统计)"""
+    if _collector is not None and _collector.pid == os.getpid():
+        _collector.add_output(path)
+
+
+def emit(event, **fields):
+    if _reporter is not None and _reporter.pid == os.getpid():
+        _reporter.emit(event, **fields)
@@ -7,8 +7,12 @@ import logging
 
 try:
     from utils.log import logwriter
+    from utils.epub_container import EpubContainer
+    from utils import progress
 except ImportError:
     from log import logwriter
+    from epub_container import EpubContainer
+    import progress
 
 logger = logwriter()
 
@@ -20,7 +24,8 @@ class RegexFootnote:
         self.epub_path = os.path.normpath(epub_path)
         self.output_path = output_path
         self.regex_pattern = regex_pattern
-        self.epub = zipfile.ZipFile(epub_path)
+        self.container = EpubContainer(epub_path)
+        self.epub = self.container.epub
         
         if output_path and os.path.exists(output_path):
             if os.path.isfile(output_path):
@@ -37,6 +42,7 @@ class RegexFootnote:
         if os.path.exists(self.file_write_path):
             os.remove(self.file_write_path)
             
+        progress.output_file(self.file_write_path)
         self.target_epub = zipfile.ZipFile(
             self.file_write_path,
             "w",
@@ -65,120 +71,124 @@ class RegexFootnote:
         except re.error as e:
             raise Exception(f"无效的正则表达式: {e}")
 
-        for item in self.epub.infolist():
-            content = self.epub.read(item.filename)
-            
-            # 仅处理 HTML 文件
-            if item.filename.lower().endswith(('.html', '.xhtml', '.htm')):
-                try:
-                    # 尝试 decode，如果失败则尝试其他编码
+        with progress.stage("replace", len(self.epub.infolist()), self.target_epub) as stage:
+            for item in self.epub.infolist():
+                stage.advance(read=item.compress_size)
+                # 仅处理 HTML 文件
+                if item.filename.lower().endswith(('.html', '.xhtml', '.htm')):
+                    content = self.epub.read(item.filename)
                     try:
-                        text_content = content.decode('utf-8')
-                    except UnicodeDecodeError:
-                        text_content = content.decode('gbk', errors='ignore')
+                        # 尝试 decode，如果失败则尝试其他编码
+                        try:
+                            text_content = content.decode('utf-8')
+                        except UnicodeDecodeError:
+                            text_content = content.decode('gbk', errors='ignore')
                     
-                    footnotes_to_add = []
-                    note_index = 1
+                        footnotes_to_add = []
+                        note_index = 1
                     
-                    # 查找匹配
-                    matches = list(pattern.finditer(text_content))
+                        # 查找匹配
+                        matches = list(pattern.finditer(text_content))
                     
-                    if matches:
-                        new_content = ""
-                        last_idx = 0
+                        if matches:
+                            # 各段先收集再一次拼接，避免反复复制整篇文本
+                            pieces = []
+                            last_idx = 0
                         
-                        # 倒序处理或者正序拼接
-                        for match in matches:
-                            start, end = match.span()
-                            # 优先获取捕获组1，如果没有则使用整体匹配
-                            if match.groups():
-                                matched_text = match.group(1)
-                            else:
-                                matched_text = match.group()
+                            # 倒序处理或者正序拼接
+                            for match in matches:
+                                start, end = match.span()
+                                # 优先获取捕获组1，如果没有则使用整体匹配
+                                if match.groups():
+                                    matched_text = match.group(1)
+                                else:
+                                    matched_text = match.group()
                                 
-                            # 添加匹配前的文本
-                            new_content += text_content[last_idx:start]
+                                # 添加匹配前的文本
+                                pieces.append(text_content[last_idx:start])
                             
-                            # 构建替换 HTML 字符串
-                            # <sup> 
-                            #   <a class="duokan-footnote" epub:type="noteref" href="#note1" id="note_ref1"> 
-                            #     <img alt="note" class="zhangyue-footnote" src="../Images/note.png" zy-footnote="匹配到的内容"/> 
-                            #   </a> 
-                            # </sup>
+                                # 构建替换 HTML 字符串
+                                # <sup> 
+                                #   <a class="duokan-footnote" epub:type="noteref" href="#note1" id="note_ref1"> 
+                                #     <img alt="note" class="zhangyue-footnote" src="../Images/note.png" zy-footnote="匹配到的内容"/> 
+                                #   </a> 
+                                # </sup>
                             
-                            replacement = (
-                                f'<sup>'
-                                f'<a class="duokan-footnote" epub:type="noteref" href="#note{note_index}" id="note_ref{note_index}">'
-                                f'<img alt="note" class="zhangyue-footnote" src="../Images/note.png" zy-footnote="{matched_text}"/>'
-                                f'</a>'
-                                f'</sup>'
-                            )
-                            new_content += replacement
+                                replacement = (
+                                    f'<sup>'
+                                    f'<a class="duokan-footnote" epub:type="noteref" href="#note{note_index}" id="note_ref{note_index}">'
+                                    f'<img alt="note" class="zhangyue-footnote" src="../Images/note.png" zy-footnote="{matched_text}"/>'
+                                    f'</a>'
+                                    f'</sup>'
+                                )
+                                pieces.append(replacement)
                             
-                            # 准备对应的 aside 内容
-                            # <aside epub:type="footnote" id="note1"> 
-                            #   <ol class="duokan-footnote-content" style="list-style:none"> 
-                            #   <li class="duokan-footnote-item" id="note1"> 
-                            #   <p><a href="#note_ref1">匹配到的内容</a></p> 
-                            #   </li> 
-                            #   </ol> 
-                            # </aside>
+                                # 准备对应的 aside 内容
+                                # <aside epub:type="footnote" id="note1"> 
+                                #   <ol class="duokan-footnote-content" style="list-style:none"> 
+                                #   <li class="duokan-footnote-item" id="note1"> 
+                                #   <p><a href="#note_ref1">匹配到的内容</a></p> 
+                                #   </li> 
+                                #   </ol> 
+                                # </aside>
                             
-                            aside_html = (
-                                f'<aside epub:type="footnote" id="note{note_index}">'
-                                f'<ol class="duokan-footnote-content" style="list-style:none">'
-                                f'<li class="duokan-footnote-item" id="note{note_index}">'
-                                f'<p><a href="#note_ref{note_index}">{matched_text}</a></p>'
-                                f'</li>'
-                                f'</ol>'
-                                f'</aside>'
-                            )
+                                aside_html = (
+                                    f'<aside epub:type="footnote" id="note{note_index}">'
+                                    f'<ol class="duokan-footnote-content" style="list-style:none">'
+                                    f'<li class="duokan-footnote-item" id="note{note_index}">'
+                                    f'<p><a href="#note_ref{note_index}">{matched_text}</a></p>'
+                                    f'</li>'
+                                    f'</ol>'
+                                    f'</aside>'
+                                )
                             
-                            footnotes_to_add.append(aside_html)
+                                footnotes_to_add.append(aside_html)
                             
-                            note_index += 1
-                            last_idx = end
+                                note_index += 1
+                                last_idx = end
                             
-                        # 添加剩余文本
-                        new_content += text_content[last_idx:]
+                            # 添加剩余文本
+                            pieces.append(text_content[last_idx:])
+                            new_content = "".join(pieces)
                         
-                        # 检查并添加 epub 命名空间
-                        if 'xmlns:epub="http://www.idpf.org/2007/ops"' not in new_content:
-                            new_content = new_content.replace(
-                                '<html', 
-                                '<html xmlns:epub="http://www.idpf.org/2007/ops"', 
-                                1
-                            )
+                            # 检查并添加 epub 命名空间
+                            if 'xmlns:epub="http://www.idpf.org/2007/ops"' not in new_content:
+                                new_content = new_content.replace(
+                                    '<html', 
+                                    '<html xmlns:epub="http://www.idpf.org/2007/ops"', 
+                                    1
+                                )
 
-                        # 在 body 结束标签前插入 footnotes
-                        # 如果没有 body 结束标签，则追加到文件末尾（虽然不太规范）
-                        if footnotes_to_add:
-                            footnotes_str = "\n".join(footnotes_to_add)
-                            if "</body>" in new_content:
-                                new_content = new_content.replace("</body>", f"{footnotes_str}\n</body>")
-                            else:
-                                new_content += f"\n{footnotes_str}"
+                            # 在 body 结束标签前插入 footnotes
+                            # 如果没有 body 结束标签，则追加到文件末尾（虽然不太规范）
+                            if footnotes_to_add:
+                                footnotes_str = "\n".join(footnotes_to_add)
+                                if "</body>" in new_content:
+                                    new_content = new_content.replace("</body>", f"{footnotes_str}\n</body>")
+                                else:
+                                    new_content += f"\n{footnotes_str}"
                         
-                        self.target_epub.writestr(item.filename, new_content.encode('utf-8'))
-                    else:
-                        self.target_epub.writestr(item, content)
+                            self.target_epub.writestr(item.filename, new_content.encode('utf-8'))
+                        else:
+                            self.container.copy_to(self.target_epub, item)
                         
-                except Exception as e:
-                    logger.write(f"文件 {item.filename} 处理失败: {e}")
-                    traceback.print_exc()
-                    self.target_epub.writestr(item, content)
+                    except Exception as e:
+                        logger.write(f"文件 {item.filename} 处理失败: {e}")
+                        traceback.print_exc()
+                        self.container.copy_to(self.target_epub, item)
             
-            # 处理 CSS 文件，追加脚注样式
-            elif item.filename.lower().endswith('.css'):
-                try:
-                    # 尝试 decode
+                # 处理 CSS 文件，追加脚注样式
+                elif item.filename.lower().endswith('.css'):
+                    content = self.epub.read(item.filename)
                     try:
-                        css_content = content.decode('utf-8')
-                    except UnicodeDecodeError:
-                        css_content = content.decode('gbk', errors='ignore')
+                        # 尝试 decode
+                        try:
+                            css_content = content.decode('utf-8')
+                        except UnicodeDecodeError:
+                            css_content = content.decode('gbk', errors='ignore')
                         
-                    # 检查是否已包含通用样式
-                    footnote_css = """
+                        # 检查是否已包含通用样式
+                        footnote_css = """
 /* ========== 脚注通用样式 ========== */ 
  
  /* 脚注标记：上标图标 */ 
@@ -224,18 +234,18 @@ class RegexFootnote:
    text-decoration: none !important; 
  }
 """
-                    if "/* ========== 脚注通用样式 ========== */" not in css_content:
-                        css_content += footnote_css
-                        self.target_epub.writestr(item.filename, css_content.encode('utf-8'))
-                    else:
-                         self.target_epub.writestr(item, content)
+                        if "/* ========== 脚注通用样式 ========== */" not in css_content:
+                            css_content += footnote_css
+                            self.target_epub.writestr(item.filename, css_content.encode('utf-8'))
+                        else:
+                             self.container.copy_to(self.target_epub, item)
                          
-                except Exception as e:
-                    logger.write(f"样式文件 {item.filename} 处理失败: {e}")
-                    self.target_epub.writestr(item, content)
+                    except Exception as e:
+                        logger.write(f"样式文件 {item.filename} 处理失败: {e}")
+                        self.container.copy_to(self.target_epub, item)
 
-            else:
-                self.target_epub.writestr(item, content)
+                else:
+                    self.container.copy_to(self.target_epub, item)
 
         self.close_file()
         logger.write(f"EPUB正则注释替换完成，输出路径: {self.file_write_path}")
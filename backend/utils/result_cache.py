@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# 处理结果的磁盘缓存 (按内容寻址)
+#
+# 同一本书以相同操作重复提交时 (崩溃后重跑、重复上传)，直接返回上次的输出。
+# 缓存键为输入文件的 SHA-256 + 命令名 + --extra JSON + 工具版本 (代码、字典及依赖包版本)，任一项变化都会重新处理。
+# 每个缓存项是一个目录，保存输出文件及结果 JSON；按最近使用时间淘汰，总大小不超过上限。
+# 输出文件名中的书名部分 (如 a_traditional.epub 的 a) 按本次输入的文件名替换，
+# 内容相同、文件名不同的书命中同一缓存项时得到以自己命名的输出。
+#
+#     python cli.py s2t --input a.epub --output out --cache-dir ~/.epub_tool_cache --cache-size 2048
+#
+# 开启增量处理 (--extra '{"incremental": ...}'，见 incremental.py) 的任务不经过缓存。
+
+import functools
+import glob
+import hashlib
+import json
+import os
+from importlib import metadata
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    from utils.log import logwriter
+    from utils import progress
+except ImportError:
+    from log import logwriter
+    import progress
+
+logger = logwriter()
+
+CACHE_FORMAT = 2
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024  # 1GB
+RESULT_FILE = "result.json"
+_HASH_CHUNK = 1 << 20
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 影响输出内容的依赖包，升级后旧的缓存项失效
+OUTPUT_PACKAGES = (
+    "opencc-python-reimplemented",
+    "fonttools",
+    "pillow",
+    "beautifulsoup4",
+    "lxml",
+    "selectolax",
+    "tinycss2",
+    "pypinyin",
+)
+
+
+def file_sha256(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def tool_version():
+    # 代码、字典或依赖包版本变化后旧的缓存项自动失效；打包后以可执行文件本身为准
+    if getattr(sys, "frozen", False):
+        stat = os.stat(sys.executable)
+        return f"frozen-{stat.st_size}-{stat.st_mtime_ns}"
+    sha = hashlib.sha256()
+    sources = [os.path.join(BACKEND_DIR, "cli.py")]
+    sources += glob.glob(os.path.join(BACKEND_DIR, "utils", "*.py"))
+    sources += glob.glob(os.path.join(BACKEND_DIR, "utils", "dict", "*.py"))
+    sources += glob.glob(os.path.join(BACKEND_DIR, "utils", "dict", "*.idx"))
+    for source in sorted(sources):
+        sha.update(os.path.relpath(source, BACKEND_DIR).encode("utf-8"))
+        with open(source, "rb") as f:
+            sha.update(f.read())
+    sha.update(sys.version.encode("utf-8"))
+    for package in OUTPUT_PACKAGES:
+        try:
+            version = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            version = None
+        sha.update(f"{package}={version}".encode("utf-8"))
+    return sha.hexdigest()[:16]
+
+
+def input_stem(input_path):
+    return os.path.splitext(os.path.basename(input_path))[0]
+
+
+def rename_output(name, stored_stem, stem):
+    # 以缓存时输入的书名开头的输出文件改为以本次的书名开头
+    if stored_stem and name.startswith(stored_stem):
+        return stem + name[len(stored_stem):]
+    return name
+
+
+def parse_size(size):
+    # 单位为 MB；为空时使用默认上限
+    if size in (None, ""):
+        return DEFAULT_MAX_SIZE
+    return int(float(size) * 1024 * 1024)
+
+
+class ResultCache:
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.entries_dir = os.path.join(self.cache_dir, "entries")
+        self.tmp_dir = os.path.join(self.cache_dir, "tmp")
+        self.max_size = max_size
+        os.makedirs(self.entries_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def make_key(self, cmd, input_path, extra):
+        key = json.dumps(
+            {
+                "format": CACHE_FORMAT,
+                "input": file_sha256(input_path),
+                "command": cmd,
+                "extra": extra,
+                "version": tool_version(),
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.entries_dir, key)
+
+    def run(self, cmd, input_path, output_dir, extra, runner):
+        """runner(output_dir) 执行命令并返回结果 JSON；命中缓存时不调用，直接把缓存的输出复制到输出目录"""
+        if output_dir and not os.path.isdir(output_dir):
+            # 输出目录不存在时各命令的处理方式不同，不使用缓存
+            return runner(output_dir)
+        target_dir = output_dir or os.path.dirname(os.path.abspath(input_path))
+        try:
+            key = self.make_key(cmd, input_path, extra)
+        except OSError as e:
+            logger.write(f"缓存键计算失败，不使用缓存: {e}")
+            return runner(output_dir)
+
+        result = self.restore(key, target_dir, input_stem(input_path))
+        if result is not None:
+            logger.write(f"命中缓存: {cmd} {input_path}")
+            return {**result, "file": input_path, "cached": True}
+
+        staging_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        try:
+            result = runner(staging_dir)
+            if result.get("status") != "success":
+                return {**result, "cached": False}
+            outputs = sorted(os.listdir(staging_dir))
+            stored = {name: value for name, value in result.items() if name not in ("file", "output_path")}
+            if "output_path" in result:
+                stored["output_name"] = os.path.basename(result["output_path"])
+            try:
+                self.store(key, stored, staging_dir, outputs, input_stem(input_path))
+            except OSError as e:
+                logger.write(f"写入缓存失败: {e}")
+            for name in outputs:
+                shutil.move(os.path.join(staging_dir, name), os.path.join(target_dir, name))
+                progress.output_file(os.path.join(target_dir, name))
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+        if "output_path" in result:
+            result["output_path"] = os.path.join(target_dir, os.path.basename(result["output_path"]))
+        self.evict()
+        return {**result, "cached": False}
+
+    def restore(self, key, target_dir, stem):
+        entry = self.entry_path(key)
+        try:
+            with open(os.path.join(entry, RESULT_FILE), encoding="utf-8") as f:
+                meta = json.load(f)
+            stored_stem = meta["stem"]
+            for name in meta["outputs"]:
+                output_file = os.path.join(target_dir, rename_output(name, stored_stem, stem))
+                shutil.copyfile(os.path.join(entry, name), output_file)
+                progress.output_file(output_file)
+            # 以结果文件的修改时间记录最近使用时间
+            os.utime(os.path.join(entry, RESULT_FILE))
+        except (OSError, ValueError, KeyError):
+            return None
+        result = dict(meta["result"])
+        output_name = result.pop("output_name", None)
+        if output_name is not None:
+            result["output_path"] = os.path.join(target_dir, rename_output(output_name, stored_stem, stem))
+        return result
+
+    def store(self, key, result, source_dir, outputs, stem):
+        # 先写入临时目录再整体改名，并发写入同一缓存项时只保留先完成的一份
+        tmp_entry = tempfile.mkdtemp(dir=self.tmp_dir)
+        try:
+            for name in outputs:
+                shutil.copyfile(os.path.join(source_dir, name), os.path.join(tmp_entry, name))
+            with open(os.path.join(tmp_entry, RESULT_FILE), "w", encoding="utf-8") as f:
+                json.dump(
+                    {"result": result, "outputs": outputs, "stem": stem, "created": time.time()}, f, ensure_ascii=False
+                )
+            try:
+                os.rename(tmp_entry, self.entry_path(key))
+            except OSError:
+                pass
+        finally:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    def evict(self):
+        # 按最近使用时间从旧到新删除，直到总大小不超过上限
+        entries = []
+        total = 0
+        for key in os.listdir(self.entries_dir):
+            entry = self.entry_path(key)
+            try:
+                used = os.path.getmtime(os.path.join(entry, RESULT_FILE))
+                size = sum(item.stat().st_size for item in os.scandir(entry))
+            except OSError:
+                continue
+            entries.append((used, size, entry))
+            total += size
+        entries.sort()
+        for _, size, entry in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
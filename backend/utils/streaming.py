@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# 有界内存的流式处理
+#
+# 以图片为主的书籍 (漫画、有声书) 可达数 GB，整本或整批图片读入内存会使工作进程 OOM。
+# 指定内存上限 (--extra '{"memory_limit": 512}'，单位 MB) 后:
+#   - 无需转换的成员按块搬运 (copy_member)，不整体读入；
+#   - 解码后超过单个成员上限的图片不做转换，按原样按块复制。解码后的大小按图片头中的宽高与像素格式估算
+#     (很小的 PNG/WebP 也可能解码为数百 MB 的像素)；
+#   - 在途 (已读入、尚未写出) 的成员按解码后的估算大小计，总量不超过上限；
+#   - 需要暂存的转换结果超过上限后溢出到临时文件，写出时按块读回。
+# 未指定上限时行为与原来相同。
+
+import shutil
+import tempfile
+import time
+import zipfile
+
+from PIL import Image
+
+MEMORY_CHUNK = 1 << 20
+# 单个成员最多占用上限的 1/4: 转换时解码后的图像、转换副本及编码结果同时驻留
+MEMBER_SHARE = 4
+# Pillow 内部每个像素占用的字节数，其余模式 (RGB、RGBA、CMYK、I、F 等) 为 4
+PIXEL_BYTES = {"1": 1, "L": 1, "P": 1, "I;16": 2, "I;16L": 2, "I;16B": 2, "I;16N": 2}
+
+
+def parse_memory_limit(value):
+    # 单位为 MB；为空或 0 时不限制
+    if value in (None, "", 0, "0"):
+        return None
+    return int(float(value) * 1024 * 1024)
+
+
+def decoded_size(zin, info):
+    """图片解码后一帧像素的大小 (字节)，只读取图片头；无法识别时返回 None"""
+    try:
+        with zin.open(info) as f, Image.open(f) as image:
+            width, height = image.size
+            return width * height * PIXEL_BYTES.get(image.mode, 4)
+    except Image.DecompressionBombError:
+        # 像素数超过 Pillow 的安全上限
+        return float("inf")
+    except Exception:
+        return None
+
+
+class MemoryBudget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.member_limit = max(limit // MEMBER_SHARE, MEMORY_CHUNK)
+        self.sizes = {}  # { 成员 : 估算的内存占用 }
+
+    def fits(self, zin, name):
+        """成员解压及 (图片) 解码后的大小是否允许整体读入内存"""
+        info = zin.getinfo(name)
+        size = max(info.file_size, decoded_size(zin, info) or 0)
+        self.sizes[name] = size
+        return size <= self.member_limit
+
+    def member_size(self, name, data):
+        # 在途数据按估算的内存占用计 (见 parallel.map_members)
+        return max(len(data), self.sizes.get(name, 0))
+
+
+def open_budget(memory_limit):
+    limit = parse_memory_limit(memory_limit)
+    return MemoryBudget(limit) if limit else None
+
+
+class SpillBuffer:
+    """暂存多段数据: 总量不超过 max_size 时留在内存，超过后整体转存到临时文件"""
+
+    def __init__(self, max_size):
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_size)
+        self.size = 0
+
+    def put(self, data):
+        # 返回可交给 write_member 的数据句柄
+        self.file.seek(self.size)
+        self.file.write(data)
+        spilled = Spilled(self, self.size, len(data))
+        self.size += len(data)
+        return spilled
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+class Spilled:
+    def __init__(self, buffer, offset, length):
+        self.buffer = buffer
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def copy_to(self, fileobj):
+        source = self.buffer.file
+        source.seek(self.offset)
+        remaining = self.length
+        while remaining > 0:
+            chunk = source.read(min(MEMORY_CHUNK, remaining))
+            if not chunk:
+                raise EOFError("暂存数据不完整")
+            fileobj.write(chunk)
+            remaining -= len(chunk)
+
+
+def write_member(zout, arcname, data, compress_type=zipfile.ZIP_DEFLATED):
+    """写入新成员；data 为 bytes 或 SpillBuffer 中的数据句柄，后者按块写入"""
+    if isinstance(data, (bytes, bytearray)):
+        zout.writestr(arcname, data, compress_type)
+        return
+    # 与 writestr 相同的时间与权限
+    zinfo = zipfile.ZipInfo(arcname, time.localtime(time.time())[:6])
+    zinfo.compress_type = compress_type
+    zinfo.external_attr = 0o600 << 16
+    zinfo.file_size = len(data)
+    with zout.open(zinfo, "w", force_zip64=len(data) > zipfile.ZIP64_LIMIT) as dst:
+        data.copy_to(dst)
+
+
+def stream_member(zin, zout, info):
+    """按块解压再写入 (不能直接搬运压缩数据时使用)，不整体读入内存"""
+    zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.comment = info.comment
+    zinfo.external_attr = info.external_attr
+    zinfo.file_size = info.file_size
+    with zin.open(info) as src, zout.open(zinfo, "w", force_zip64=info.file_size > zipfile.ZIP64_LIMIT) as dst:
+        shutil.copyfileobj(src, dst, MEMORY_CHUNK)
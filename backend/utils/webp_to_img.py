@@ -10,14 +10,49 @@ except ImportError:
 
 try:
     from utils.log import logwriter
+    from utils.epub_container import EpubContainer
+    from utils.parallel import map_members
+    from utils.streaming import open_budget
+    from utils import progress
 except:
     from log import logwriter
+    from epub_container import EpubContainer
+    from parallel import map_members
+    from streaming import open_budget
+    import progress
 
 logger = logwriter()
 
 
+def convert_image(img_path, img_data):
+    """将单张 WebP 图片转为 PNG(透明) 或 JPG，返回 (新路径, 新数据, media-type, 错误信息)；可在工作进程中执行"""
+    try:
+        image = Image.open(BytesIO(img_data))
+        img_basename = os.path.basename(img_path)
+        filename_no_ext, ext = os.path.splitext(img_basename)
+        
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            new_name = filename_no_ext + ".png"
+            media_type = "image/png"
+            buffer = BytesIO()
+            # Quantize to 256 colors for PNG-8 equivalent optimization if desired, 
+            # or just save as PNG. The original code used quantization.
+            # Let's keep it safe and just save as optimized PNG.
+            image.save(buffer, format="PNG", optimize=True)
+        else:
+            new_name = filename_no_ext + ".jpg"
+            media_type = "image/jpeg"
+            buffer = BytesIO()
+            image = image.convert("RGB")
+            image.save(buffer, format="JPEG")
+
+        return img_path.replace(img_basename, new_name), buffer.getvalue(), media_type, None
+    except Exception as e:
+        return img_path, None, None, str(e)
+
+
 class WebPToImage:
-    def __init__(self, epub_path, output_path):
+    def __init__(self, epub_path, output_path, max_workers=1, memory_limit=None):
         if not Image:
              raise ImportError("Pillow library not found. Please install it with 'pip install Pillow'")
 
@@ -58,6 +93,8 @@ class WebPToImage:
         self.opf = ""
         self.ori_files = []
         self.img_dict = {}
+        self.max_workers = max_workers  # 并行转码图片的进程数
+        self.budget = open_budget(memory_limit)  # 有界内存的流式处理，见 streaming.py
 
     def process(self):
         if os.path.exists(self.file_write_path):
@@ -67,11 +104,13 @@ class WebPToImage:
                 pass
 
         try:
-            with zipfile.ZipFile(self.epub_path, 'r') as self.epub, \
+            progress.output_file(self.file_write_path)
+            with EpubContainer(self.epub_path) as self.container, \
                  zipfile.ZipFile(self.file_write_path, "w", zipfile.ZIP_DEFLATED) as self.target_epub:
+                self.epub = self.container.epub
                 
                 # Scan files
-                for file in self.epub.namelist():
+                for file in self.container.namelist:
                     if file.lower().endswith(".html") or file.endswith(".xhtml"):
                         self.htmls.append(file)
                     elif file.lower().endswith(".css"):
@@ -84,7 +123,8 @@ class WebPToImage:
                         self.ori_files.append(file)
 
                 # 1. Process Images
-                self._process_images()
+                with progress.stage("convert", len(self.images), self.target_epub) as self.stage:
+                    self._process_images()
 
                 # 2. Copy original files
                 self._copy_original_files()
@@ -109,45 +149,39 @@ class WebPToImage:
             raise e
 
     def _process_images(self):
-        for img_path in self.images:
-            img_data = self.epub.read(img_path)
-            img_file = BytesIO(img_data)
-            try:
-                image = Image.open(img_file)
-                img_basename = os.path.basename(img_path)
-                filename_no_ext, ext = os.path.splitext(img_basename)
-                
-                if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
-                    new_name = filename_no_ext + ".png"
-                    self.img_dict[img_basename] = [new_name, "image/png"]
-                    
-                    buffer = BytesIO()
-                    # Quantize to 256 colors for PNG-8 equivalent optimization if desired, 
-                    # or just save as PNG. The original code used quantization.
-                    # Let's keep it safe and just save as optimized PNG.
-                    image.save(buffer, format="PNG", optimize=True)
-                    
-                    if img_basename != new_name:
-                        # Path handling if needed, but we construct full path on write
-                        pass
+        # 转码在进程池中并行，写入仍在当前线程按原顺序进行
+        images = self.images
+        max_in_flight_bytes = None
+        size_of = None
+        if self.budget is not None:
+            # 超过单个成员内存上限的图片不转换，按块原样复制
+            images = []
+            for img_path in self.images:
+                if self.budget.fits(self.epub, img_path):
+                    images.append(img_path)
                 else:
-                    new_name = filename_no_ext + ".jpg"
-                    self.img_dict[img_basename] = [new_name, "image/jpeg"]
-                    buffer = BytesIO()
-                    image = image.convert("RGB")
-                    image.save(buffer, format="JPEG")
-
-                new_img_path = img_path.replace(img_basename, new_name)
-                self.target_epub.writestr(new_img_path, buffer.getvalue())
-
-            except Exception as e:
-                logger.write(f"无法处理图片 {img_path}: {str(e)}")
-                self.target_epub.writestr(img_path, img_data)
+                    logger.write(f"图片 {img_path} 超过内存上限，保留原图")
+                    self.container.copy_to(self.target_epub, img_path)
+                    self.stage.advance(read=self.epub.getinfo(img_path).compress_size)
+            max_in_flight_bytes = self.budget.member_limit
+            size_of = self.budget.member_size
+        for img_path, (new_img_path, data, media_type, error) in map_members(
+            self.epub, images, convert_image, self.max_workers,
+            max_in_flight_bytes=max_in_flight_bytes, size_of=size_of,
+        ):
+            self.stage.advance(read=self.epub.getinfo(img_path).compress_size)
+            if error is None:
+                img_basename = os.path.basename(img_path)
+                self.img_dict[img_basename] = [os.path.basename(new_img_path), media_type]
+                self.target_epub.writestr(new_img_path, data)
+            else:
+                logger.write(f"无法处理图片 {img_path}: {error}")
+                self.container.copy_to(self.target_epub, img_path)
 
     def _copy_original_files(self):
+        # 原样复制，不解压也不重新压缩
         for item in self.ori_files:
-            content = self.epub.read(item)
-            self.target_epub.writestr(item, content)
+            self.container.copy_to(self.target_epub, item)
 
     def _replace_references(self):
         if self.opf:
@@ -215,7 +249,11 @@ class WebPToImage:
         
         updated_content = re.sub(pattern, lambda m: replace_match(m), content, flags=re.IGNORECASE)
         updated_content = re.sub(pattern2, lambda m: replace_match(m), updated_content, flags=re.IGNORECASE)
-        self.target_epub.writestr(html_path, updated_content.encode("utf-8"))
+        if updated_content == content:
+            # 没有需要替换的引用，原样复制
+            self.container.copy_to(self.target_epub, html_path)
+        else:
+            self.target_epub.writestr(html_path, updated_content.encode("utf-8"))
 
     def _replace_css(self, css_path, content):
         def replace_match(match):
@@ -230,13 +268,17 @@ class WebPToImage:
         import re
         pattern = r'url\(\s*([\'"]?)\s*(.*?)\.(webp)\s*(?:\?\S*)?\s*\1\s*\)'
         updated_css = re.sub(pattern, replace_match, content, flags=re.IGNORECASE)
-        self.target_epub.writestr(css_path, updated_css.encode("utf-8"))
+        if updated_css == content:
+            # 没有需要替换的引用，原样复制
+            self.container.copy_to(self.target_epub, css_path)
+        else:
+            self.target_epub.writestr(css_path, updated_css.encode("utf-8"))
 
 
-def run(epub_path, output_path):
+def run(epub_path, output_path, max_workers=1, memory_limit=None):
     logger.write(f"\n正在尝试将EPUB WebP图片转为PNG/JPG: {epub_path}")
     try:
-        it = WebPToImage(epub_path, output_path)
+        it = WebPToImage(epub_path, output_path, max_workers, memory_limit)
         return it.process()
     except Exception as e:
         logger.write(f"处理EPUB文件时发生错误: {str(e)}")
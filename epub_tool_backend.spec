@@ -5,8 +5,16 @@ a = Analysis(
     ['backend/cli.py'],
     pathex=['backend'],
     binaries=[],
-    datas=[],
-    hiddenimports=[],
+    datas=[
+        ('backend/utils/dict/phonetic.idx', 'utils/dict'),
+    ],
+    hiddenimports=[
+        # 按需以 importlib 导入的字典模块 (预编译索引缺失或过期时使用)，静态分析找不到
+        'utils.dict.ShengPiZi',
+        'utils.dict.Phrases',
+        'utils.dict.国标一二级汉字',
+        'utils.dict.完整拼音字典',
+    ],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -37,7 +37,10 @@ else
 fi
 
 echo "Using Python command: $PY_CMD"
-$PY_CMD -m PyInstaller --clean --onefile --name epub_tool_backend --paths backend --log-level ERROR backend/cli.py
+# Regenerate the precompiled phonetic dictionary and bundle it; the dict modules are
+# imported lazily (fallback when the index is missing), so they are listed as hidden imports
+$PY_CMD backend/utils/phonetic_index.py
+$PY_CMD -m PyInstaller --clean --onefile --name epub_tool_backend --paths backend --add-data "backend/utils/dict/phonetic.idx:utils/dict" --hidden-import utils.dict.ShengPiZi --hidden-import utils.dict.Phrases --hidden-import utils.dict.国标一二级汉字 --hidden-import utils.dict.完整拼音字典 --log-level ERROR backend/cli.py
 
 # 2. Build Wails Application
 echo "🕸️  Building Wails Application..."